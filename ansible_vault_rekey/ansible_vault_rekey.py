@@ -1,45 +1,72 @@
 # -*- coding: utf-8 -*-
 
 from collections import OrderedDict
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
 import errno
-import fnmatch
+import hashlib
 import logging
+import mmap
 import os
 import random
 import shutil
 import string
 import yaml
-import subprocess
 
-from ansible.constants import DEFAULT_VAULT_ID_MATCH
-from ansible.parsing.vault import VaultLib, VaultSecret
-
-from ansible_vault_rekey.vaultstring import VaultString
+from ansible_vault_rekey import scanner
+from ansible_vault_rekey import stream
+from ansible_vault_rekey import textscan
+from ansible_vault_rekey.manifest import file_sha256, sha256
+from ansible_vault_rekey.metrics import METRICS, call_with_metrics
+from ansible_vault_rekey.vaultstring import KEY_CACHE, VaultString
 
 """Main module."""
-yaml.add_representer(VaultString, VaultString.to_yaml, Dumper=yaml.Dumper)
-yaml.add_constructor(VaultString.yaml_tag, VaultString.yaml_constructor)
+# use libyaml's parser and emitter when PyYAML was built with it, they're several times faster.
+# safe variants only, vars files never need arbitrary python objects constructed.
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
+
+for loader in set([yaml.Loader, yaml.SafeLoader, YamlLoader]):
+    yaml.add_constructor(VaultString.yaml_tag, VaultString.yaml_constructor, Loader=loader)
+for dumper in set([yaml.Dumper, yaml.SafeDumper, YamlDumper]):
+    yaml.add_representer(VaultString, VaultString.to_yaml, Dumper=dumper)
 log = logging.getLogger()
 # log.setLevel(logging.WARNING)
 # log_console = logging.StreamHandler()
 # log_console.setLevel(logging.DEBUG)
 # log.addHandler(log_console)
 
+VAULT_HEADER = b'$ANSIBLE_VAULT'
+# what a file has to contain to hold any vault data, inline or whole, under a 1.1 or 1.2 (vault id) header
+VAULT_MARKER = b'$ANSIBLE_VAULT;'
+# what a file has to contain as well to hold inline secrets. files which only mention vaults, docs,
+# scripts, templates and the like, are skipped without being parsed
+VAULT_TAG = VaultString.yaml_tag.encode('utf-8')
+MMAP_THRESHOLD = 1024 * 1024
+# whole-file vaults this big are rekeyed a chunk at a time rather than read into memory
+STREAM_THRESHOLD = 16 * 1024 * 1024
+STAGED_SUFFIX = '.rekey-tmp'
+# files with this many inline secrets have them handed to the process pool one by one, rather
+# than holding up a single worker for the whole file
+SPLIT_SECRETS = 16
+DEFAULT_EXCLUDE = ['.rekey-backups', '.git', '.hg', '.svn', 'node_modules', '__pycache__',
+                   '*.j2', '*' + STAGED_SUFFIX]
+
 
 def get_dict_value(data, address):
     """Accepts a dictionary and an "address" (a list representing a nested dict value's key)
-    and returns the value at that "address"
+    and returns the value at that "address". The value itself is returned, not a copy.
         >>> d = {'mailserver_users': [{'somekey': 'someval'}, ...], ...}
         >>> a = ['mailserver_users', 0, 'somekey']
         >>> get_dict_value(d, a)
         'someval'
     """
-    d = deepcopy(data)
+    d = data
     for key in address:
         try:
             d = d[key]
-        except KeyError:
+        except (KeyError, IndexError, TypeError):
             return None
     return d
 
@@ -68,7 +95,8 @@ def write_password_file(path, password=None, overwrite=False):
     if os.path.isfile(path) and not overwrite:
         log.error('Cowardly refusing to overwrite an existing password file at {}'.format(path))
         return False
-    with open(path, 'w+') as f:
+    # new files are created readable by their owner only, overwritten ones keep their mode
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
         f.write(password)
     return True
 
@@ -89,39 +117,323 @@ def restore_files(files, target_path, prefix='.'):
 
 
 def backup_files(files, backup_path, prefix='.'):
-    for f in files:
-        relpath = os.path.realpath(f)[len(os.path.realpath(prefix)) + 1:]
-        newpath = os.path.join(backup_path, relpath)
-        try:
-            os.makedirs(os.path.dirname(newpath))
-        except OSError as e:
-            if e.errno != errno.EEXIST:
-                raise
-        shutil.copy(f, newpath)
-    return find_files(backup_path)
+    return [backup_file(f, backup_path, prefix) for f in files]
+
+
+def backup_name(path, prefix='.'):
+    """Where a file goes under the backup path, or in a backup archive."""
+    return os.path.realpath(path)[len(os.path.realpath(prefix)) + 1:]
+
+
+@METRICS.timed('backup')
+def backup_file(path, backup_path, prefix='.'):
+    newpath = os.path.join(backup_path, backup_name(path, prefix))
+    try:
+        os.makedirs(os.path.dirname(newpath))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    shutil.copy(path, newpath)
+    return newpath
 
 
-def find_files(path, pattern='*.*'):
-    exclude = ['.rekey-backups', '.git', '.j2']
-    for root, dirs, files in os.walk(path):
-        dirs[:] = [d for d in dirs if d not in exclude]  # this tells python to modify dirs in place
-        for name in files:                               # without creating a new list
-            if fnmatch.fnmatch(name, pattern):
-                yield os.path.realpath(os.path.join(root, name))
+def find_files(path, pattern='*.*', exclude=(), max_size=None, gitignore=False, threads=1):
+    """Generator which yields every file under path whose name matches pattern, a glob or a
+        list of globs. Version control and backup directories, templates and staged temp files
+        are always skipped, see scanner.scan_files for the rest."""
+    include = [pattern] if isinstance(pattern, str) else pattern
+    return scanner.scan_files(path, include, DEFAULT_EXCLUDE + list(exclude), max_size, gitignore, threads)
+
+
+def find_changed_files(path, rev_range=None, staged=False, pattern='*.*', exclude=(), max_size=None):
+    """find_files for only the files git says the commits in rev_range, or with staged the index,
+        added or modified. See scanner.git_changed_files."""
+    include = [pattern] if isinstance(pattern, str) else pattern
+    return scanner.git_changed_files(path, rev_range, staged, include, DEFAULT_EXCLUDE + list(exclude), max_size)
 
 
 def is_file_secret(path):
     with open(path, 'rb') as f:
-        return True if f.readline().startswith(b'$ANSIBLE_VAULT;1.1;AES256') else False
+        return True if f.readline().startswith(VAULT_MARKER) else False
+
+
+@METRICS.timed('classify')
+def classify_file(path):
+    """Reads a file once and works out what sort of vault data it holds. Returns an entry for
+        cli.main's vault_files list, carrying the file contents forward so nothing has to read or
+        parse it again, or None if the file holds no vault data:
+            {'file': path, 'sha256': '...', 'raw': b'$ANSIBLE_VAULT;1.1;AES256...'}  # whole-file vault
+            {'file': path, 'sha256': '...', 'data': {...}, 'secrets': [('password',), ...],
+             'spans': {('password',): (10, 260), ...}}  # inline, spans of each !vault node
+        Whole-file vaults over STREAM_THRESHOLD are left on disk to be streamed instead:
+            {'file': path, 'sha256': '...', 'header': b'$ANSIBLE_VAULT;1.1;AES256', 'stream': True}
+        Raises if the file has inline secrets but isn't valid YAML."""
+    METRICS.incr('files_classified')
+    with open(path, 'rb') as f:
+        prefix = f.read(len(VAULT_HEADER))
+        size = os.fstat(f.fileno()).st_size
+        if prefix == VAULT_HEADER:
+            METRICS.incr('whole_file_vaults')
+            if size >= STREAM_THRESHOLD:
+                header = (prefix + f.readline()).strip()
+                return {'file': path, 'sha256': file_sha256(path), 'header': header, 'stream': True}
+            raw = prefix + f.read()
+            return {'file': path, 'sha256': sha256(raw), 'raw': raw}
+
+        content = read_inline_candidate(f, prefix, size)
+        if content is None:
+            return None
+
+    data, found = load_yaml_secrets(content)
+    if not found:
+        return None
+    secrets = [address for address, _ in found]
+    METRICS.incr('inline_vault_files')
+    METRICS.incr('inline_secrets', len(secrets))
+    spans = dict((address, (node.start_mark.index, node.end_mark.index)) for address, node in found)
+    return {'file': path, 'sha256': sha256(content), 'data': data, 'secrets': secrets, 'spans': spans}
+
+
+def read_inline_candidate(f, prefix, size):
+    """Reads the rest of a file which isn't a whole-file vault, after prefix. Returns its contents
+        if it could hold inline secrets, otherwise None. Big files are searched through mmap and
+        only read if they could."""
+    if size >= MMAP_THRESHOLD:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if m.find(VAULT_MARKER) == -1 or m.find(VAULT_TAG) == -1:
+                return None
+            return m[:]
+    content = prefix + f.read()
+    if VAULT_MARKER not in content or VAULT_TAG not in content:
+        return None
+    return content
+
+
+@METRICS.timed('classify')
+def inventory_file(path):
+    """A cheaper classify_file for listing what a repo holds. Inline secrets are found straight
+        from the text by textscan, the file is only parsed when the scan can't be sure of it.
+        Returns None if the file holds no vault data, otherwise one of:
+            {'file': path, 'vault_ids': 'default'}                      # whole-file vault
+            {'file': path, 'vault_ids': 'dev,prod', 'secrets': [('password',), ...]}
+        """
+    METRICS.incr('files_classified')
+    with open(path, 'rb') as f:
+        prefix = f.read(len(VAULT_HEADER))
+        if prefix == VAULT_HEADER:
+            METRICS.incr('whole_file_vaults')
+            return {'file': path, 'vault_ids': vault_id(prefix + f.readline())}
+        content = read_inline_candidate(f, prefix, os.fstat(f.fileno()).st_size)
+        if content is None:
+            return None
+
+    blocks = textscan.find_vault_blocks(content.decode('utf-8'))
+    if blocks is None:
+        METRICS.incr('text_scan_fallbacks')
+        _, found = load_yaml_secrets(content)
+        blocks = [(address, None, vault_id(node.value)) for address, node in found]
+    if not blocks:
+        return None
+    METRICS.incr('inline_vault_files')
+    METRICS.incr('inline_secrets', len(blocks))
+    return {'file': path, 'vault_ids': ','.join(sorted(set(b[2] for b in blocks))),
+            'secrets': [b[0] for b in blocks]}
+
+
+def vault_id(vaulttext):
+    """Returns the vault id from a vault's header, 'default' for 1.1 vaults which don't carry one."""
+    b_vaulttext = vaulttext[:512] if isinstance(vaulttext, bytes) else vaulttext[:512].encode('utf-8')
+    header = b_vaulttext.lstrip().split(b'\n', 1)[0].strip().split(b';')
+    return header[3].decode('utf-8') if len(header) > 3 else 'default'
+
+
+def file_vault_ids(vault_file):
+    """Returns the vault ids used in a vault_files entry, as a comma separated string."""
+    if 'raw' in vault_file:
+        return vault_id(vault_file['raw'])
+    if 'header' in vault_file:
+        return vault_id(vault_file['header'])
+    ids = set(vault_id(get_dict_value(vault_file['data'], a).header) for a in vault_file['secrets'])
+    return ','.join(sorted(ids))
+
+
+def select_vault_ids(vault_file, ids):
+    """Narrows a vault_files entry down to the secrets under one of the given vault ids. Returns
+        None if it has none."""
+    if 'secrets' not in vault_file:
+        return vault_file if vault_id(vault_file.get('raw') or vault_file['header']) in ids else None
+    secrets = [a for a in vault_file['secrets']
+               if vault_id(get_dict_value(vault_file['data'], a).header) in ids]
+    return dict(vault_file, secrets=secrets) if secrets else None
 
 
 def rekey_file(path, password_file, new_password_file):
-    cmd = "ansible-vault rekey --vault-password-file {} --new-vault-password-file {} {}".format(
-        password_file, new_password_file, path)
-    subprocess.check_call(cmd, shell=True)
+    """Rekeys a whole-file vault in place, the same as `ansible-vault rekey` but in-process, so
+        there's no interpreter start and Ansible import to pay for every file."""
+    if os.path.getsize(path) >= STREAM_THRESHOLD:
+        rekey_large_file(path, None, read_keyring(password_file), read_keyring(new_password_file))
+        return True
+    with open(path, 'rb') as f:
+        ciphertext = f.read()
+    encrypted = rekey_secret(ciphertext, read_keyring(password_file), read_keyring(new_password_file))
+    replace_file(path, encrypted)
     return True
 
 
+def replace_file(path, data):
+    """Atomically replaces the contents of path with data, keeping its permissions."""
+    tmp = path + STAGED_SUFFIX
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    shutil.copymode(path, tmp)
+    os.replace(tmp, path)
+
+
+def is_streamed(vault_file):
+    return vault_file.get('stream') and 'raw' not in vault_file
+
+
+def decrypt_large_file(path, newpath, password):
+    """Streaming decrypt_secret for a whole-file vault. The plaintext goes to newpath, only once
+        the HMAC has checked out, or nowhere if newpath is None. Returns the plaintext's size."""
+    with open(path, 'rb') as src:
+        password = keyring_password(password, vault_id(src.readline()))
+        src.seek(0)
+        if not newpath:
+            return stream.decrypt(src, None, password)
+        tmp = newpath + STAGED_SUFFIX
+        try:
+            with open(tmp, 'wb') as dst:
+                size = stream.decrypt(src, dst, password)
+        except Exception:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            raise
+    os.replace(tmp, newpath)
+    return size
+
+
+def rekey_large_file(path, newpath, password, new_password):
+    """Streaming rekey_secret for a whole-file vault, so memory use stays the same whatever its
+        size. Writes to newpath, or to a temp file which atomically replaces path if newpath is
+        None. Returns the plaintext's size. Vaults under an id new_password has no password for
+        are copied as they are."""
+    target = newpath or path + STAGED_SUFFIX
+    try:
+        with open(path, 'rb') as src, open(target, 'wb') as dst:
+            vid = vault_id(src.readline())
+            src.seek(0)
+            if isinstance(new_password, dict) and vid not in new_password:
+                shutil.copyfileobj(src, dst)
+                size = None
+            else:
+                size = stream.rekey(src, dst, keyring_password(password, vid), new_password[vid]
+                                    if isinstance(new_password, dict) else new_password, vault_id=vid)
+    except Exception:
+        if os.path.isfile(target):
+            os.remove(target)
+        raise
+    if not newpath:
+        shutil.copymode(path, target)
+        os.replace(target, path)
+    return size
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def read_password(password_file):
+    with open(password_file) as f:
+        return f.read().strip()
+
+
+def read_keyring(password_files):
+    """Reads a dict of vault id -> password file into a keyring of vault id -> password. A single
+        password file is read as a single password, used whatever a vault's id."""
+    if isinstance(password_files, dict):
+        return dict((vid, read_password(path)) for vid, path in password_files.items())
+    return read_password(password_files)
+
+
+def keyring_password(keyring, vid):
+    """Returns the password to use for vault id vid, see read_keyring."""
+    if not isinstance(keyring, dict):
+        return keyring
+    if vid not in keyring:
+        raise ValueError('No password given for vault id {}'.format(vid))
+    return keyring[vid]
+
+
+def decrypt_secret(ciphertext, password):
+    """Decrypts a single vault blob, either a whole file's contents or one inline secret.
+        password can be a keyring, see read_keyring."""
+    return KEY_CACHE.decrypt(ciphertext, keyring_password(password, vault_id(ciphertext)))
+
+
+def encrypt_secret(plaintext, password, vault_id=None):
+    """Encrypts a single value, either a whole file's contents or one inline secret."""
+    return KEY_CACHE.encrypt(plaintext, password, vault_id)
+
+
+def rekey_secret(ciphertext, password, new_password):
+    """Re-encrypts a single vault blob under new_password, keeping its vault id. The plaintext
+        never leaves this call. Either password can be a keyring, see read_keyring, secrets under
+        an id the new keyring has no password for are returned as they are."""
+    vid = vault_id(ciphertext)
+    if isinstance(new_password, dict) and vid not in new_password:
+        return ciphertext if isinstance(ciphertext, bytes) else ciphertext.encode('utf-8')
+    return encrypt_secret(decrypt_secret(ciphertext, password), keyring_password(new_password, vid), vid)
+
+
+def parallel_map(func, tasks, jobs=1, executor=None):
+    """Calls func(*task) for every task, spreading the calls across a pool of `jobs` processes,
+        or across executor, a process pool which is already running, if given.
+        Returns one (result, error) tuple per task, in the same order as tasks, so a failure
+        only ever affects the task that raised it."""
+    results = []
+    if executor is None and (jobs <= 1 or len(tasks) <= 1):
+        for task in tasks:
+            try:
+                results.append((func(*task), None))
+            except Exception as e:
+                results.append((None, e))
+        return results
+
+    pool = executor or ProcessPoolExecutor(max_workers=jobs)
+    try:
+        futures = [pool.submit(call_with_metrics, func, task) for task in tasks]
+        for future in futures:
+            try:
+                result, snapshot = future.result()
+                METRICS.merge(snapshot)
+                results.append((result, None))
+            except Exception as e:
+                results.append((None, e))
+    finally:
+        if executor is None:
+            pool.shutdown()
+    return results
+
+
+@METRICS.timed('write')
+def write_decrypted(path, decrypted, vault_file=None):
+    """Writes decrypted data to path. Decrypted vars files are spliced into their original
+        text where possible, see splice_yaml, and re-emitted otherwise."""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    spliced = splice_yaml(vault_file, decrypted, render_plaintext) if vault_file else None
+    with open(path, 'wb') as f:
+        if spliced is not None:
+            f.write(spliced.encode('utf-8'))
+        elif not isinstance(decrypted, bytes):
+            # yaml
+            f.write(yaml.dump(decrypted, Dumper=YamlDumper).encode('utf-8'))
+        else:
+            f.write(decrypted)
+
+
 def decrypt_file(path, password_file, newpath=None):
     """Decrypts an Ansible Vault encrypted file and returns unmodified contents. Set newpath to
         write the result somewhere."""
@@ -129,34 +441,98 @@ def decrypt_file(path, password_file, newpath=None):
     decrypted = None
     if is_file_secret(path):
         # log.debug('file is fully encrypted')
-        with open(password_file, 'rb') as f:
-            vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(f.read().strip()))])
-        # log.debug('vault fetched with password file: {}'.format(password_file))
         with open(path, 'rb') as f:
-            decrypted = vault.decrypt(f.read())
+            decrypted = decrypt_secret(f.read(), read_keyring(password_file))
         # log.debug('loaded file: {}'.format(decrypted))
     else:
         decrypted = parse_yaml(path)
-        for secret in find_yaml_secrets(decrypted):
-            v = get_dict_value(decrypted, secret)
-            plaintext = v.decrypt(open(password_file).read().strip()).decode('utf-8')
-            put_dict_value(decrypted, secret, plaintext)
+        password = read_keyring(password_file)
+        for _, container, key in list(find_yaml_secret_slots(decrypted)):
+            container[key] = decrypt_secret(container[key].ciphertext, password).decode('utf-8')
 
     if not decrypted:
         raise ValueError('The Vault library extracted nothing from the file. Is it actually encrypted?')
 
     if newpath:
-        if not os.path.isdir(os.path.dirname(newpath)):
-            os.makedirs(os.path.dirname(newpath))
-        with open(newpath, 'wb') as f:
-            if not isinstance(decrypted, bytes):
-                # yaml
-                f.write(yaml.dump(decrypted).encode('utf-8'))
-            else:
-                f.write(decrypted)
+        write_decrypted(newpath, decrypted)
     return decrypted
 
 
+def map_vault_files(vault_files, func, args=(), jobs=1, unwrap=None, wrap=None, stream=None, newpaths=None,
+                    executor=None):
+    """Calls func(value, *args) on every whole file's contents and every inline secret in
+        vault_files (dicts as built by cli.main), spread across `jobs` processes. Whole-file
+        vaults are one task each, inline secrets are handed out individually so that one file
+        full of secrets doesn't hold up the rest of the run. Inline values are passed through
+        unwrap before the call and the results through wrap before they're put back in place.
+        Contents already loaded by classify_file are used as-is rather than re-read, a 'data'
+        document is updated in place. Whole-file vaults classify_file left on disk to be streamed
+        are handed to stream(path, newpath, *args) instead, which writes its own output. With
+        executor, a running process pool, the calls go to it instead, see parallel_map.
+        Returns one [result, error] pair per file, in the same order as vault_files."""
+    results = [[None, None] for _ in vault_files]
+    tasks, owners, streams, streamed = [], [], [], []
+    for i, vf in enumerate(vault_files):
+        try:
+            if stream and is_streamed(vf):
+                streams.append((vf['file'], newpaths[i] if newpaths else None) + tuple(args))
+                streamed.append((i, None))
+            elif vf.get('secrets'):
+                results[i][0] = vf['data'] if 'data' in vf else parse_yaml(vf['file'])
+                for address in vf['secrets']:
+                    value = get_dict_value(results[i][0], address)
+                    tasks.append((unwrap(value) if unwrap else value,) + tuple(args))
+                    owners.append((i, address))
+            else:
+                data = vf['raw'] if 'raw' in vf else read_bytes(vf['file'])
+                if not data:
+                    raise ValueError('Unable to parse/read file {}'.format(vf['file']))
+                tasks.append((data,) + tuple(args))
+                owners.append((i, None))
+        except Exception as e:
+            results[i][1] = e
+
+    mapped = list(zip(owners, parallel_map(func, tasks, jobs, executor)))
+    if streams:
+        mapped += zip(streamed, parallel_map(stream, streams, jobs, executor))
+    for (i, address), (value, error) in mapped:
+        if results[i][1]:
+            continue
+        if error:
+            results[i][1] = error
+        elif address is None:
+            results[i][0] = value
+        else:
+            put_dict_value(results[i][0], address, wrap(value) if wrap else value)
+
+    for result in results:
+        if result[1]:
+            result[0] = None
+    return results
+
+
+def decrypt_files(vault_files, password_file, newpaths=None, jobs=1, executor=None):
+    """Decrypts every file in vault_files across `jobs` processes, see map_vault_files. Set
+        newpaths to a list matching vault_files to write the results somewhere. Large whole-file
+        vaults are streamed, their result is the plaintext size rather than the plaintext.
+        password_file can also be a dict of vault id -> password file, see read_keyring.
+        Returns one (decrypted, error) tuple per file, in the same order as vault_files."""
+    results = map_vault_files(vault_files, decrypt_secret, (read_keyring(password_file),), jobs,
+                              unwrap=lambda v: v.ciphertext, wrap=lambda p: p.decode('utf-8'),
+                              stream=decrypt_large_file, newpaths=newpaths, executor=executor)
+    for i, result in enumerate(results):
+        if result[1]:
+            continue
+        if not result[0]:
+            result[1] = ValueError('The Vault library extracted nothing from the file. Is it actually encrypted?')
+        elif newpaths and not is_streamed(vault_files[i]):
+            try:
+                write_decrypted(newpaths[i], result[0], vault_files[i])
+            except Exception as e:
+                result[1] = e
+    return [tuple(r) for r in results]
+
+
 def encrypt_file(path, password_file, newpath=None, secrets=None):
     """Encrypts an Ansible Vault file. Returns encrypted data. Set newpath to
         write the result somewhere. Set secrets to specify inline secret addresses."""
@@ -188,50 +564,331 @@ def encrypt_file(path, password_file, newpath=None, secrets=None):
             write_yaml(newpath, data)
         return data
     else:
-        vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(p.encode('utf-8')))])
-        encrypted = vault.encrypt(data)
+        encrypted = encrypt_secret(data, p)
         with open(newpath, 'wb') as f:
             f.write(encrypted)
         return encrypted
 
 
+def encrypt_files(vault_files, password_file, newpaths, jobs=1):
+    """Encrypts every file in vault_files across `jobs` processes, see map_vault_files, and
+        writes the results to the matching entries in newpaths. Files with a list of secrets
+        have those addresses encrypted inline, everything else is encrypted whole.
+        Returns one (encrypted, error) tuple per file, in the same order as vault_files."""
+    results = map_vault_files(vault_files, encrypt_secret, (read_password(password_file),), jobs,
+                              wrap=VaultString)
+    return write_encrypted_results(results, newpaths)
+
+
+def rekey_files(vault_files, password_file, new_password_file, newpaths=None, jobs=1, preserve_format=True,
+                executor=None):
+    """Re-encrypts every file in vault_files under the password in new_password_file, across
+        `jobs` processes, see map_vault_files. Each value is decrypted and re-encrypted inside a
+        single task, so plaintext only ever exists in memory and never reaches the disk. Set
+        newpaths to a list matching vault_files to write the results somewhere, large whole-file
+        vaults are only streamed straight to their newpath when it's set, as their result is then
+        just the plaintext size. Either password file can also be a dict of vault id -> password
+        file, see read_keyring, only secrets under the ids in new_password_file are rekeyed.
+        Vars files only have their !vault blocks rewritten unless preserve_format is False, see
+        splice_yaml. executor is passed on to map_vault_files.
+        Returns one (encrypted, error) tuple per file, in the same order as vault_files."""
+    args = (read_keyring(password_file), read_keyring(new_password_file))
+    results = map_vault_files(vault_files, rekey_secret, args, jobs,
+                              unwrap=lambda v: v.ciphertext, wrap=VaultString,
+                              stream=rekey_large_file if newpaths else None, newpaths=newpaths, executor=executor)
+    if newpaths:
+        newpaths = [None if is_streamed(vf) else p for vf, p in zip(vault_files, newpaths)]
+    return write_encrypted_results(results, newpaths, vault_files if preserve_format else None)
+
+
+def rekey_staged(password_file, new_password_file, preserve_format, verify, vault_file, executor=None):
+    """rekey_files for a single vault_files entry, writing to its 'staged' path. For pipeline
+        stages, which may run in another process, so only a summary comes back rather than the
+        rekeyed data: (file, sha256 of the staged file, error). With verify, the staged file is
+        then checked with verify_staged and any mismatch is returned as the error. Pass a running
+        process pool as executor to spread a file with many inline secrets across it."""
+    originals = None
+    if verify and vault_file.get('secrets'):
+        data = vault_file['data'] if 'data' in vault_file else parse_yaml(vault_file['file'])
+        originals = [get_dict_value(data, a).ciphertext for a in vault_file['secrets']]
+    _, error = rekey_files([vault_file], password_file, new_password_file, [vault_file['staged']],
+                           preserve_format=preserve_format, executor=executor)[0]
+    try:
+        if verify and not error:
+            mismatches = verify_staged(vault_file, originals, read_keyring(password_file),
+                                       read_keyring(new_password_file), executor)
+            if mismatches:
+                error = ValueError('Verification failed, the new ciphertext does not decrypt to the original at {}'.format(
+                    ', '.join('the whole file' if a is None else str(list(a)) for a in mismatches)))
+        return vault_file['file'], None if error else file_sha256(vault_file['staged']), error
+    except Exception as e:
+        return vault_file['file'], None, e
+
+
+def plaintext_sha256(vaulttext, password):
+    try:
+        return sha256(decrypt_secret(vaulttext, password))
+    except Exception:
+        return None
+
+
+def streamed_plaintext_sha256(path, password):
+    h = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            password = keyring_password(password, vault_id(f.readline()))
+            f.seek(0)
+            for chunk in stream.plaintext_chunks(f, password):
+                h.update(chunk)
+    except Exception:
+        return None
+    return h.hexdigest()
+
+
+def secret_matches(ciphertext, original, password, new_password):
+    """Whether ciphertext, under new_password, decrypts to the same plaintext as original does
+        under password."""
+    after = plaintext_sha256(ciphertext, new_password)
+    return bool(after) and after == plaintext_sha256(original, password)
+
+
+@METRICS.timed('verify')
+def verify_staged(vault_file, originals, password, new_password, executor=None):
+    """Decrypts a vault_files entry's staged file with new_password and compares each value's
+        digest with the original's, decrypted with password. originals are the entry's original
+        inline ciphertexts, in the same order as its secrets. Run in the same process as the
+        rekey, both decrypts find their derived keys already in KEY_CACHE, so this costs no key
+        derivation, unless the secrets are spread across executor, a running process pool.
+        Returns the addresses which don't match, None standing for a whole file."""
+    if 'secrets' not in vault_file:
+        if is_streamed(vault_file):
+            before = streamed_plaintext_sha256(vault_file['file'], password)
+            after = streamed_plaintext_sha256(vault_file['staged'], new_password)
+        else:
+            before = plaintext_sha256(vault_file.get('raw') or read_bytes(vault_file['file']), password)
+            after = plaintext_sha256(read_bytes(vault_file['staged']), new_password)
+        METRICS.incr('files_verified')
+        return [] if before and before == after else [None]
+
+    data = parse_yaml(vault_file['staged'])
+    mismatches, tasks, checked = [], [], []
+    for address, original in zip(vault_file['secrets'], originals):
+        value = get_dict_value(data, address)
+        if isinstance(value, VaultString):
+            tasks.append((value.ciphertext, original, password, new_password))
+            checked.append(address)
+        else:
+            mismatches.append(address)
+    for address, (matches, error) in zip(checked, parallel_map(secret_matches, tasks, executor=executor)):
+        if error or not matches:
+            mismatches.append(address)
+    METRICS.incr('files_verified')
+    METRICS.incr('secrets_verified', len(originals))
+    return mismatches
+
+
+def decrypt_checked(password_file, vault_file, executor=None):
+    """decrypt_files for a single vault_files entry, only checking that it decrypts. For pipeline
+        stages, returns (file, None, error), the same shape as rekey_staged."""
+    return vault_file['file'], None, decrypt_files([vault_file], password_file, executor=executor)[0][1]
+
+
+@METRICS.timed('write')
+def write_encrypted_results(results, newpaths=None, vault_files=None):
+    """Writes each result to its newpath. With vault_files, vars files are spliced into their
+        original text where possible, see splice_yaml, rather than re-emitted."""
+    for i, result in enumerate(results):
+        if result[1] or not newpaths or not newpaths[i]:
+            continue
+        try:
+            spliced = None
+            if vault_files and not isinstance(result[0], bytes):
+                spliced = splice_yaml(vault_files[i], result[0], render_vault_block)
+            if isinstance(result[0], bytes) or spliced is not None:
+                with open(newpaths[i], 'wb') as f:
+                    f.write(result[0] if spliced is None else spliced.encode('utf-8'))
+            else:
+                write_yaml(newpaths[i], result[0])
+        except Exception as e:
+            result[1] = e
+    return [tuple(r) for r in results]
+
+
+def splice_yaml(vault_file, data, render):
+    """Rebuilds a vars file's original text with only its !vault nodes replaced, keeping every
+        comment, key order and bit of whitespace, and saving a full emit of the document. Each
+        node's span, recorded by classify_file, is replaced with render(original node text, new
+        value at its address in data). Returns the new text, or None if the file has to be
+        re-emitted instead: the file wasn't classified with spans, a node can't be rendered or
+        several addresses share one node through anchors, aliases or merge keys."""
+    if not vault_file.get('spans') or not vault_file.get('secrets'):
+        return None
+    with open(vault_file['file'], 'rb') as f:
+        content = f.read()
+    if sha256(content) != vault_file['sha256']:
+        raise ValueError('{} changed since it was scanned'.format(vault_file['file']))
+    text = content.decode('utf-8')
+
+    replacements = []
+    for address in vault_file['secrets']:
+        span = vault_file['spans'].get(tuple(address))
+        if not span or any(span == s for s, _ in replacements):
+            return None
+        new = render(text[span[0]:span[1]], get_dict_value(data, address))
+        if new is None:
+            return None
+        replacements.append((span, new))
+
+    parts, last = [], 0
+    for (start, end), new in sorted(replacements):
+        if start < last:
+            return None
+        parts += [text[last:start], new]
+        last = end
+    parts.append(text[last:])
+    return ''.join(parts)
+
+
+def is_vault_block(original):
+    """True if a node's text is a plain `!vault |` block scalar, without an anchor."""
+    header, _, body = original.partition('\n')
+    tokens = header.split('#', 1)[0].split()
+    return len(tokens) == 2 and tokens[0] == VaultString.yaml_tag and tokens[1].startswith('|') and bool(body.strip())
+
+
+def render_vault_block(original, value):
+    """Renders value's ciphertext in place of an original `!vault |` block scalar, keeping its
+        tag line, indentation and trailing blank lines. None for any other style of node."""
+    if not is_vault_block(original):
+        return None
+    # the block's own line breaks, so a CRLF file stays CRLF
+    newline = '\r\n' if '\r\n' in original else '\n'
+    header, _, body = original.partition('\n')
+    indent = body[:len(body) - len(body.lstrip(' '))]
+    content = body.rstrip()
+    lines = ['{}{}'.format(indent, line) for line in value.ciphertext.splitlines()]
+    return newline.join([header.rstrip('\r')] + lines) + body[len(content):]
+
+
+def render_plaintext(original, value):
+    """Renders a decrypted value as a double quoted scalar in place of an original `!vault |`
+        block scalar. None for any other style of node."""
+    if not is_vault_block(original):
+        return None
+    quoted = yaml.dump(value, Dumper=YamlDumper, default_style='"', width=2 ** 30, allow_unicode=True)
+    return quoted.rstrip('\n') + original[len(original.rstrip()):]
+
+
 def parse_yaml(path):
     with open(path) as f:
-        return yaml.load(f, Loader=yaml.Loader)
+        return load_yaml(f)
+
+
+@METRICS.timed('yaml_load')
+def load_yaml(stream):
+    return yaml.load(stream, Loader=YamlLoader)
 
 
+@METRICS.timed('yaml_load')
+def load_yaml_secrets(stream):
+    """load_yaml for a document which may hold secrets. Its !vault nodes are found in the
+        composed node graph first, so a document without any is never constructed into Python
+        objects at all. Returns (data, [(address, node), ...]), data is None without secrets."""
+    loader = YamlLoader(stream)
+    try:
+        node = loader.get_single_node()
+        found = list(find_yaml_node_secrets(loader, node)) if node is not None else []
+        return (loader.construct_document(node) if found else None), found
+    finally:
+        loader.dispose()
+
+
+@METRICS.timed('yaml_dump')
 def write_yaml(path, data):
     if not os.path.isdir(os.path.dirname(path)):
         os.makedirs(os.path.dirname(path))
     with open(path, 'w+') as f:
-        f.write(yaml.dump(data, default_flow_style=False))
+        f.write(yaml.dump(data, Dumper=YamlDumper, default_flow_style=False))
 
 
 def find_yaml_secrets(data, path=None):
-    """Generator which results a list of YAML key paths formatted as lists.
+    """Generator which results the YAML key paths of every secret, formatted as tuples.
             >>> for i in find_yaml_secrets(data):
             ...   print(i)
             ...
-            ['test_password']                       # data['test_password']
-            ['mailserver_users', 0, 'password']     # data['mailserver_users'][0]['password']
+            ('test_password',)                      # data['test_password']
+            ('mailserver_users', 0, 'password')     # data['mailserver_users'][0]['password']
+    """
+    for address, _, _ in find_yaml_secret_slots(data, path):
+        yield address
+
+
+def find_yaml_secret_slots(data, path=None):
+    """Like find_yaml_secrets, but also yields the container holding each secret and its key
+        in that container, so every secret in a document can be read or replaced in a single
+        pass without walking back down from the root.
+            >>> for address, container, key in find_yaml_secret_slots(data):
+            ...   container[key] = 'newval'         # same as put_dict_value(data, address, ...)
+        Walks the document with an explicit stack, in document order, so there's no limit on
+        how deeply it can be nested, and only builds an address for containers and secrets.
     """
-    path = [] if not path else path
+    path = tuple(path) if path else ()
     if data.__class__ is VaultString:
-        yield path
-    if isinstance(data, list):
-        counter = 0
-        for item in data:
-            newpath = path + [counter]
-            result = find_yaml_secrets(item, newpath)
-            if result:
-                for r in result:
-                    yield r
-            counter += 1
-    # log.debug(data)
-    if isinstance(data, dict) or isinstance(data, OrderedDict):
-        for k, v in data.items():
-            newpath = path + [k]
-            result = find_yaml_secrets(v, newpath)
-            if result:
-                for r in result:
-                    yield r
+        yield path, None, None
+        return
+    if not isinstance(data, (list, dict)):
+        return
+    stack = [(path, data, _children(data))]
+    while stack:
+        prefix, container, children = stack[-1]
+        for key, value in children:
+            if value.__class__ is VaultString:
+                yield prefix + (key,), container, key
+            elif isinstance(value, (list, dict)):
+                stack.append((prefix + (key,), value, _children(value)))
+                break
+        else:
+            stack.pop()
+
+
+def _children(container):
+    return enumerate(container) if isinstance(container, list) else iter(container.items())
+
+
+def find_yaml_node_secrets(loader, node):
+    """find_yaml_secrets for a composed, not yet constructed, document: yields the address and
+        node of every !vault node under node. Only mapping keys are constructed along the way,
+        scalars are never pushed onto the stack and nothing else is built."""
+    if node.tag == VaultString.yaml_tag:
+        yield (), node
+        return
+    stack = [((), _node_children(loader, node))]
+    while stack:
+        prefix, children = stack[-1]
+        for key, child in children:
+            if child.tag == VaultString.yaml_tag:
+                yield prefix + (key,), child
+            elif isinstance(child, (yaml.MappingNode, yaml.SequenceNode)):
+                stack.append((prefix + (key,), _node_children(loader, child)))
+                break
+        else:
+            stack.pop()
+
+
+def _node_children(loader, node):
+    if isinstance(node, yaml.SequenceNode):
+        return enumerate(node.value)
+    if isinstance(node, yaml.MappingNode):
+        # merge keys and duplicates resolve the same way they will when the data is constructed
+        loader.flatten_mapping(node)
+        children = OrderedDict()
+        for key_node, child in node.value:
+            key = loader.construct_object(key_node)
+            try:
+                hash(key)
+            except TypeError as e:
+                raise yaml.constructor.ConstructorError('while constructing a mapping', node.start_mark,
+                                                        'found unhashable key ({})'.format(e), key_node.start_mark)
+            children[key] = child
+        return iter(children.items())
+    return iter(())
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+"""Backs up the files a rekey touches into one tar archive, written front to back in a single
+pass, rather than copying each into a mirrored directory tree.
+
+Compressed archives hold each member as a gzip member of its own. Concatenated gzip members
+are still one valid gzip stream, so `tar -xzf` reads the archive as usual, while a restore can
+seek straight to the one it wants and decompress only that. Where each member starts is kept in
+an index alongside the archive, a JSON line appended per member as it's written, so an archive
+cut short by a crash can still be restored from as far as it got."""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zlib
+
+from ansible_vault_rekey.metrics import METRICS
+
+FORMATS = OrderedDict([('tar', '.tar'), ('tar.gz', '.tar.gz')])
+INDEX_SUFFIX = '.index'
+CHUNK_SIZE = 1024 * 1024
+# members built in memory up to this size, spooled to a temp file past it
+SPOOL_SIZE = 4 * 1024 * 1024
+
+
+def find_archives(backup_path):
+    """Returns the paths of every archive under backup_path with an index, oldest first."""
+    if not os.path.isdir(backup_path):
+        return []
+    names = sorted(n for n in os.listdir(backup_path)
+                   if n.startswith('backup-') and any(n.endswith(suffix) for suffix in FORMATS.values()))
+    return [os.path.join(backup_path, n) for n in names if os.path.isfile(os.path.join(backup_path, n + INDEX_SUFFIX))]
+
+
+def load_index(archive_path):
+    """Returns {member name: index entry} for an archive, the last entry winning if a file was
+        added twice. A partly written last line, from a run which was killed, is ignored."""
+    entries = OrderedDict()
+    with open(archive_path + INDEX_SUFFIX) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            entries[entry['name']] = entry
+    return entries
+
+
+def latest_entries(archives):
+    """Returns {member name: (archive path, index entry)} across archives, from the newest
+        archive holding each name."""
+    entries = OrderedDict()
+    for archive_path in archives:
+        for name, entry in load_index(archive_path).items():
+            entries[name] = archive_path, entry
+    return entries
+
+
+def create(path, mode):
+    """open(path, mode) for a new file only its owner can read. Archives hold the old password
+        files, whatever the umask is."""
+    flags = os.O_WRONLY | os.O_CREAT | (os.O_EXCL if 'x' in mode else os.O_TRUNC)
+    return os.fdopen(os.open(path, flags, 0o600), mode.replace('x', 'w'))
+
+
+class ArchiveWriter:
+    """Appends files to a new archive under backup_path. Safe to add to from several threads:
+    members are read and compressed in parallel and only written out one at a time."""
+
+    def __init__(self, backup_path, backup_format='tar.gz'):
+        if not os.path.isdir(backup_path):
+            os.makedirs(backup_path)
+        self.compress = backup_format == 'tar.gz'
+        self.lock = threading.Lock()
+        self.offset = 0
+        stamp = time.strftime('%Y%m%dT%H%M%S')
+        for i in range(1000):
+            self.path = os.path.join(backup_path, 'backup-{}-{:03}{}'.format(stamp, i, FORMATS[backup_format]))
+            try:
+                self.f = create(self.path, 'xb')
+                break
+            except FileExistsError:
+                continue
+        else:
+            raise OSError('No free archive name under {}'.format(backup_path))
+        self.index = create(self.path + INDEX_SUFFIX, 'w')
+
+    def _encoder(self):
+        if not self.compress:
+            return lambda b: b, lambda: b''
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return compressor.compress, compressor.flush
+
+    @METRICS.timed('backup')
+    def add(self, path, name):
+        """Adds the file at path to the archive as name. Returns its index entry."""
+        st = os.stat(path)
+        info = tarfile.TarInfo(name)
+        info.size, info.mode, info.mtime = st.st_size, st.st_mode & 0o7777, int(st.st_mtime)
+        header = info.tobuf(tarfile.PAX_FORMAT)
+        sha256 = hashlib.sha256()
+        encode, flush = self._encoder()
+
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as member:
+            member.write(encode(header))
+            remaining = info.size
+            with open(path, 'rb') as src:
+                while remaining:
+                    chunk = src.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise ValueError('{} shrank while being backed up'.format(path))
+                    sha256.update(chunk)
+                    member.write(encode(chunk))
+                    remaining -= len(chunk)
+            member.write(encode(b'\0' * (-info.size % tarfile.BLOCKSIZE)))
+            member.write(flush())
+            length = member.tell()
+            member.seek(0)
+
+            entry = OrderedDict([('name', name), ('offset', None), ('length', length), ('header', len(header)),
+                                 ('size', info.size), ('mode', info.mode), ('sha256', sha256.hexdigest())])
+            with self.lock:
+                entry['offset'] = self.offset
+                shutil.copyfileobj(member, self.f, CHUNK_SIZE)
+                self.offset += length
+                # the member goes out before the entry pointing at it
+                self.f.flush()
+                self.index.write(json.dumps(entry) + '\n')
+                self.index.flush()
+        METRICS.incr('backup_bytes', info.size)
+        return entry
+
+    def close(self):
+        with self.lock:
+            encode, flush = self._encoder()
+            self.f.write(encode(b'\0' * 2 * tarfile.BLOCKSIZE) + flush())
+            self.f.close()
+            self.index.close()
+
+
+def member_chunks(archive_path, entry):
+    """Generator which yields the contents of one archived file a chunk at a time, read from
+        where the index says it is. Raises ValueError once everything has been read if it
+        doesn't match the hash it was archived with."""
+    compressed = archive_path.endswith(FORMATS['tar.gz'])
+    decompressor = zlib.decompressobj(31) if compressed else None
+    skip, remaining, left = entry['header'], entry['size'], entry['length']
+    sha256 = hashlib.sha256()
+    with open(archive_path, 'rb') as f:
+        f.seek(entry['offset'])
+        while remaining and left:
+            chunk = f.read(min(CHUNK_SIZE, left))
+            if not chunk:
+                break
+            left -= len(chunk)
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            chunk, skip = chunk[skip:], max(0, skip - len(chunk))
+            chunk = chunk[:remaining]
+            remaining -= len(chunk)
+            sha256.update(chunk)
+            yield chunk
+    if remaining or sha256.hexdigest() != entry['sha256']:
+        raise ValueError('{} is damaged in {}'.format(entry['name'], archive_path))
+
+
+def extract(archive_path, entry, target):
+    """Writes one archived file to target, with the mode it was archived with, replacing
+        target only once the whole file has been read back and checked."""
+    if os.path.dirname(target) and not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+    tmp = '{}.restore-tmp'.format(target)
+    try:
+        with open(tmp, 'wb') as f:
+            for chunk in member_chunks(archive_path, entry):
+                f.write(chunk)
+        os.chmod(tmp, entry['mode'])
+        os.replace(tmp, target)
+    finally:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+    return target
@@ -2,18 +2,30 @@
 
 """(Re)keys Ansible Vault repos."""
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import click
+import cProfile
+import functools
 import logging
 import os
 import shutil
 import sys
-
-from ansible.parsing.vault import is_encrypted_file
+import yaml
 
 if sys.version_info >= (3, 0):
     import ansible_vault_rekey.ansible_vault_rekey as rekey
 else:
     import ansible_vault_rekey as rekey
+from ansible_vault_rekey import archive
+from ansible_vault_rekey import commit
+from ansible_vault_rekey import index
+from ansible_vault_rekey import manifest
+from ansible_vault_rekey import pipeline
+from ansible_vault_rekey import scanner
+from ansible_vault_rekey import shard
+from ansible_vault_rekey.metrics import METRICS, call_with_metrics
+from ansible_vault_rekey.vaultstring import KEY_CACHE
 
 
 log = logging.getLogger()
@@ -24,114 +36,657 @@ log_console = logging.StreamHandler()
 log_console.setLevel(logging.INFO)
 log.addHandler(log_console)
 
+# files rekeyed between manifest saves, bounds the work an interrupted run loses
+CHUNK_SIZE = 64
+
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option('--debug', 'debug', default=False, is_flag=True)
 @click.option('--dry-run', 'dry_run', default=False, is_flag=True,
               help="Skip any action that would overwrite an original file.")
 @click.option('--keep-backups', '-k', 'keep_backups', default=False, is_flag=True,
-              help='Keep unencrypted copies of files after a successful rekey.')
+              help='Keep copies of the original encrypted files after a successful rekey.')
+@click.option('--no-backups', 'no_backups', default=False, is_flag=True,
+              help='Skip backing up the original encrypted files.')
+@click.option('--backup-format', 'backup_format', type=click.Choice(['tree'] + list(archive.FORMATS)), default='tree',
+              help='Back up to a copy of each file under .rekey-backups, or to a single tar archive there, '
+                   'optionally gzipped, which the restore command can pull single files from. Default: tree')
 @click.option('--code-path', '-r', 'code_path', default='.',
               help='Path to Ansible code.')
 @click.option('--password-file', '-p', 'password_file', default=None,
               type=str, help='Path to password file. Default: vault-password.txt')
+@click.option('--vault-id', 'vault_ids', multiple=True,
+              help='Rekey secrets under a vault id, given as ID@PASSWORD_FILE. Can be repeated, '
+                   'every id is rekeyed in the same pass and secrets under ids not given are left alone.')
+@click.option('--new-password-file', 'new_password_file_specs', multiple=True,
+              help='With --shard, re-encrypt under the password in this file rather than a generated one, given as '
+                   '[ID@]PASSWORD_FILE for each vault id. Every shard has to be given the same.')
 @click.option('--vars-file', '-v', 'varsfile', type=str, default=None,
               help='Only operate on the file specified. Default is to check every file for encrypted assets.')
-def main(password_file, varsfile, code_path, dry_run, keep_backups, debug):
+@click.option('--jobs', '-j', 'jobs', type=int, default=1,
+              help='Number of processes to decrypt and encrypt with. 0 uses every CPU. Default: 1')
+@click.option('--include', 'include', multiple=True, default=['*.*'],
+              help='Only check files whose names match this glob. Can be repeated. Default: *.*')
+@click.option('--exclude', 'exclude', multiple=True,
+              help='Skip files and directories whose names match this glob. Can be repeated.')
+@click.option('--max-size', 'max_size', type=int, default=None,
+              help='Skip files larger than this many bytes.')
+@click.option('--gitignore', 'gitignore', default=False, is_flag=True,
+              help="Skip anything .gitignore files say git should ignore.")
+@click.option('--scan-threads', 'scan_threads', type=int, default=4,
+              help='Number of threads to scan directories with. Default: 4')
+@click.option('--index-file', 'index_file', type=str, default=None,
+              help='Where to cache scan results between runs. Default: ~/.cache/ansible-vault-rekey/')
+@click.option('--no-cache', 'no_cache', default=False, is_flag=True,
+              help='Ignore cached scan results and check every file from scratch.')
+@click.option('--resume', 'resume', default=False, is_flag=True,
+              help='Pick up an interrupted rekey from the manifest in the backup directory.')
+@click.option('--since', 'since', type=str, default=None,
+              help='Only re-encrypt files which changed since the given manifest was written, keeping the current password.')
+@click.option('--git-diff', 'git_diff', type=str, default=None,
+              help='Only re-encrypt files which the commits in this git range added, modified or renamed, '
+                   'keeping the current password.')
+@click.option('--staged', 'git_staged', default=False, is_flag=True,
+              help='Only re-encrypt files staged in the git index, keeping the current password.')
+@click.option('--shard', 'shard_spec', type=str, default=None,
+              help='Only re-encrypt shard i of N, given as i/N, of the vault-enabled files, split the same way on '
+                   'every node. Backups and the old password files are kept until the merge command finds every '
+                   'shard finished.')
+@click.option('--scan-only', 'scan_only', default=False, is_flag=True,
+              help='Only list the vault-enabled files, their vault ids and secrets, without parsing '
+                   'anything that can be read from the text alone. Needs no password.')
+@click.option('--verify', 'verify', default=False, is_flag=True,
+              help='Check every rewritten file decrypts with the new password to what the original held before '
+                   'replacing anything. Backups are only removed once everything has verified.')
+@click.option('--reformat', 'reformat', default=False, is_flag=True,
+              help="Re-emit whole vars files rather than only rewriting their !vault blocks. Loses comments and formatting.")
+@click.option('--stats', 'stats', default=False, is_flag=True,
+              help='Log time spent and work done in each stage when finished.')
+@click.option('--metrics-file', 'metrics_file', type=str, default=None,
+              help='Write per-stage timings and counters to this file, in Prometheus format if it ends in .prom and JSON otherwise.')
+@click.option('--profile', 'profile', type=str, default=None,
+              help='Profile the run with cProfile and write the stats to this file.')
+def main(password_file, vault_ids, new_password_file_specs, varsfile, code_path, dry_run, keep_backups, no_backups,
+         backup_format, debug, jobs, include, exclude, max_size, gitignore, scan_threads, index_file, no_cache, resume, since,
+         git_diff, git_staged, shard_spec, scan_only, verify, reformat, stats, metrics_file, profile):
     """(Re)keys Ansible Vault repos."""
+    if click.get_current_context().invoked_subcommand:
+        return
     if debug:
         log_console.setLevel(logging.DEBUG)
 
+    METRICS.reset()
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    # reported on close so runs which bail out with sys.exit are still accounted for
+    click.get_current_context().call_on_close(lambda: report_metrics(stats, metrics_file, profiler, profile))
+
     if not os.path.isdir(code_path):
         log.error("{} doesn't seem to exist".format(code_path))
         sys.exit(1)
     code_path = os.path.realpath(code_path)
 
+    if jobs < 0:
+        log.error('--jobs must be 0 or more')
+        sys.exit(1)
+    jobs = jobs or os.cpu_count() or 1
+
+    if resume and since:
+        log.error('--resume and --since can not be used together')
+        sys.exit(1)
+    # only re-encrypting some files, under the password the rest are still using
+    changed_only = since or git_diff or git_staged
+    if (git_diff or git_staged) and sum(1 for i in (since, git_diff, git_staged, varsfile, resume) if i) > 1:
+        log.error('--git-diff and --staged can not be used together or with --since, --vars-file or --resume')
+        sys.exit(1)
+    if shard_spec:
+        if changed_only or varsfile:
+            log.error('--shard can not be used with --since, --git-diff, --staged or --vars-file')
+            sys.exit(1)
+        try:
+            shard_index, shard_count = shard.parse(shard_spec)
+        except ValueError as e:
+            log.error(str(e))
+            sys.exit(1)
+    elif new_password_file_specs:
+        log.error('--new-password-file is only used with --shard')
+        sys.exit(1)
+
+    def find_candidates():
+        if varsfile:
+            return [os.path.realpath(varsfile)]
+        if git_diff or git_staged:
+            try:
+                return rekey.find_changed_files(code_path, git_diff, git_staged, list(include), exclude, max_size)
+            except scanner.GitError as e:
+                log.error('Unable to list changed files: {}'.format(e))
+                sys.exit(1)
+        return rekey.find_files(code_path, list(include), exclude, max_size, gitignore, scan_threads)
+
+    if scan_only:
+        list_inventory(find_candidates(), scan_threads)
+        return
+
     backup_path = os.path.join(code_path, ".rekey-backups")
     log.debug('Backup path set to: {}'.format(backup_path))
+    manifest_path = os.path.join(backup_path, shard.name(shard_index, shard_count) if shard_spec else 'manifest.json')
+    journal_path = commit.journal_path(manifest_path)
+    if os.path.isfile(journal_path) and not dry_run and not resume:
+        log.error('A crash interrupted the last run while it replaced the original files. Rerun with --resume to '
+                  'finish it, or use the recover command with --rollback to undo it.')
+        sys.exit(1)
 
-    if not password_file:
-        password_file = os.path.join(code_path, 'vault-password.txt')
-    else:
-        if not os.path.isfile(password_file):
-            log.error("{} doesn't seem to exist".format(password_file))
-            sys.exit(1)
-        password_file = os.path.realpath(password_file)
+    password_files = get_password_files(code_path, password_file, vault_ids)
+    given_password_files = None
+    if shard_spec and not dry_run and not resume:
+        given_password_files = get_new_password_files(password_files, new_password_file_specs)
+
+    def keyring(files):
+        return files if vault_ids else files['default']
 
     # find all files
-    files = [os.path.realpath(varsfile)] if varsfile else rekey.find_files(code_path)
-
-    vault_files = []
-    for f in files:
-        with open(f, 'rb') as stream:
-            if is_encrypted_file(stream):
-                vault_files.append({'file': f})
-                continue
-
-            if b'$ANSIBLE_VAULT;1.1;AES256' in stream.read():
-                # inline secrets
-                try:
-                    data = rekey.parse_yaml(f)
-                except Exception as e:
-                    log.warning('Unable to parse file, probably not valid yaml: {} {}'.format(happy_relpath(f), e))
-                    continue
-
-                # enh, generator. w/e.
-                secrets = list(rekey.find_yaml_secrets(data)) if data else None
-                if secrets and len(secrets) > 0:
-                    vault_files.append({'file': f, 'secrets': secrets})
+    files = find_candidates()
+    shard_record = None
+    if shard_spec:
+        if resume and os.path.isfile(manifest_path):
+            # the files the shard was given, whatever state the repo is in now
+            shard_record = manifest.Manifest.load(manifest_path).shard
+            files = [os.path.join(code_path, f) for f in shard_record['files']]
+        else:
+            files, shard_record = shard.select(files, code_path, shard_index, shard_count, scan_threads)
 
-    vflog = []
-    for i in vault_files:
-        suffix = " (whole)" if 'secrets' not in i.keys() else ""
-        vflog.append("{}{}".format(happy_relpath(i['file']), suffix))
+    scan_index = None
+    # the index is pruned to the files seen, so it's only used when every file is
+    if not varsfile and not git_diff and not git_staged and not shard_spec and not no_cache:
+        scan_index = index.ScanIndex(index_file or index.default_index_path(code_path))
+    previous = manifest.Manifest.load(since) if since else None
 
-    log.info('Found {} vault-enabled files: {}'.format(len(vflog), ', '.join(vflog)))
+    backup_archive = None
+    if not no_backups and not resume:
+        log.info('Backing up password files...')
+        if backup_format == 'tree':
+            rekey.backup_files(list(password_files.values()), backup_path, code_path)
+        else:
+            backup_archive = archive.ArchiveWriter(backup_path, backup_format)
+            for path in password_files.values():
+                backup_archive.add(path, rekey.backup_name(path, code_path))
+
+    if not dry_run:
+        if resume:
+            if os.path.isfile(journal_path):
+                log.info('Finishing the interrupted commit...')
+                recover_commit(journal_path)
+            if not os.path.isfile(manifest_path):
+                log.error('Nothing to resume, no manifest found at {}'.format(happy_relpath(manifest_path)))
+                sys.exit(1)
+            m = manifest.Manifest.load(manifest_path)
+            if m.complete:
+                log.info('Nothing to resume, the last run completed.')
+                sys.exit(0)
+            new_password_files = m.new_password_files
+            for path in new_password_files.values():
+                if not os.path.isfile(path):
+                    log.error('Unable to resume, the staged password file {} is missing'.format(happy_relpath(path)))
+                    sys.exit(1)
+        elif changed_only:
+            new_password_files = OrderedDict(password_files)
+            m = manifest.Manifest(manifest_path, new_password_files)
+        elif shard_spec:
+            # every shard re-encrypts under the same given passwords, which the merge installs
+            new_password_files = given_password_files
+            m = manifest.Manifest(manifest_path, new_password_files, shard_record)
+        else:
+            # generate new password files, staged until every file has been re-encrypted
+            log.info('Generating new password files...')
+            new_password_files = OrderedDict()
+            for vid, path in password_files.items():
+                new_password_files[vid] = path + rekey.STAGED_SUFFIX
+                # a fresh file, so it's created 0600 rather than keeping a stale one's mode
+                if os.path.isfile(new_password_files[vid]):
+                    os.remove(new_password_files[vid])
+                rekey.write_password_file(new_password_files[vid])
+            m = manifest.Manifest(manifest_path, new_password_files)
+        staged_password_files = [p for p in new_password_files.values() if p.endswith(rekey.STAGED_SUFFIX)]
+
+    # every file flows through scan -> classify -> backup -> decrypt and re-encrypt into a temp
+    # file alongside the original, with each stage working on files as soon as the one before
+    # hands them over. originals are only replaced once every file has succeeded. only a slim
+    # record of each file outlives the crypt stage, its parsed data and ciphertext are let go
+    found, skipped, seen, tracked, staged, failures = [], [], set(), {}, [], []
+
+    def classify(path):
+        seen.add(path)
+        try:
+            vf = index.classify_file(path, scan_index)
+        except (yaml.YAMLError, UnicodeDecodeError) as e:
+            log.warning('Unable to parse file, probably not valid yaml: {} {}'.format(happy_relpath(path), e))
+            return None
+        except Exception as e:
+            # a file which can't be read might be a vault, the run fails rather than rekeying around it
+            failures.append(({'file': path}, e))
+            return None
+        if not vf:
+            return None
+        found.append((vf['file'], 'secrets' not in vf))
+        if vault_ids:
+            vf = rekey.select_vault_ids(vf, password_files)
+            if not vf:
+                skipped.append(path)
+                return None
+        vf['relpath'] = vf['file'][len(code_path) + 1:]
+        vf['staged'] = vf['file'] + rekey.STAGED_SUFFIX
+        if previous and previous.is_unchanged(vf['relpath'], vf['sha256']):
+            return None
+        return vf
 
-    log.info('Backing up encrypted and password files...')
-    # backup password file
-    rekey.backup_files([password_file], backup_path, code_path)
+    def track(vf):
+        tracked[vf['file']] = record_of(vf)
+        if dry_run:
+            return vf
+        m.track(vf['relpath'], vf['sha256'], rekey.file_vault_ids(vf))
+        if m.is_done(vf['relpath'], vf['sha256']):
+            log.debug('Already re-encrypted: {}'.format(happy_relpath(vf['file'])))
+            m.set_state(vf['relpath'], manifest.REENCRYPTED)
+        elif m.is_staged(vf['relpath'], vf['staged']) and not verify:
+            # with --verify these are rekeyed again, their original ciphertext is needed to check them
+            log.debug('Already staged: {}'.format(happy_relpath(vf['file'])))
+            staged.append(tracked[vf['file']])
+        else:
+            return vf
+        return None
+
+    def backup(vf):
+        if backup_archive:
+            backup_archive.add(vf['file'], rekey.backup_name(vf['file'], code_path))
+        else:
+            rekey.backup_file(vf['file'], backup_path, code_path)
+        return vf
 
-    # decrypt and write files out to unencbackup location (same relative paths)
-    for f in vault_files:
-        newpath = os.path.join(backup_path, f['file'][len(code_path) + 1:])
-        log.debug('Decrypting {} to {} using {}'.format(
-            happy_relpath(f['file']), happy_relpath(newpath), happy_relpath(password_file)))
-        rekey.decrypt_file(f['file'], password_file, newpath)
+    def record(result):
+        path, new_sha256, error = result
+        vf = tracked[path]
+        if error:
+            failures.append((vf, error))
+        elif not dry_run:
+            m.set_state(vf['relpath'], manifest.DECRYPTED, new_sha256)
+            staged.append(vf)
+            METRICS.incr('files_rekeyed')
+            if len(staged) % CHUNK_SIZE == 0:
+                m.save()
 
-    # generate new password file
-    log.info('Generating new password file...')
+    def dispatch(vf):
+        if crypto_pool is None:
+            return crypt(vf)
+        if len(vf.get('secrets', ())) >= rekey.SPLIT_SECRETS:
+            # one file's secrets spread across every process, rather than a single one working through them
+            return crypt(vf, executor=crypto_pool)
+        result, snapshot = crypto_pool.submit(call_with_metrics, crypt, (vf,)).result()
+        METRICS.merge(snapshot)
+        return result
+
+    io_pool = ThreadPoolExecutor(max_workers=2 * max(1, scan_threads) + 1)
+    # crypt calls wait on the process pool from these threads, so a file can be split up there
+    crypto_pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    dispatch_pool = ThreadPoolExecutor(max_workers=jobs * 2)
     if dry_run:
-        log.info('>> Dry run enabled, skipping overwrite. <<')
+        log.info('Decrypting vault files using {} job(s)...'.format(jobs))
+        crypt = functools.partial(rekey.decrypt_checked, keyring(password_files))
     else:
-        rekey.write_password_file(password_file, overwrite=True)
-        log.info('Password file written: {}'.format(happy_relpath(password_file)))
-
-    # loop through encrypted asset list, re-encrypt and overwrite originals
-    log.info('Re-encrypting assets with new password file...')
-    for f in vault_files:
-        # log.debug('Raw file obj: {}'.format(f))
-        oldpath = os.path.join(backup_path, happy_relpath(f['file']))
-        newpath = os.path.realpath(f['file'])
-        log.debug('Encrypting {} to {}'.format(happy_relpath(oldpath), happy_relpath(newpath)))
+        log.info('Re-encrypting vault files with new password files using {} job(s)...'.format(jobs))
+        crypt = functools.partial(rekey.rekey_staged, keyring(password_files), keyring(new_password_files),
+                                  not reformat, verify)
+    stages = [pipeline.Stage(classify, io_pool, scan_threads), pipeline.Stage(track)]
+    if not no_backups and not resume:
+        stages.append(pipeline.Stage(backup, io_pool, scan_threads))
+    stages += [pipeline.Stage(dispatch, dispatch_pool, jobs * 2), pipeline.Stage(record)]
+    try:
+        with METRICS.timer('decrypt' if dry_run else 'rekey'):
+            pipeline.run(files, stages, io_pool)
+    finally:
+        io_pool.shutdown()
+        dispatch_pool.shutdown()
+        if crypto_pool:
+            crypto_pool.shutdown()
+        if backup_archive:
+            backup_archive.close()
+            log.debug('Backups written: {}'.format(happy_relpath(backup_archive.path)))
+
+    if scan_index:
+        log.debug('Scan index: {} unchanged files skipped, {} read'.format(scan_index.hits, scan_index.misses))
+        scan_index.prune(seen)
+        scan_index.close()
+
+    vflog = []
+    for path, whole in sorted(found):
+        suffix = " (whole)" if whole else ""
+        vflog.append("{}{}".format(happy_relpath(path), suffix))
+    log.info('Found {} vault-enabled files: {}'.format(len(vflog), ', '.join(vflog)))
+    if skipped:
+        log.info('Skipped {} files with no secrets under vault ids {}: {}'.format(
+            len(skipped), ', '.join(password_files), ', '.join(happy_relpath(f) for f in sorted(skipped))))
+    if changed_only:
+        log.info('{} vault-enabled files changed {}'.format(len(tracked), 'since {}'.format(since) if since else (
+            'in {}'.format(git_diff) if git_diff else 'in the index')))
+
+    if failures:
+        failures.sort(key=lambda f: f[0]['file'])
+        report_failures('Decryption' if dry_run else 'Rekey', [f[0] for f in failures],
+                        [(None, f[1]) for f in failures])
         if dry_run:
-            log.info('>> Dry run enabled, skipping overwrite. <<')
-            r = True
-        else:
-            r = rekey.encrypt_file(oldpath, password_file, newpath, f.get('secrets', None))
-        if not r:
-            log.error('Encryption failed on {}'.format(oldpath))
+            sys.exit(1)
+        abort(m, list(tracked.values()), staged_password_files)
 
-    # test decryption of newly written assets?
+    if dry_run:
+        log.info('>> Dry run enabled, skipping overwrite. <<')
+    else:
+        m.save()
+        # every original, then the password files, replaced in one journaled step, see commit
+        state = manifest.VERIFIED if verify else manifest.REENCRYPTED
+        journal = commit.Journal(journal_path, manifest_path, state)
+        for f in sorted(staged, key=lambda f: f['file']):
+            journal.add(f['file'], f['staged'], m.files[f['relpath']]['new_sha256'], f['relpath'])
+        for new_password_file in staged_password_files:
+            journal.add(new_password_file[:-len(rekey.STAGED_SUFFIX)], new_password_file)
+        log.debug('Replacing {} files'.format(len(journal.entries)))
+        commit.commit(journal)
+        for entry in journal.entries:
+            if entry['relpath']:
+                m.set_state(entry['relpath'], state)
+            else:
+                log.info('Password file written: {}'.format(happy_relpath(entry['path'])))
+        m.complete = True
+        m.save()
+        commit.finish(journal)
+
+    KEY_CACHE.wipe()
+
+    if shard_spec and not dry_run:
+        log.info('Shard {}/{} finished, keeping backups and the old password files until every shard is merged.'.format(
+            shard_index, shard_count))
+        keep_backups = True
+
+    if verify and not dry_run:
+        unverified = sorted(p for p, entry in m.files.items() if entry['state'] != manifest.VERIFIED)
+        if unverified:
+            log.warning('Keeping backups, {} files were re-encrypted by an earlier run and could not be verified: {}'.format(
+                len(unverified), ', '.join(unverified)))
+            keep_backups = True
+        else:
+            log.info('Verified {} files.'.format(len(m.files)))
 
     # remove backups
-    if not keep_backups:
+    if not keep_backups and os.path.isdir(backup_path):
         log.info('Removing backups...')
         shutil.rmtree(backup_path)
 
     log.info('Done!')
 
 
+@main.command()
+@click.option('--code-path', '-r', 'code_path', default='.',
+              help='Path to Ansible code.')
+@click.option('--archive', 'archive_path', type=str, default=None,
+              help='Restore from this backup archive. Default: the newest backup of each file under .rekey-backups')
+@click.option('--target', 'target', type=str, default=None,
+              help='Write restored files under this directory rather than over the originals.')
+@click.option('--list', 'list_only', default=False, is_flag=True,
+              help='List the backed up files rather than restoring them.')
+@click.argument('paths', nargs=-1)
+def restore(code_path, archive_path, target, list_only, paths):
+    """Restores files from the backups of an earlier run. PATHS are relative to the code path,
+    every backed up file is restored if none are given."""
+    code_path = os.path.realpath(code_path)
+    backup_path = os.path.join(code_path, '.rekey-backups')
+    if archive_path:
+        if not os.path.isfile(archive_path + archive.INDEX_SUFFIX):
+            log.error('{} is not a backup archive with an index'.format(archive_path))
+            sys.exit(1)
+        archives = [archive_path]
+    else:
+        archives = archive.find_archives(backup_path)
+
+    # backup name -> (archive, index entry), or the copy of the file for tree backups
+    if archives:
+        backups = archive.latest_entries(archives)
+    else:
+        backups = OrderedDict()
+        for path in sorted(rekey.find_files(backup_path, '*')):
+            name = path[len(backup_path) + 1:]
+            if not manifest.is_bookkeeping(name):
+                backups[name] = path
+    if list_only:
+        for name in backups:
+            click.echo(name)
+        return
+
+    names = [rekey.backup_name(os.path.join(code_path, p), code_path) for p in paths] or list(backups)
+    missing = [name for name in names if name not in backups]
+    if missing:
+        log.error('No backup of {}'.format(', '.join(missing)))
+        sys.exit(1)
+    if not names:
+        log.error('Nothing to restore, no backups found under {}'.format(happy_relpath(backup_path)))
+        sys.exit(1)
+
+    destination = os.path.realpath(target) if target else code_path
+    if archives:
+        for name in names:
+            archive.extract(backups[name][0], backups[name][1], os.path.join(destination, name))
+    else:
+        rekey.restore_files([backups[name] for name in names], destination, backup_path)
+    for name in names:
+        log.debug('Restored {}'.format(name))
+    log.info('Restored {} files to {}'.format(len(names), happy_relpath(destination)))
+
+
+@main.command()
+@click.option('--code-path', '-r', 'code_path', default='.',
+              help='Path to Ansible code.')
+@click.option('--password-file', '-p', 'password_file', default=None,
+              type=str, help='Path to password file. Default: vault-password.txt')
+@click.option('--vault-id', 'vault_ids', multiple=True,
+              help='A vault id the shards rekeyed, given as ID@PASSWORD_FILE. Can be repeated.')
+@click.option('--new-password-file', 'new_password_file_specs', multiple=True,
+              help='The new password file the shards were given, as [ID@]PASSWORD_FILE for each vault id.')
+@click.option('--keep-backups', '-k', 'keep_backups', default=False, is_flag=True,
+              help='Keep the backups and shard manifests after a successful merge.')
+@click.argument('manifests', nargs=-1)
+def merge(code_path, password_file, vault_ids, new_password_file_specs, keep_backups, manifests):
+    """Finishes a rekey run as shards with --shard. Checks that every shard finished and that every
+    file holds what its shard re-encrypted it to, then installs the new password files and removes
+    the backups. MANIFESTS are the shard manifests, every one under .rekey-backups by default."""
+    code_path = os.path.realpath(code_path)
+    backup_path = os.path.join(code_path, '.rekey-backups')
+    password_files = get_password_files(code_path, password_file, vault_ids)
+    new_password_files = get_new_password_files(password_files, new_password_file_specs)
+    if not manifests and os.path.isdir(backup_path):
+        manifests = [os.path.join(backup_path, n) for n in sorted(os.listdir(backup_path))
+                     if n.startswith('shard-') and n.endswith('.json')]
+    shards = [manifest.Manifest.load(path) for path in manifests]
+
+    problems = shard.check(shards, code_path)
+    if not problems:
+        # every file already holds its shard's output, one file a shard is enough to show it used these passwords
+        keyring = new_password_files if vault_ids else new_password_files['default']
+        for m in shards:
+            for relpath in sorted(m.files)[:1]:
+                vf = rekey.classify_file(os.path.join(code_path, relpath))
+                error = rekey.decrypt_checked(keyring, vf)[2] if vf else None
+                if error:
+                    problems.append('Shard {}/{} did not re-encrypt {} with the given new password files: {}'.format(
+                        m.shard['index'], m.shard['count'], relpath, error))
+    if problems:
+        for problem in problems:
+            log.error(problem)
+        log.error('Not merging, {} problems found. Backups and the old password files are untouched.'.format(len(problems)))
+        sys.exit(1)
+
+    merged = shard.merged(shards, os.path.join(backup_path, 'manifest.json'), password_files)
+    journal = commit.Journal(commit.journal_path(merged.path))
+    for vid, path in password_files.items():
+        if os.path.realpath(new_password_files[vid]) != os.path.realpath(path):
+            shutil.copyfile(new_password_files[vid], path + rekey.STAGED_SUFFIX)
+            journal.add(path, path + rekey.STAGED_SUFFIX)
+    commit.commit(journal)
+    for path in password_files.values():
+        log.info('Password file written: {}'.format(happy_relpath(path)))
+    merged.save()
+    commit.finish(journal)
+    log.info('Merged {} shards, {} files re-encrypted.'.format(len(shards), len(merged.files)))
+
+    if not keep_backups and os.path.isdir(backup_path):
+        log.info('Removing backups...')
+        shutil.rmtree(backup_path)
+    log.info('Done!')
+
+
+@main.command()
+@click.option('--code-path', '-r', 'code_path', default='.',
+              help='Path to Ansible code.')
+@click.option('--rollback', 'rollback', default=False, is_flag=True,
+              help='Put back every original file and the old password files rather than finishing the commit.')
+def recover(code_path, rollback):
+    """Finishes or undoes a crashed run's commit. Replaces the rest of the original files, as
+    --resume does, or with --rollback puts back every original and the old password files."""
+    backup_path = os.path.join(os.path.realpath(code_path), '.rekey-backups')
+    journals = commit.find_journals(backup_path)
+    if not journals:
+        log.info('Nothing to recover, no interrupted commit found under {}'.format(happy_relpath(backup_path)))
+        return
+    for path in journals:
+        recover_commit(path, rollback)
+    log.info(('Rolled back {} interrupted commits.' if rollback else 'Finished {} interrupted commits.').format(len(journals)))
+
+
+def recover_commit(journal_path, rollback=False):
+    """Rolls the commit in a journal forward, or back, and brings its manifest up to date. A
+        rolled back run's manifest is removed, along with its staged files."""
+    journal = commit.Journal.load(journal_path)
+    problems = commit.roll_back(journal) if rollback else commit.roll_forward(journal)
+    if problems:
+        for problem in problems:
+            log.error(problem)
+        log.error('Unable to recover, nothing was changed. The journal is at {}'.format(happy_relpath(journal_path)))
+        sys.exit(1)
+    if journal.manifest_path and os.path.isfile(journal.manifest_path):
+        if rollback:
+            os.remove(journal.manifest_path)
+        else:
+            m = manifest.Manifest.load(journal.manifest_path)
+            for entry in journal.entries:
+                if entry['relpath'] in m.files:
+                    m.set_state(entry['relpath'], journal.manifest_state)
+            m.complete = True
+            m.save()
+    commit.finish(journal)
+
+
+def get_password_files(code_path, password_file, vault_ids):
+    """Returns vault id -> password file from the --password-file and --vault-id options. The
+        default password file only joins --vault-id ids if it's given or exists, without any it's
+        used for every secret whatever its vault id, as before."""
+    password_files = OrderedDict()
+    if password_file:
+        if not os.path.isfile(password_file):
+            log.error("{} doesn't seem to exist".format(password_file))
+            sys.exit(1)
+        password_files['default'] = os.path.realpath(password_file)
+    elif not vault_ids or os.path.isfile(os.path.join(code_path, 'vault-password.txt')):
+        password_files['default'] = os.path.join(code_path, 'vault-password.txt')
+    for spec in vault_ids:
+        vid, _, path = spec.rpartition('@')
+        if not os.path.isfile(path):
+            log.error("{} doesn't seem to exist".format(path))
+            sys.exit(1)
+        password_files[vid or 'default'] = os.path.realpath(path)
+    return password_files
+
+
+def get_new_password_files(password_files, specs):
+    """Returns vault id -> new password file from --new-password-file options, one for every
+        vault id in password_files."""
+    new_password_files = OrderedDict()
+    for spec in specs:
+        vid, _, path = spec.rpartition('@')
+        if not os.path.isfile(path):
+            log.error("{} doesn't seem to exist".format(path))
+            sys.exit(1)
+        new_password_files[vid or 'default'] = os.path.realpath(path)
+    missing = [vid for vid in password_files if vid not in new_password_files]
+    if missing or len(new_password_files) != len(password_files):
+        log.error('--new-password-file has to be given once for each vault id being rekeyed: {}'.format(
+            ', '.join(password_files)))
+        sys.exit(1)
+    return OrderedDict((vid, new_password_files[vid]) for vid in password_files)
+
+
+def list_inventory(files, threads):
+    """--scan-only: echoes every vault-enabled file, the vault ids it uses and the address of
+        each inline secret, one file per line."""
+    def inventory(path):
+        try:
+            return rekey.inventory_file(path)
+        except Exception as e:
+            log.warning('Unable to parse file, probably not valid yaml: {} {}'.format(happy_relpath(path), e))
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        entries = sorted((i for i in pool.map(inventory, files) if i), key=lambda i: i['file'])
+    for i in entries:
+        if 'secrets' in i:
+            secrets = ', '.join('.'.join(str(k) for k in address) for address in i['secrets'])
+        else:
+            secrets = '(whole)'
+        click.echo('{}: {} [{}]'.format(happy_relpath(i['file']), secrets, i['vault_ids']))
+    log.info('Found {} vault-enabled files, {} inline secrets.'.format(
+        len(entries), sum(len(i.get('secrets', ())) for i in entries)))
+
+
+def abort(m, vault_files, new_password_files=()):
+    """Bails out of a failed rekey. If no original has been replaced yet, the staged files and
+        manifest are cleaned up, otherwise they're left for a later --resume."""
+    if any(entry['state'] in manifest.DONE for entry in m.files.values()):
+        log.error('Aborting. Some files are already re-encrypted, fix the errors above and rerun with --resume.')
+        sys.exit(1)
+
+    for path in [f['staged'] for f in vault_files] + list(new_password_files) + [m.path]:
+        if path and os.path.isfile(path):
+            os.remove(path)
+    log.error('Aborting, no original files have been modified.')
+    sys.exit(1)
+
+
+def report_metrics(stats, metrics_file, profiler=None, profile_path=None):
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+        log.info('Profile written: {}'.format(happy_relpath(profile_path)))
+    if stats:
+        for line in METRICS.summary():
+            log.info(line)
+    if metrics_file:
+        METRICS.write(metrics_file)
+        log.debug('Metrics written: {}'.format(happy_relpath(metrics_file)))
+
+
+def record_of(vault_file):
+    """The parts of a vault_files entry needed once it's been re-encrypted, see main."""
+    return dict((k, vault_file[k]) for k in ('file', 'relpath', 'staged', 'sha256'))
+
+
+def report_failures(action, vault_files, results):
+    """Logs every file which failed `action`. Returns True if nothing failed."""
+    failed = 0
+    for f, (_, error) in zip(vault_files, results):
+        if error:
+            failed += 1
+            log.error('{} failed on {}: {}'.format(action, happy_relpath(f['file']), error))
+    if failed:
+        log.error('{} failed on {} of {} files.'.format(action, failed, len(vault_files)))
+    return failed == 0
+
+
 def happy_relpath(path):
     return path.replace(os.getcwd(), '.')
 
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""Replaces the originals with their staged, re-encrypted copies as one all-or-nothing step.
+
+Every staged file is flushed to disk in one batch, then a journal listing each replacement is
+written and flushed, and only then are the originals swapped out in a tight loop of renames,
+password files last. Each original gets a hard link alongside it just before its rename, so
+after a crash the journal can roll the commit forward, renaming the rest, or back, putting
+every original back, until the commit is marked finished."""
+
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import json
+import logging
+import os
+import shutil
+
+from ansible_vault_rekey import manifest
+from ansible_vault_rekey.metrics import METRICS
+
+log = logging.getLogger()
+
+OLD_SUFFIX = '.rekey-old'
+JOURNAL_SUFFIX = '.journal'
+
+PREPARED = 'prepared'       # everything staged and flushed, originals may be partly replaced
+COMMITTED = 'committed'     # every original replaced, only the old links are left to remove
+
+# concurrent fsyncs, enough for the filesystem to fold them into a few journal commits
+FSYNC_THREADS = 16
+
+
+def journal_path(manifest_path):
+    return os.path.splitext(manifest_path)[0] + JOURNAL_SUFFIX
+
+
+def find_journals(backup_path):
+    if not os.path.isdir(backup_path):
+        return []
+    return sorted(os.path.join(backup_path, n) for n in os.listdir(backup_path) if n.endswith(JOURNAL_SUFFIX))
+
+
+def fsync_file(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(path):
+    """Flushes a directory's entries, so renames in it survive a crash. Skipped where directories
+        can't be opened or flushed."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        if e.errno not in (errno.EINVAL, errno.EBADF):
+            raise
+    finally:
+        os.close(fd)
+
+
+@METRICS.timed('fsync')
+def fsync_all(paths, dirs=False, threads=FSYNC_THREADS):
+    """Flushes every file, or directory, in paths at once rather than one after another, so the
+        filesystem can fold them into a few journal commits, or NFS COMMITs."""
+    paths = list(paths)
+    with ThreadPoolExecutor(max_workers=max(1, min(threads, len(paths)))) as pool:
+        list(pool.map(fsync_dir if dirs else fsync_file, paths))
+    METRICS.incr('dirs_fsynced' if dirs else 'files_fsynced', len(paths))
+
+
+class Journal:
+    """JSON record of one commit, flushed to disk before any original is replaced.
+        {
+          "state": "prepared",
+          "manifest": "/repo/.rekey-backups/manifest.json",
+          "manifest_state": "re-encrypted",
+          "entries": [
+            {"path": "/repo/group_vars/all.yml", "staged": "/repo/group_vars/all.yml.rekey-tmp",
+             "sha256": "<hash of the staged file>", "relpath": "group_vars/all.yml", "existed": true},
+            {"path": "/repo/vault-password.txt", "staged": "/repo/vault-password.txt.rekey-tmp",
+             "sha256": "<hash of the staged file>", "relpath": null, "existed": true}
+          ]
+        }
+    Entries are replaced in order. manifest_state is what each entry with a relpath is set to in
+    the manifest once the commit is done.
+    """
+
+    def __init__(self, path, manifest_path=None, manifest_state=manifest.REENCRYPTED):
+        self.path = path
+        self.manifest_path = manifest_path
+        self.manifest_state = manifest_state
+        self.state = None
+        self.entries = []
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            data = json.load(f)
+        j = Journal(path, data.get('manifest'), data.get('manifest_state'))
+        j.state = data['state']
+        j.entries = data['entries']
+        return j
+
+    def add(self, path, staged, sha256=None, relpath=None):
+        """Adds a replacement of path with staged, hashing staged unless its sha256 is given."""
+        self.entries.append({'path': path, 'staged': staged, 'sha256': sha256 or manifest.file_sha256(staged),
+                             'relpath': relpath, 'existed': os.path.isfile(path)})
+
+    def save(self, state):
+        self.state = state
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        tmp = '{}.tmp'.format(self.path)
+        with open(tmp, 'w') as f:
+            json.dump({'state': self.state, 'manifest': self.manifest_path, 'manifest_state': self.manifest_state,
+                       'entries': self.entries}, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        fsync_dir(os.path.dirname(self.path))
+
+    def dirs(self):
+        return sorted(set(os.path.dirname(e['path']) for e in self.entries))
+
+
+def replace(entry):
+    """Links the original aside, for a rollback, then renames the staged file over it."""
+    path, old = entry['path'], entry['path'] + OLD_SUFFIX
+    if os.path.isfile(path):
+        if not os.path.exists(old):
+            try:
+                os.link(path, old)
+            except OSError:
+                # no hard links on this filesystem
+                shutil.copy2(path, old)
+        shutil.copymode(path, entry['staged'])
+    os.replace(entry['staged'], path)
+
+
+@METRICS.timed('commit')
+def commit(journal, threads=FSYNC_THREADS):
+    """Replaces every entry in journal, see the module docstring. Leaves the journal COMMITTED,
+        call finish once whatever records the commit, like the manifest, has been saved."""
+    fsync_all([e['staged'] for e in journal.entries], threads=threads)
+    journal.save(PREPARED)
+    for entry in journal.entries:
+        replace(entry)
+    fsync_all(journal.dirs(), dirs=True, threads=threads)
+    journal.save(COMMITTED)
+
+
+def finish(journal):
+    """Removes the old originals' links and the journal, after which there's no rolling back."""
+    for entry in journal.entries:
+        if os.path.exists(entry['path'] + OLD_SUFFIX):
+            os.remove(entry['path'] + OLD_SUFFIX)
+    os.remove(journal.path)
+    fsync_dir(os.path.dirname(journal.path))
+
+
+def roll_forward(journal):
+    """Finishes an interrupted commit, renaming every staged file which is still there over its
+        original. Returns every reason it can't, without renaming anything. Empty if it's done."""
+    problems = []
+    for entry in journal.entries:
+        if os.path.isfile(entry['staged']):
+            if manifest.file_sha256(entry['staged']) != entry['sha256']:
+                problems.append('{} has changed since it was staged'.format(entry['staged']))
+        elif not os.path.isfile(entry['path']) or manifest.file_sha256(entry['path']) != entry['sha256']:
+            problems.append('{} is missing and {} does not hold it'.format(entry['staged'], entry['path']))
+    if problems:
+        return problems
+    for entry in journal.entries:
+        if os.path.isfile(entry['staged']):
+            replace(entry)
+    fsync_all(journal.dirs(), dirs=True)
+    journal.save(COMMITTED)
+    return []
+
+
+def roll_back(journal):
+    """Undoes an interrupted commit, putting back every original which was replaced and removing
+        the staged files. Returns every reason it can't, without touching anything. Empty if it's
+        done."""
+    if journal.state == COMMITTED:
+        return ['The commit in {} finished, it can only be rolled forward'.format(journal.path)]
+    for entry in reversed(journal.entries):
+        path, old = entry['path'], entry['path'] + OLD_SUFFIX
+        if os.path.exists(old):
+            os.replace(old, path)
+            if os.path.exists(old):
+                # not replaced yet, the link and the original are the same file and rename left both
+                os.remove(old)
+        elif not entry['existed'] and not os.path.isfile(entry['staged']) and os.path.isfile(path):
+            os.remove(path)
+        if os.path.isfile(entry['staged']):
+            os.remove(entry['staged'])
+    fsync_all(journal.dirs(), dirs=True)
+    return []
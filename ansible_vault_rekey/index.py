@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""On-disk cache of file classifications so repeat scans only reopen files that changed."""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from ansible_vault_rekey import __version__
+from ansible_vault_rekey import ansible_vault_rekey as rekey
+
+log = logging.getLogger()
+
+NONE = 'none'
+WHOLE = 'whole'
+INLINE = 'inline'
+
+# files modified this recently might still be changing within the filesystem's timestamp
+# granularity, so they're never trusted to the index
+RACY_SECONDS = 2
+
+# bumped whenever the files table changes shape, which drops and recreates it
+SCHEMA = 2
+
+
+def default_index_path(code_path):
+    """Per-repo index under $XDG_CACHE_HOME, kept out of the repo itself."""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    name = hashlib.sha256(os.path.realpath(code_path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_home, 'ansible-vault-rekey', '{}.sqlite'.format(name))
+
+
+def fingerprint(st):
+    return [st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino]
+
+
+class ScanIndex:
+    """SQLite table of path -> (stat fingerprint, classification). An entry is only used while
+    the file's size, mtime, ctime and inode all still match. Only files classified as holding no
+    vault data are skipped on a hit, vault files are always read again, as the rekey needs their
+    contents anyway. The whole index is dropped whenever the tool version, its schema or the vault
+    marker it classified against changes. Safe to share between threads."""
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        stamp = '{} {} {}'.format(__version__, SCHEMA, rekey.VAULT_MARKER.decode('utf-8'))
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'stamp'").fetchone()
+        if not row or row[0] != stamp:
+            self.db.execute('DROP TABLE IF EXISTS files')
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('stamp', ?)", (stamp,))
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, fingerprint TEXT, kind TEXT)')
+        self.hits = self.misses = 0
+
+    def lookup(self, path, st):
+        """Returns the file's kind if path is indexed and unchanged, otherwise None."""
+        with self.lock:
+            row = self.db.execute('SELECT fingerprint, kind FROM files WHERE path = ?', (path,)).fetchone()
+            if not row or json.loads(row[0]) != fingerprint(st):
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row[1]
+
+    def store(self, path, st, kind):
+        if time.time() - st.st_mtime < RACY_SECONDS:
+            return
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (path, json.dumps(fingerprint(st)), kind))
+
+    def prune(self, seen):
+        """Drops entries for every path not in seen, ie. files which have gone away."""
+        gone = [(p,) for (p,) in self.db.execute('SELECT path FROM files') if p not in seen]
+        self.db.executemany('DELETE FROM files WHERE path = ?', gone)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def classify_file(path, index=None):
+    """rekey.classify_file, skipping the read entirely for files the index already knows hold no
+        vault data."""
+    if index is None:
+        return rekey.classify_file(path)
+    st = os.stat(path)
+    if index.lookup(path, st) == NONE:
+        return None
+    vf = rekey.classify_file(path)
+    if vf is None:
+        index.store(path, st, NONE)
+    elif 'secrets' not in vf:
+        # whole-file vaults, held in memory or left on disk to be streamed
+        index.store(path, st, WHOLE)
+    else:
+        index.store(path, st, INLINE)
+    return vf
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+"""Tracks the progress of a rekey run so an interrupted run can pick up where it left off."""
+
+import fnmatch
+import hashlib
+import json
+import os
+
+PENDING = 'pending'
+DECRYPTED = 'decrypted'         # decrypted and re-encrypted into a staged temp file
+REENCRYPTED = 're-encrypted'    # original replaced with the staged file
+VERIFIED = 'verified'
+
+DONE = (REENCRYPTED, VERIFIED)
+
+# what a run keeps at the top of the backup path for itself: manifests, shard manifests, commit
+# journals and the temp files they're saved through
+BOOKKEEPING = ('manifest.json', 'shard-*-of-*.json', '*.journal', '*.tmp')
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_bookkeeping(name):
+    """True if name, relative to the backup path, is one of a run's own files rather than a
+        backup."""
+    return os.sep not in name and any(fnmatch.fnmatch(name, pattern) for pattern in BOOKKEEPING)
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """JSON record of every vault file in a run, kept under the backup directory. Paths are
+    stored relative to the code path so a manifest still applies to a fresh checkout.
+        {
+          "new_password_files": {"default": "/repo/vault-password.txt.rekey-tmp"},
+          "complete": false,
+          "shard": null,
+          "files": {
+            "group_vars/all.yml": {
+              "sha256": "<hash of the original ciphertext>",
+              "key_id": "default",
+              "state": "decrypted",
+              "new_sha256": "<hash of the re-encrypted file>"
+            }
+          }
+        }
+    A sharded run's manifest only covers its own shard, and records which one that is:
+        "shard": {"index": 2, "count": 4, "partition": "<shard.fingerprint>", "files": [...]}
+    """
+
+    def __init__(self, path, new_password_files=None, shard=None):
+        self.path = path
+        self.new_password_files = new_password_files or {}
+        self.complete = False
+        self.shard = shard
+        self.files = {}
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            data = json.load(f)
+        m = Manifest(path, data.get('new_password_files'))
+        if 'new_password_file' in data:
+            # written before vault ids were supported
+            m.new_password_files = {'default': data['new_password_file']}
+        m.complete = data.get('complete', False)
+        m.shard = data.get('shard')
+        m.files = data.get('files', {})
+        return m
+
+    def save(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        tmp = '{}.tmp'.format(self.path)
+        with open(tmp, 'w') as f:
+            json.dump({'new_password_files': self.new_password_files, 'complete': self.complete,
+                       'shard': self.shard, 'files': self.files}, f, indent=2, sort_keys=True)
+            # a resume trusts what this says was staged or replaced, so it has to reach the disk first
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def track(self, relpath, sha256, key_id):
+        """Adds a file to the manifest as pending, unless it's already there."""
+        if relpath not in self.files:
+            self.files[relpath] = {'sha256': sha256, 'key_id': key_id, 'state': PENDING, 'new_sha256': None}
+        return self.files[relpath]
+
+    def set_state(self, relpath, state, new_sha256=None):
+        self.files[relpath]['state'] = state
+        if new_sha256:
+            self.files[relpath]['new_sha256'] = new_sha256
+
+    def is_done(self, relpath, sha256):
+        """True if the file on disk is the re-encrypted version this manifest produced."""
+        entry = self.files.get(relpath)
+        return bool(entry) and entry['new_sha256'] == sha256 and entry['state'] in (DECRYPTED,) + DONE
+
+    def is_staged(self, relpath, staged_path):
+        """True if a staged temp file from an interrupted run is still intact."""
+        entry = self.files.get(relpath)
+        return bool(entry) and entry['state'] == DECRYPTED and os.path.isfile(staged_path) and \
+            file_sha256(staged_path) == entry['new_sha256']
+
+    def is_unchanged(self, relpath, sha256):
+        """True if the file is exactly as this manifest last saw it."""
+        entry = self.files.get(relpath)
+        return bool(entry) and sha256 == (entry['new_sha256'] or entry['sha256'])
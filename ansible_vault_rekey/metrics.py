@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""Counters and timers for the stages of a rekey run."""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import functools
+import json
+import threading
+import time
+
+
+class Metrics:
+    """Named counters plus named timers, each timer tracking a call count and total seconds.
+    Safe to update from scanner threads. Pool workers collect their own and hand a snapshot
+    back with each result, which the parent merges in."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = OrderedDict()
+        self.timers = OrderedDict()
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name, seconds, calls=1):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """Decorator version of timer."""
+        def wrap(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return wrap
+
+    def snapshot(self):
+        with self.lock:
+            return {'counters': dict(self.counters), 'timers': dict((k, list(v)) for k, v in self.timers.items())}
+
+    def merge(self, snapshot):
+        for name, value in snapshot['counters'].items():
+            self.incr(name, value)
+        for name, (calls, seconds) in snapshot['timers'].items():
+            self.add_time(name, seconds, calls)
+
+    def summary(self):
+        """Returns the metrics as a list of lines making up a table."""
+        lines = ['{:<24} {:>10} {:>12}'.format('timer', 'calls', 'seconds')]
+        for name, (calls, seconds) in self.timers.items():
+            lines.append('{:<24} {:>10} {:>12.3f}'.format(name, calls, seconds))
+        lines.append('{:<24} {:>10}'.format('counter', 'value'))
+        for name, value in self.counters.items():
+            lines.append('{:<24} {:>10}'.format(name, value))
+        return lines
+
+    def to_prometheus(self, prefix='ansible_vault_rekey'):
+        """Renders the metrics in the Prometheus text format, for node_exporter's textfile collector."""
+        lines = []
+        for name, value in self.counters.items():
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+            lines.append('{}_{}_total {}'.format(prefix, name, value))
+        if self.timers:
+            lines.append('# TYPE {}_stage_seconds_total counter'.format(prefix))
+            for name, (_, seconds) in self.timers.items():
+                lines.append('{}_stage_seconds_total{{stage="{}"}} {:.6f}'.format(prefix, name, seconds))
+            lines.append('# TYPE {}_stage_calls_total counter'.format(prefix))
+            for name, (calls, _) in self.timers.items():
+                lines.append('{}_stage_calls_total{{stage="{}"}} {}'.format(prefix, name, calls))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Writes the metrics to path, in the Prometheus text format if it ends in .prom and as
+            JSON otherwise."""
+        with open(path, 'w') as f:
+            if path.endswith('.prom'):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.snapshot(), f, indent=2)
+
+
+METRICS = Metrics()
+
+
+def call_with_metrics(func, task):
+    """Runs func(*task) in a pool worker and returns its result along with the metrics it
+        recorded, so the parent process can account for work done in its workers."""
+    METRICS.reset()
+    return func(*task), METRICS.snapshot()
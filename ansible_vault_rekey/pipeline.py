@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""Runs the per-file stages of a rekey concurrently, so reading and writing one file overlaps
+with the crypto on another instead of every stage waiting for the last to finish everything."""
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import functools
+
+from ansible_vault_rekey.metrics import METRICS, call_with_metrics
+
+# items allowed to wait between two stages before the earlier stage is held back
+QUEUE_SIZE = 64
+
+_END = object()
+
+
+class Stage:
+    """One step of a pipeline: func(item) called on up to `workers` items at a time. Blocking
+    funcs go to executor, a thread or process pool, funcs run without one must be quick as they
+    run on the event loop itself. Whatever func returns is passed on to the next stage, None
+    drops the item."""
+
+    def __init__(self, func, executor=None, workers=1):
+        self.func = func
+        self.executor = executor
+        self.workers = max(1, workers)
+
+    async def call(self, loop, item):
+        if self.executor is None:
+            return self.func(item)
+        if isinstance(self.executor, ProcessPoolExecutor):
+            # pool workers hand their metrics back with each result
+            result, snapshot = await loop.run_in_executor(
+                self.executor, functools.partial(call_with_metrics, self.func, (item,)))
+            METRICS.merge(snapshot)
+            return result
+        return await loop.run_in_executor(self.executor, self.func, item)
+
+
+async def _feed(loop, source, executor, queue, consumers):
+    # the source may block, eg. a directory scan, so it's advanced from the executor too
+    it = iter(source)
+    while True:
+        item = await loop.run_in_executor(executor, next, it, _END)
+        if item is _END:
+            break
+        await queue.put(item)
+    for _ in range(consumers):
+        await queue.put(_END)
+
+
+async def _work(loop, stage, inbox, outbox):
+    while True:
+        item = await inbox.get()
+        if item is _END:
+            break
+        result = await stage.call(loop, item)
+        if result is not None:
+            await outbox.put(result)
+
+
+async def _close(loop, workers, outbox, consumers):
+    await asyncio.gather(*workers)
+    for _ in range(consumers):
+        await outbox.put(_END)
+
+
+async def _pipeline(loop, source, stages, executor, queue_size):
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    tasks = [asyncio.ensure_future(_feed(loop, source, executor, queues[0], stages[0].workers))]
+    for i, stage in enumerate(stages):
+        workers = [asyncio.ensure_future(_work(loop, stage, queues[i], queues[i + 1])) for _ in range(stage.workers)]
+        closer = _close(loop, workers, queues[i + 1], stages[i + 1].workers if i + 1 < len(stages) else 1)
+        tasks += workers + [asyncio.ensure_future(closer)]
+
+    results = []
+
+    async def collect():
+        while True:
+            item = await queues[-1].get()
+            if item is _END:
+                break
+            results.append(item)
+
+    tasks.append(asyncio.ensure_future(collect()))
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # a stage raised, the rest would wait on it forever
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return results
+
+
+def run(source, stages, executor, queue_size=QUEUE_SIZE):
+    """Feeds every item of source, an iterable which may block, through stages in turn and
+        returns what comes out of the last one, in the order it finished. Each stage works on
+        items as soon as the one before hands them over, and the bounded queues between them
+        stop a fast stage from racing ahead and piling up work in memory. So the whole run
+        takes about as long as its slowest stage rather than the sum of them. executor is the
+        thread pool the source is advanced in. Stage funcs are expected to return their errors
+        rather than raise them, anything raised stops the whole pipeline and is raised here."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_pipeline(loop, source, stages, executor, queue_size))
+    finally:
+        loop.close()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+"""Walks a repository looking for candidate files, pruning excluded and ignored trees early."""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import fnmatch
+import logging
+import os
+import subprocess
+
+from ansible_vault_rekey.metrics import METRICS
+
+log = logging.getLogger()
+
+
+def matches(name, patterns):
+    for pattern in patterns:
+        if fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+
+class GitIgnore:
+    """The .gitignore rules in effect for a directory. Covers the common subset of the format:
+    comments, negation with '!', directory-only patterns ending in '/', patterns anchored to
+    their .gitignore's directory when they contain a '/', and leading '**/'."""
+
+    def __init__(self, rules=None):
+        self.rules = rules or []
+
+    def extend(self, dirpath):
+        """Returns the rules for dirpath: these plus any from dirpath/.gitignore."""
+        try:
+            with open(os.path.join(dirpath, '.gitignore')) as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError):
+            return self
+
+        rules = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            line = line[1:] if negate else line
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            if line.startswith('**/'):
+                line = line[3:]
+            anchored = '/' in line
+            rules.append((dirpath, line.lstrip('/'), negate, dir_only, anchored))
+        return GitIgnore(self.rules + rules) if rules else self
+
+    def ignored(self, path, is_dir=False):
+        result = False
+        for base, pattern, negate, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            target = os.path.relpath(path, base) if anchored else os.path.basename(path)
+            if fnmatch.fnmatch(target, pattern):
+                result = not negate
+        return result
+
+
+@METRICS.timed('scan')
+def scan_dir(dirpath, include, exclude, max_size, gitignore):
+    """Lists a single directory. Returns the matching files and the subdirectories (with the
+        .gitignore rules that apply in them) still worth descending into."""
+    if gitignore is not None:
+        gitignore = gitignore.extend(dirpath)
+    files, dirs = [], []
+    try:
+        with os.scandir(dirpath) as it:
+            entries = list(it)
+    except OSError as e:
+        log.warning('Unable to scan {}: {}'.format(dirpath, e))
+        return files, dirs
+
+    for entry in entries:
+        if matches(entry.name, exclude):
+            continue
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                if gitignore is None or not gitignore.ignored(entry.path, True):
+                    dirs.append((entry.path, gitignore))
+                continue
+            if not entry.is_file() or not matches(entry.name, include):
+                continue
+            if gitignore is not None and gitignore.ignored(entry.path):
+                continue
+            if max_size is not None and entry.stat().st_size > max_size:
+                continue
+        except OSError:
+            continue
+        files.append(os.path.realpath(entry.path))
+    METRICS.incr('dirs_scanned')
+    METRICS.incr('files_found', len(files))
+    return files, dirs
+
+
+def scan_files(path, include=('*',), exclude=(), max_size=None, gitignore=False, threads=4):
+    """Generator which yields the real path of every file under path whose name matches one of
+        the include globs. Files and directories matching an exclude glob, files over max_size
+        bytes and, when gitignore is set, anything a .gitignore ignores are skipped without
+        being descended into or opened. Directories are listed across `threads` threads and
+        paths are yielded as soon as their directory has been listed, so callers can start on
+        them before the walk finishes. The order is not stable with more than one thread."""
+    root = (os.path.realpath(path), GitIgnore() if gitignore else None)
+    args = (list(include), list(exclude), max_size)
+    if threads <= 1:
+        stack = [root]
+        while stack:
+            dirpath, rules = stack.pop()
+            files, dirs = scan_dir(dirpath, *(args + (rules,)))
+            stack.extend(reversed(dirs))
+            for f in files:
+                yield f
+        return
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = set([pool.submit(scan_dir, root[0], *(args + (root[1],)))])
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                for dirpath, rules in dirs:
+                    pending.add(pool.submit(scan_dir, dirpath, *(args + (rules,))))
+                for f in files:
+                    yield f
+
+
+class GitError(Exception):
+    pass
+
+
+def git(cwd, *args):
+    """Runs a git command in cwd and returns its output, raising GitError if it fails."""
+    try:
+        result = subprocess.run(['git', '-C', cwd] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise GitError('Unable to run git: {}'.format(e))
+    if result.returncode != 0:
+        raise GitError(result.stderr.decode('utf-8', 'replace').strip())
+    return result.stdout
+
+
+@METRICS.timed('scan')
+def git_changed_files(path, rev_range=None, staged=False, include=('*',), exclude=(), max_size=None):
+    """Lists the real path of every file under path which the commits in rev_range, or with
+        staged the index, added or modified, without walking the tree. Renamed and copied files
+        are listed under their new path and deleted ones not at all. include, exclude and
+        max_size filter them the same as in scan_files, exclude matching any part of the path
+        since there's no walk to prune excluded directories. Raises GitError if git fails."""
+    root = os.path.realpath(path)
+    args = ['diff', '--name-status', '-z', '--find-renames', '--relative', '--diff-filter=ACMRTU']
+    args += ['--cached'] if staged else [rev_range]
+    fields = [os.fsdecode(f) for f in git(root, *args).split(b'\0') if f]
+
+    files, i = [], 0
+    while i < len(fields):
+        status = fields[i]
+        # renames and copies give the old path and then the new one
+        i += 3 if status[0] in 'RC' else 2
+        relpath = fields[i - 1]
+        parts = relpath.split('/')
+        if any(matches(part, exclude) for part in parts) or not matches(parts[-1], include):
+            continue
+        full = os.path.join(root, relpath)
+        try:
+            st = os.stat(full)
+        except OSError:
+            continue  # deleted since, or only in the index
+        if max_size is not None and st.st_size > max_size:
+            continue
+        files.append(os.path.realpath(full))
+    METRICS.incr('files_found', len(files))
+    return files
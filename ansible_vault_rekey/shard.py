@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""Splits a repo's vault files between the nodes of a sharded rekey.
+
+Every node lists the whole repo and works out the same partition from it, so the nodes never
+need to talk to each other. Files are weighed by the work rekeying them takes: a key derivation
+per inline secret, or one for a whole-file vault plus its size in MiB. Each is then handed,
+heaviest first, to whichever shard has the least work so far. Ties go by the hash of the path,
+so the result only depends on which files there are and what's in them."""
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+
+from ansible_vault_rekey import ansible_vault_rekey as rekey
+from ansible_vault_rekey import manifest
+
+log = logging.getLogger()
+
+MIB = 1024 * 1024
+
+
+def parse(spec):
+    """Parses an `i/N` shard spec into (i, N), counting shards from 1. Raises ValueError."""
+    index, sep, count = spec.partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ValueError('Shards are given as i/N, eg. 2/4, not {}'.format(spec))
+    if not sep or count < 1 or not 1 <= index <= count:
+        raise ValueError('Shards are given as i/N with 1 <= i <= N, not {}'.format(spec))
+    return index, count
+
+
+def weigh(path):
+    """Returns the work rekeying a file takes, or None if it holds no vault data. Files which
+        can't be read as YAML weigh 1, whichever shard gets them reports the error."""
+    try:
+        entry = rekey.inventory_file(path)
+    except Exception:
+        return 1
+    if not entry:
+        return None
+    if 'secrets' in entry:
+        return len(entry['secrets'])
+    return 1 + os.path.getsize(path) // MIB
+
+
+def weigh_files(files, code_path, threads=4):
+    """Returns {path relative to code_path: weight} for every vault-enabled file in files."""
+    files = list(files)
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        weights = list(pool.map(weigh, files))
+    return dict((f[len(code_path) + 1:], w) for f, w in zip(files, weights) if w is not None)
+
+
+def partition(weights, count):
+    """Splits {relpath: weight} into `count` lists of relpaths, balancing the total weight of
+        each."""
+    shards = [[] for _ in range(count)]
+    loads = [0] * count
+
+    def order(item):
+        return -item[1], hashlib.sha256(item[0].encode('utf-8')).hexdigest()
+
+    for relpath, weight in sorted(weights.items(), key=order):
+        lightest = min(range(count), key=lambda i: (loads[i], i))
+        shards[lightest].append(relpath)
+        loads[lightest] += weight
+    return shards
+
+
+def fingerprint(weights, count):
+    """Identifies a partition, so shards can be checked to have split the same set of files."""
+    data = json.dumps([count, sorted(weights.items())], separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def select(files, code_path, index, count, threads=4):
+    """Returns the paths in files which belong to shard `index` of `count`, and the shard's
+        record for its manifest."""
+    weights = weigh_files(files, code_path, threads)
+    mine = partition(weights, count)[index - 1]
+    log.info('Shard {}/{}: {} of {} vault-enabled files, weighing {} of {}'.format(
+        index, count, len(mine), len(weights), sum(weights[f] for f in mine), sum(weights.values())))
+    record = {'index': index, 'count': count, 'partition': fingerprint(weights, count), 'files': sorted(mine)}
+    return [os.path.join(code_path, f) for f in sorted(mine)], record
+
+
+def name(index, count):
+    return 'shard-{}-of-{}.json'.format(index, count)
+
+
+def check(manifests, code_path):
+    """Returns every reason the shard manifests don't add up to one finished rekey of the whole
+        repo: shards missing, unfinished or splitting different sets of files, and files which
+        don't hold what their shard re-encrypted them to. Empty if there are none."""
+    problems = ['{} is not a shard manifest'.format(m.path) for m in manifests if not m.shard]
+    shards = [m for m in manifests if m.shard]
+    if not shards:
+        return problems + ['No shard manifests found']
+    if len(set((m.shard['count'], m.shard['partition']) for m in shards)) > 1:
+        return problems + ['The shards split different sets of files, they were not all run on the same checkout']
+
+    count = shards[0].shard['count']
+    runs = Counter(m.shard['index'] for m in shards)
+    problems += ['Shard {}/{} is missing'.format(i, count) for i in range(1, count + 1) if not runs[i]]
+    problems += ['Shard {}/{} was given more than once'.format(i, count) for i in sorted(runs) if runs[i] > 1]
+    for m in sorted(shards, key=lambda m: m.shard['index']):
+        label = '{}/{}'.format(m.shard['index'], count)
+        if not m.complete:
+            problems.append('Shard {} did not finish, rerun it with --resume'.format(label))
+            continue
+        for relpath, entry in sorted(m.files.items()):
+            path = os.path.join(code_path, relpath)
+            if entry['state'] not in manifest.DONE:
+                problems.append('{} is {} in shard {}'.format(relpath, entry['state'], label))
+            elif not os.path.isfile(path) or manifest.file_sha256(path) != entry['new_sha256']:
+                problems.append('{} does not hold what shard {} re-encrypted it to'.format(relpath, label))
+    return problems
+
+
+def merged(manifests, path, new_password_files):
+    """Returns one complete manifest covering every file in the shard manifests, as an unsharded
+        run would have written it."""
+    m = manifest.Manifest(path, new_password_files)
+    for shard_manifest in manifests:
+        m.files.update(shard_manifest.files)
+    m.complete = True
+    return m
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+"""Chunked decryption and re-encryption of whole-file vaults, for files too big to comfortably
+hold in memory several times over.
+
+A vault file is a header line followed by the hex encoding, wrapped at 80 columns, of
+
+    hex(salt) \\n hex(hmac) \\n hex(ciphertext)
+
+where the ciphertext is the PKCS7 padded plaintext under AES-256-CTR and the HMAC is SHA256 over
+the raw ciphertext. Every layer of that can be undone or applied a chunk at a time, so memory use
+depends on the chunk size rather than the file size. The only thing which can't be streamed is
+the HMAC, which comes before the ciphertext it covers: a placeholder is written in its place and
+filled in once the last chunk is through."""
+
+from binascii import hexlify, unhexlify
+import os
+
+from ansible_vault_rekey.metrics import METRICS
+from ansible_vault_rekey.vaultstring import KEY_CACHE
+
+HEADER = b'$ANSIBLE_VAULT;1.1;AES256'
+WIDTH = 80
+CHUNK_SIZE = 1024 * 1024
+SALT_SIZE = 32
+
+
+class HexDecoder:
+    """Incrementally unhexlifies a stream, skipping whitespace and carrying an odd trailing
+    digit over to the next chunk."""
+
+    def __init__(self):
+        self.carry = b''
+
+    def update(self, chunk):
+        chunk = self.carry + b''.join(chunk.split())
+        cut = len(chunk) - len(chunk) % 2
+        self.carry = chunk[cut:]
+        return unhexlify(chunk[:cut])
+
+    def finalize(self):
+        if self.carry:
+            raise ValueError('Vault data has an odd number of hex digits')
+        return b''
+
+
+class VaultReader:
+    """Reads a vault file's salt and HMAC up front, then yields its raw ciphertext in chunks."""
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        header = f.readline().strip().split(b';')
+        if header[0] != b'$ANSIBLE_VAULT' or len(header) < 3:
+            raise ValueError('Not a vault file')
+        if header[2] != b'AES256':
+            raise ValueError('Unsupported vault cipher {}'.format(header[2].decode('utf-8')))
+
+        self.outer = HexDecoder()
+        fields = b''
+        while fields.count(b'\n') < 2:
+            chunk = f.read(self.chunk_size)
+            if not chunk:
+                raise ValueError('Vault data ends before the ciphertext')
+            fields += self.outer.update(chunk)
+        b_salt, self.b_hmac, self.rest = fields.split(b'\n', 2)
+        self.b_salt = unhexlify(b_salt)
+
+    def chunks(self):
+        inner = HexDecoder()
+        yield inner.update(self.rest)
+        for chunk in iter(lambda: self.f.read(self.chunk_size), b''):
+            yield inner.update(self.outer.update(chunk))
+        self.outer.finalize()
+        inner.finalize()
+
+
+class VaultWriter:
+    """Writes a vault file a chunk of ciphertext at a time, hex encoded and wrapped the same way
+    Ansible does. f has to be seekable, the HMAC is filled in over a placeholder at the end."""
+
+    def __init__(self, f, b_salt, vault_id=None):
+        self.f = f
+        if vault_id and vault_id != 'default':
+            f.write(b';'.join([b'$ANSIBLE_VAULT', b'1.2', b'AES256', vault_id.encode('utf-8')]) + b'\n')
+        else:
+            f.write(HEADER + b'\n')
+        self.start = f.tell()
+        self.written = 0  # outer hex digits so far, not counting line breaks
+        self.write(hexlify(b_salt) + b'\n')
+        self.hmac_at = self.written
+        self.write(b'0' * 64 + b'\n')
+
+    def write(self, b_inner):
+        b_outer = hexlify(b_inner)
+        first = min(len(b_outer), (WIDTH - self.written % WIDTH) % WIDTH)
+        lines = [b_outer[:first]] if first else []
+        lines += [b_outer[i:i + WIDTH] for i in range(first, len(b_outer), WIDTH)]
+        self.written += len(b_outer)
+        self.f.write(b'\n'.join(lines) + (b'\n' if self.written % WIDTH == 0 and lines else b''))
+
+    def finalize(self, b_hmac):
+        if self.written % WIDTH:
+            self.f.write(b'\n')
+        b_outer, position = hexlify(hexlify(b_hmac)), self.hmac_at
+        while b_outer:
+            take = WIDTH - position % WIDTH
+            self.f.seek(self.start + position + position // WIDTH)
+            self.f.write(b_outer[:take])
+            position += len(b_outer[:take])
+            b_outer = b_outer[take:]
+        self.f.seek(0, os.SEEK_END)
+
+
+def plaintext_chunks(src, password, chunk_size=CHUNK_SIZE):
+    """Generator which decrypts the vault file open in src a chunk at a time. The HMAC can only
+        be checked once everything has been read, so nothing yielded can be trusted until the
+        generator finishes without raising ValueError."""
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives.hmac import HMAC
+
+    reader = VaultReader(src, chunk_size)
+    b_key1, b_key2, b_iv = KEY_CACHE.derive(password.encode('utf-8'), reader.b_salt)
+    hmac = HMAC(b_key2, hashes.SHA256(), default_backend())
+    decryptor = Cipher(algorithms.AES(b_key1), modes.CTR(b_iv), default_backend()).decryptor()
+    unpadder = padding.PKCS7(128).unpadder()
+    for chunk in reader.chunks():
+        hmac.update(chunk)
+        yield unpadder.update(decryptor.update(chunk))
+    try:
+        hmac.verify(unhexlify(reader.b_hmac))
+    except InvalidSignature:
+        raise ValueError('HMAC verification failed, wrong password or corrupt vault')
+    yield unpadder.update(decryptor.finalize()) + unpadder.finalize()
+
+
+@METRICS.timed('stream_decrypt')
+def decrypt(src, dst, password, chunk_size=CHUNK_SIZE):
+    """Decrypts the vault file open in src into dst, which may be None to only check that it
+        decrypts. Returns the size of the plaintext."""
+    size = 0
+    for chunk in plaintext_chunks(src, password, chunk_size):
+        size += len(chunk)
+        if dst is not None:
+            dst.write(chunk)
+    METRICS.incr('streamed_bytes', size)
+    return size
+
+
+@METRICS.timed('stream_rekey')
+def rekey(src, dst, password, new_password, chunk_size=CHUNK_SIZE, vault_id=None):
+    """Re-encrypts the vault file open in src under new_password into dst, which has to be
+        seekable, with a 1.2 header naming vault_id unless it's None or 'default'. Plaintext
+        only ever exists a chunk at a time, in memory. Returns the size of the plaintext."""
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives.hmac import HMAC
+
+    b_salt = os.urandom(SALT_SIZE)
+    b_key1, b_key2, b_iv = KEY_CACHE.derive(new_password.encode('utf-8'), b_salt)
+    hmac = HMAC(b_key2, hashes.SHA256(), default_backend())
+    encryptor = Cipher(algorithms.AES(b_key1), modes.CTR(b_iv), default_backend()).encryptor()
+    padder = padding.PKCS7(128).padder()
+    writer = VaultWriter(dst, b_salt, vault_id)
+
+    def emit(b_ciphertext):
+        hmac.update(b_ciphertext)
+        writer.write(hexlify(b_ciphertext))
+
+    size = 0
+    for chunk in plaintext_chunks(src, password, chunk_size):
+        size += len(chunk)
+        emit(encryptor.update(padder.update(chunk)))
+    emit(encryptor.update(padder.finalize()) + encryptor.finalize())
+    writer.finalize(hmac.finalize())
+    METRICS.incr('streamed_bytes', size)
+    return size
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+"""Finds the `!vault |` blocks in a vars file, and the key paths they sit under, straight from
+its text by indentation, without parsing it as YAML.
+
+Covers the block style Ansible writes and people keep their vars in: nested block mappings and
+sequences, comments, quoted keys and scalars, and other block scalars. Anything it can't be sure
+it reads the same way a YAML parser would, such as flow collections or trailing comments
+mentioning !vault, anchors and aliases, merge keys, duplicate keys, tab indentation or several
+documents, makes it give up so callers can fall back to a full parse."""
+
+import re
+
+import yaml
+
+from ansible_vault_rekey.vaultstring import VaultString
+
+TAG = VaultString.yaml_tag
+
+PLAIN_KEY = r'''[^\s#'"{}\[\],&*!|>%@`?:<-](?:[^\s:]|:(?=\S)|[ \t]+(?=[^\s:#]))*'''
+KEY = re.compile(r'''(?P<key>"[^"\\]*"|'(?:[^']|'')*'|''' + PLAIN_KEY + r''')[ \t]*:(?:[ \t]+|$)''')
+BLOCK = re.compile(r'[|>][-+0-9]*(?:[ \t]+#.*)?$')
+SIMPLE_KEY = re.compile(r'[A-Za-z_][\w.-]*$')
+# plain keys YAML 1.1 might resolve to something other than a string, left to the parser
+WORDS = set(['yes', 'no', 'true', 'false', 'on', 'off', 'null'])
+# block scalar bodies by indentation, matched in one go rather than a line at a time
+BODIES = {}
+
+
+class Ambiguous(Exception):
+    pass
+
+
+def find_vault_blocks(text):
+    """Returns [(address, (start, end), vault id), ...] for every !vault block in text, in
+        document order. Addresses and spans are the same a full parse would give, ie. what
+        find_yaml_node_secrets and node marks give. Returns None if text holds anything the
+        scan can't be sure about."""
+    if TAG not in text:
+        return []
+    try:
+        return list(_scan(text))
+    except Ambiguous:
+        return None
+
+
+def _scan(text):
+    if text.startswith(u'\ufeff') or '\r' in text.replace('\r\n', ''):
+        raise Ambiguous()
+
+    stack = []            # [indent, key or sequence index, is sequence, indent of children, keys under it]
+    root_keys = set()
+    block = None          # (parent indent, content indent) while inside a block scalar
+    continuation = None   # parent indent while inside a multi-line plain or flow scalar
+    quote = None          # quote character while inside a multi-line quoted scalar
+    vault = None          # (address, start offset) of the !vault block being read
+    vault_id = None
+    started = False
+    pos, size = 0, len(text)
+
+    while pos <= size:
+        end = text.find('\n', pos)
+        end = size if end == -1 else end
+        start, pos, line = pos, end + 1, text[pos:end].rstrip('\r')
+        content = line.lstrip(' ')
+        indent = len(line) - len(content)
+        blank = not content.strip()
+
+        if quote is not None:
+            end = _closing_quote(line, quote)
+            if end != -1:
+                _check_trailing(line[end:])
+                quote = None
+            continue
+
+        if block is not None:
+            parent, inner = block
+            if blank:
+                continue
+            if inner is None and indent > parent:
+                block = parent, indent
+                if vault is not None:
+                    vault_id = _vault_id(content)
+                pos = _body(indent).match(text, min(pos, size)).end()
+                continue
+            if inner is not None and indent >= inner:
+                continue
+            if indent > parent:
+                raise Ambiguous()
+            block = None
+            if vault is not None:
+                if vault_id is None:
+                    raise Ambiguous()
+                yield vault[0], (vault[1], start), vault_id
+                vault = vault_id = None
+
+        if blank or content.startswith('#'):
+            continue
+        if content.startswith('\t'):
+            raise Ambiguous()
+        if continuation is not None:
+            if indent > continuation:
+                if TAG in content:
+                    raise Ambiguous()
+                continue
+            continuation = None
+
+        if indent == 0 and content[:3] in ('---', '...') or content.startswith('%'):
+            if content[:3] == '---' and not started and content[3:].strip()[:1] in ('', '#'):
+                continue
+            raise Ambiguous()
+        started = True
+
+        column, rest, parent = indent, content, None
+        # sequence items, possibly several on one line, then at most one mapping key
+        while rest[:1] == '-' and rest[1:2] in ('', ' '):
+            while stack and stack[-1][0] > column:
+                stack.pop()
+            if stack and stack[-1][0] == column and stack[-1][2]:
+                stack[-1][1] += 1
+                stack[-1][4] = set()
+            else:
+                _check_child(stack, column)
+                stack.append([column, 0, True, None, set()])
+            parent = column
+            after = rest[1:].lstrip(' ')
+            column, rest = column + len(rest) - len(after), after
+        match = KEY.match(rest)
+        if match:
+            while stack and stack[-1][0] >= column:
+                stack.pop()
+            _check_child(stack, column)
+            key = _key(match.group('key'))
+            siblings = stack[-1][4] if stack else root_keys
+            try:
+                if key in siblings:
+                    raise Ambiguous()
+                siblings.add(key)
+            except TypeError:
+                raise Ambiguous()
+            stack.append([column, key, False, None, set()])
+            parent = column
+            rest = rest[match.end():]
+        elif parent is None:
+            raise Ambiguous()
+        if TAG in line[:len(line) - len(rest)]:
+            raise Ambiguous()
+
+        value = rest.strip()
+        if not value or value.startswith('#'):
+            _check_trailing(value)
+        elif value.startswith(TAG):
+            after = value[len(TAG):]
+            if after[:1] != ' ' or not after.strip().startswith('|') or not BLOCK.match(after.strip()):
+                raise Ambiguous()
+            vault = tuple(entry[1] for entry in stack), start + len(line) - len(rest) + rest.index(TAG)
+            block = parent, None
+        elif value[0] in '&*':
+            raise Ambiguous()
+        elif value[0] in '"\'':
+            end = _closing_quote(value[1:], value[0])
+            if end == -1:
+                quote = value[0]
+            else:
+                _check_trailing(value[1 + end:])
+        else:
+            if TAG in value:
+                raise Ambiguous()
+            if value[0] == '!':
+                value = value.partition(' ')[2].strip()
+            if value[:1] in ('|', '>') and BLOCK.match(value):
+                block = parent, None
+            else:
+                continuation = parent
+
+    if quote is not None:
+        raise Ambiguous()
+    if vault is not None:
+        if vault_id is None:
+            raise Ambiguous()
+        yield vault[0], (vault[1], len(text)), vault_id
+
+
+def _body(indent):
+    if indent not in BODIES:
+        BODIES[indent] = re.compile(r'(?:(?: {%d}[^\n]*| *\r?)(?:\n|\Z))*' % indent)
+    return BODIES[indent]
+
+
+def _key(token):
+    if token[0] == '"':
+        return token[1:-1]
+    if token[0] == "'":
+        return token[1:-1].replace("''", "'")
+    if SIMPLE_KEY.match(token) and token.lower() not in WORDS:
+        return token
+    # numbers, dates, booleans and the like resolve to whatever the parser would make of them
+    return yaml.safe_load(token)
+
+
+def _check_child(stack, column):
+    """Children of a mapping key all have to line up, one that doesn't is a parse error."""
+    if stack and not stack[-1][2]:
+        if stack[-1][3] is None:
+            stack[-1][3] = column
+        elif stack[-1][3] != column:
+            raise Ambiguous()
+
+
+def _closing_quote(text, quote):
+    """Returns the index just past the quote which closes the scalar text is inside, or -1."""
+    i = 0
+    while True:
+        i = text.find(quote, i)
+        if i == -1:
+            return -1
+        if quote == "'" and text[i + 1:i + 2] == "'":
+            i += 2
+        elif quote == '"' and (len(text[:i]) - len(text[:i].rstrip('\\'))) % 2:
+            i += 1
+        else:
+            return i + 1
+
+
+def _check_trailing(text):
+    """Only a comment may follow a scalar, and one mentioning !vault isn't worth the risk."""
+    text = text.strip()
+    if text and not text.startswith('#') or TAG in text:
+        raise Ambiguous()
+
+
+def _vault_id(line):
+    header = line.strip().split(';')
+    if header[0] != '$ANSIBLE_VAULT':
+        raise Ambiguous()
+    return header[3] if len(header) > 3 else 'default'
@@ -1,36 +1,177 @@
-from ansible.constants import DEFAULT_VAULT_ID_MATCH
-from ansible.parsing.vault import VaultLib
-from ansible.parsing.vault import VaultSecret
+from binascii import hexlify, unhexlify
+from collections import OrderedDict
+import atexit
+import os
+
+from ansible_vault_rekey.metrics import METRICS
+
+
+def ansible_vault():
+    """Returns ansible.parsing.vault, imported on first use. It loads Ansible's whole config on
+        the way, which costs more than the rest of startup put together, so nothing which doesn't
+        touch a secret (--help, --scan-only, a run with nothing to do) should pay for it."""
+    from ansible.parsing import vault
+    return vault
+
+
+class KeyCache:
+    """Bounded LRU cache of the expensive bits of vault crypto: VaultLib objects per password and
+    PBKDF2 derived keys per (password, salt). Ansible derives a fresh key for every value it
+    touches, so any ciphertext seen twice in a run (duplicated secrets, verifying our own output)
+    costs a derivation each time without this.
+
+    Encryption always uses a fresh random salt. The salt also seeds the AES-CTR counter, so
+    sharing one between secrets would reuse the keystream and leak plaintext."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.vaults = OrderedDict()
+        self.keys = OrderedDict()
+
+    def _lookup(self, cache, key, factory):
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        value = cache[key] = factory()
+        while len(cache) > self.maxsize:
+            cache.popitem(last=False)
+        return value
+
+    def vault(self, password):
+        def factory():
+            from ansible.constants import DEFAULT_VAULT_ID_MATCH
+            vault = ansible_vault()
+            return vault.VaultLib([(DEFAULT_VAULT_ID_MATCH, vault.VaultSecret(password.encode('utf-8')))])
+        return self._lookup(self.vaults, password, factory)
+
+    def derive(self, b_password, b_salt):
+        """Returns (key1, key2, iv) for a password/salt pair, the same as VaultAES256 would."""
+        def factory():
+            with METRICS.timer('key_derivation'):
+                b_derivedkey = ansible_vault().VaultAES256._create_key_cryptography(b_password, b_salt, 32, 16)
+            return b_derivedkey[:32], b_derivedkey[32:64], b_derivedkey[64:80]
+        if (b_password, b_salt) in self.keys:
+            METRICS.incr('key_cache_hits')
+        return self._lookup(self.keys, (b_password, b_salt), factory)
+
+    @METRICS.timed('encrypt')
+    def encrypt(self, plaintext, password, vault_id=None):
+        """Encrypts plaintext the same as VaultLib would, with a 1.2 header naming vault_id unless
+            it's None or 'default'."""
+        b_plaintext = plaintext if isinstance(plaintext, bytes) else str(plaintext).encode('utf-8')
+        b_salt = os.urandom(32)
+        b_key1, b_key2, b_iv = self.derive(password.encode('utf-8'), b_salt)
+        vault = ansible_vault()
+        b_hmac, b_ciphertext = vault.VaultAES256._encrypt_cryptography(b_plaintext, b_key1, b_key2, b_iv)
+        b_vaulttext = hexlify(b'\n'.join([hexlify(b_salt), b_hmac, b_ciphertext]))
+        return vault.format_vaulttext_envelope(b_vaulttext, 'AES256', vault_id=vault_id)
+
+    @METRICS.timed('decrypt')
+    def decrypt(self, vaulttext, password):
+        b_vaulttext = vaulttext if isinstance(vaulttext, bytes) else vaulttext.encode('utf-8')
+        vault = ansible_vault()
+        b_vaulttext, _, cipher_name, _ = vault.parse_vaulttext_envelope(b_vaulttext)
+        if cipher_name != 'AES256':
+            return self.vault(password).decrypt(vaulttext)
+        b_ciphertext, b_salt, b_crypted_hmac = vault.parse_vaulttext(b_vaulttext)
+        b_key1, b_key2, b_iv = self.derive(password.encode('utf-8'), b_salt)
+        return vault.VaultAES256._decrypt_cryptography(b_ciphertext, b_crypted_hmac, b_key1, b_key2, b_iv)
+
+    def wipe(self):
+        self.vaults.clear()
+        self.keys.clear()
+
+
+KEY_CACHE = KeyCache()
+atexit.register(KEY_CACHE.wipe)
+
+
+# headers are the same for every secret under a vault id, one copy of each is shared
+HEADERS = {}
+WIDTH = 80
+SALT_SIZE = 32
+HMAC_SIZE = 32
+
+
+def pack(b_vaulttext):
+    """Returns (header, salt + hmac + ciphertext) for a vault blob laid out the way Ansible writes
+        them, the raw bytes its text is a hex of a hex of, so about a quarter of its size. Returns
+        None for anything which wouldn't come back exactly the same from unpack."""
+    header, _, body = b_vaulttext.partition(b'\n')
+    try:
+        b_salt, b_hmac, b_ciphertext = unhexlify(body.replace(b'\n', b'')).split(b'\n')
+        payload = unhexlify(b_salt) + unhexlify(b_hmac) + unhexlify(b_ciphertext)
+    except ValueError:
+        return None
+    if len(b_salt) != 2 * SALT_SIZE or len(b_hmac) != 2 * HMAC_SIZE:
+        return None
+    header = HEADERS.setdefault(header, header)
+    return (header, payload) if unpack(header, payload) == b_vaulttext else None
+
+
+def unpack(header, payload):
+    """The vault blob text, without a trailing newline, for a pack result."""
+    hmac_end = SALT_SIZE + HMAC_SIZE
+    inner = b'\n'.join([hexlify(payload[:SALT_SIZE]), hexlify(payload[SALT_SIZE:hmac_end]), hexlify(payload[hmac_end:])])
+    outer = hexlify(inner)
+    return b'\n'.join([header] + [outer[i:i + WIDTH] for i in range(0, len(outer), WIDTH)])
 
 
 # Ansible Vault uses custom YAML tags to ID encrypted strings
 # adapted from https://stackoverflow.com/a/43060743/596204
 class VaultString:
+    """A !vault scalar. Inventories can hold tens of thousands, so they're kept small: slots
+    rather than a __dict__, and the ciphertext held as pack's raw bytes whenever it's in
+    Ansible's layout, as the text's bytes otherwise. Plaintext is never kept, decrypt hands it
+    back and rekey only holds it for the length of the call. VaultLibs and derived keys are
+    shared between every instance through KEY_CACHE."""
+    __slots__ = ('_header', '_payload')
     yaml_tag = u'!vault'
 
     def __repr__(self):
         return 'VaultString({:.25}...)'.format(self.ciphertext)
 
     def __init__(self, ciphertext):
-        self.plaintext = None
-        self.ciphertext = ciphertext.strip() if isinstance(ciphertext, str) else ciphertext
+        self.ciphertext = ciphertext
+
+    @property
+    def ciphertext(self):
+        if self._header is None:
+            return None if self._payload is None else self._payload.decode('utf-8')
+        return unpack(self._header, self._payload).decode('utf-8')
+
+    @ciphertext.setter
+    def ciphertext(self, ciphertext):
+        self._header, self._payload = None, None
+        if ciphertext is not None:
+            b_ciphertext = (ciphertext.encode('utf-8') if isinstance(ciphertext, str) else ciphertext).strip()
+            self._header, self._payload = pack(b_ciphertext) or (None, b_ciphertext)
+
+    @property
+    def header(self):
+        """The vault header line, without rebuilding the rest of the text."""
+        if self._header is not None:
+            return self._header
+        return None if self._payload is None else self._payload.split(b'\n', 1)[0]
 
     @staticmethod
     def encrypt(plaintext, password):
-        vs = VaultString(None)
-        vs.plaintext = str(plaintext).strip()
-        vs.vault = vs.get_vault(password)
-        vs.ciphertext = vs.vault.encrypt(plaintext).decode('utf-8')
-        return vs
+        return VaultString(KEY_CACHE.encrypt(plaintext, password))
 
     def decrypt(self, password):
-        v = self.get_vault(password)
-        self.plaintext = v.decrypt(self.ciphertext)
-        return self.plaintext
+        """Returns the plaintext, which isn't kept."""
+        return KEY_CACHE.decrypt(self.ciphertext, password)
+
+    def rekey(self, password, new_password):
+        """Re-encrypts in place under new_password, keeping the vault id."""
+        fields = self.header.split(b';')
+        vault_id = fields[3].decode('utf-8') if len(fields) > 3 else None
+        self.ciphertext = KEY_CACHE.encrypt(self.decrypt(password), new_password, vault_id)
+        return self
 
     @staticmethod
     def get_vault(password):
-        return VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(password.encode('utf-8')))])
+        return KEY_CACHE.vault(password)
 
     # for ruamel.yaml
     @staticmethod
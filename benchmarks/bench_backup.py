@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks backing up a repo's vault files the way the backup stage does, from a few threads
+at a time: a mirrored tree of copies, one per file, against a single tar archive, plain and
+gzipped. Reports the time, files and bytes each leaves behind, and the time to restore one
+file from it.
+
+    $ python -m benchmarks.bench_backup [vars files] [threads]
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from ansible_vault_rekey import ansible_vault_rekey as rekey
+from ansible_vault_rekey import archive
+
+from benchmarks.harness import generate_repo
+
+
+def disk_usage(path):
+    files, size = 0, 0
+    for root, _, names in os.walk(path):
+        files += len(names)
+        size += sum(os.path.getsize(os.path.join(root, n)) for n in names)
+    return files, size
+
+
+def main(files=2000, threads=4):
+    workdir = tempfile.mkdtemp(prefix='bench-backup-')
+    try:
+        repo = os.path.join(workdir, 'repo')
+        generate_repo(repo, files=files, secrets=5, depth=3, plain_files=0)
+        paths = [p for p in rekey.find_files(repo) if rekey.classify_file(p)]
+        print('{} vault files, {} bytes'.format(len(paths), sum(os.path.getsize(p) for p in paths)))
+        print('{:<8} {:>10} {:>8} {:>12} {:>12}'.format('format', 'backup', 'files', 'bytes', 'restore 1'))
+        for backup_format in ['tree'] + list(archive.FORMATS):
+            backup_path = os.path.join(workdir, 'backups-' + backup_format)
+            start = time.perf_counter()
+            if backup_format == 'tree':
+                with ThreadPoolExecutor(max_workers=threads) as pool:
+                    list(pool.map(lambda p: rekey.backup_file(p, backup_path, repo), paths))
+            else:
+                writer = archive.ArchiveWriter(backup_path, backup_format)
+                with ThreadPoolExecutor(max_workers=threads) as pool:
+                    list(pool.map(lambda p: writer.add(p, rekey.backup_name(p, repo)), paths))
+                writer.close()
+            backup_time = time.perf_counter() - start
+
+            name = rekey.backup_name(paths[len(paths) // 2], repo)
+            target = os.path.join(workdir, 'restored-' + backup_format)
+            start = time.perf_counter()
+            if backup_format == 'tree':
+                rekey.restore_files([os.path.join(backup_path, name)], target, backup_path)
+            else:
+                archive_path, entry = archive.latest_entries(archive.find_archives(backup_path))[name]
+                archive.extract(archive_path, entry, os.path.join(target, name))
+            restore_time = time.perf_counter() - start
+            print('{:<8} {:>9.3f}s {:>8} {:>12} {:>10.2f}ms'.format(
+                backup_format, backup_time, *disk_usage(backup_path), restore_time * 1000))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
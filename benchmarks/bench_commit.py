@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks replacing a repo's worth of files with their re-encrypted versions: overwriting
+each in place, as encrypt_file and write_yaml do, making each durable before the next with an
+fsync of the file and its directory, and the commit engine, flushing every staged file in one
+batch and then renaming them all under a journal. Point it at the volume to measure with
+--dir, a tmpfs makes every fsync free.
+
+    $ python -m benchmarks.bench_commit [--files N] [--size BYTES] [--dirs N] [--dir PATH]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from ansible_vault_rekey import ansible_vault_rekey as rekey
+from ansible_vault_rekey import commit
+from ansible_vault_rekey import manifest
+
+
+def make_files(root, files, size, dirs):
+    paths = []
+    for i in range(files):
+        directory = os.path.join(root, 'dir{}'.format(i % dirs))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        paths.append(os.path.join(directory, 'vars{}.yml'.format(i)))
+        with open(paths[-1], 'wb') as f:
+            f.write(os.urandom(size))
+    return paths
+
+
+def in_place(paths, data):
+    for path in paths:
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+def per_file(paths, data):
+    for path in paths:
+        with open(path + rekey.STAGED_SUFFIX, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + rekey.STAGED_SUFFIX, path)
+        commit.fsync_dir(os.path.dirname(path))
+
+
+def batched(paths, data, journal_path):
+    journal = commit.Journal(journal_path)
+    for path in paths:
+        with open(path + rekey.STAGED_SUFFIX, 'wb') as f:
+            f.write(data)
+        journal.add(path, path + rekey.STAGED_SUFFIX, manifest.sha256(data))
+    commit.commit(journal)
+    commit.finish(journal)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=4096)
+    parser.add_argument('--dirs', type=int, default=20)
+    parser.add_argument('--dir', default=None, help='Where to write the files. Default: the system temp dir')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-commit-', dir=args.dir)
+    try:
+        print('{} files of {} bytes in {} directories under {}'.format(args.files, args.size, args.dirs, workdir))
+        print('{:<10} {:>10} {:>12} {:>10}'.format('commit', 'seconds', 'files/s', 'durable'))
+        data = os.urandom(args.size)
+        for name, durable, run in (
+                ('in place', 'no', lambda paths: in_place(paths, data)),
+                ('per file', 'yes', lambda paths: per_file(paths, data)),
+                ('batched', 'yes', lambda paths: batched(paths, data, os.path.join(workdir, name + commit.JOURNAL_SUFFIX)))):
+            root = os.path.join(workdir, name.replace(' ', '-'))
+            paths = make_files(root, args.files, args.size, args.dirs)
+            start = time.perf_counter()
+            run(paths)
+            seconds = time.perf_counter() - start
+            print('{:<10} {:>10.3f} {:>12.0f} {:>10}'.format(name, seconds, args.files / seconds, durable))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
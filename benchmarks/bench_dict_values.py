@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks resolving every secret address in a parsed vars document.
+
+get_dict_value used to deepcopy the whole document on every lookup, so resolving k secrets in a
+document of n nodes cost O(k*n). It should now scale with the number of secrets alone.
+
+    $ python -m benchmarks.bench_dict_values
+"""
+
+import sys
+import timeit
+
+from ansible_vault_rekey import ansible_vault_rekey as rekey
+from ansible_vault_rekey.vaultstring import VaultString
+
+CIPHERTEXT = '$ANSIBLE_VAULT;1.1;AES256\n' + '0' * 400
+
+
+def generate_vars(hosts, secrets_per_host=2, padding=10):
+    """Builds a document shaped like a large group_vars/all.yml: one entry per host, each holding
+    a couple of secrets alongside plain values."""
+    data = {}
+    for h in range(hosts):
+        host = {'vars': {'opt{}'.format(p): 'value{}'.format(p) for p in range(padding)}, 'users': []}
+        for s in range(secrets_per_host):
+            host['users'].append({'name': 'user{}'.format(s), 'password': VaultString(CIPHERTEXT)})
+        data['host{}'.format(h)] = host
+    return data
+
+
+def main(sizes=(10, 50, 250, 1250)):
+    print('{:>8} {:>8} {:>12} {:>14}'.format('hosts', 'secrets', 'total (ms)', 'per secret (us)'))
+    for hosts in sizes:
+        data = generate_vars(hosts)
+        secrets = list(rekey.find_yaml_secrets(data))
+
+        def resolve():
+            for address in secrets:
+                rekey.put_dict_value(data, address, rekey.get_dict_value(data, address))
+
+        runs = 5
+        elapsed = min(timeit.repeat(resolve, number=1, repeat=runs))
+        print('{:>8} {:>8} {:>12.2f} {:>14.2f}'.format(
+            hosts, len(secrets), elapsed * 1000, elapsed / len(secrets) * 1000000))
+
+
+if __name__ == '__main__':
+    main(tuple(int(i) for i in sys.argv[1:]) or (10, 50, 250, 1250))
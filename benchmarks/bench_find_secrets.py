@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks finding every secret in a document: the old recursive generator, which re-yielded
+each address up the whole chain and copied its path list at every level, against the iterative
+walk, and constructing a document against only composing it for a file with no !vault nodes.
+
+    $ python -m benchmarks.bench_find_secrets [hosts] [depth]
+"""
+
+import sys
+import timeit
+
+from ansible_vault_rekey import ansible_vault_rekey as rekey
+from ansible_vault_rekey.vaultstring import VaultString
+
+from benchmarks.bench_dict_values import CIPHERTEXT, generate_vars
+
+
+def recursive_find(data, path=None):
+    path = [] if not path else path
+    if data.__class__ is VaultString:
+        yield path
+    if isinstance(data, list):
+        for counter, item in enumerate(data):
+            for r in recursive_find(item, path + [counter]):
+                yield r
+    if isinstance(data, dict):
+        for k, v in data.items():
+            for r in recursive_find(v, path + [k]):
+                yield r
+
+
+def deep_vars(depth):
+    data = VaultString(CIPHERTEXT)
+    for i in range(depth):
+        data = {'level{}'.format(i): data, 'plain': i}
+    return data
+
+
+def best(func, runs=5):
+    return min(timeit.repeat(func, number=1, repeat=runs)) * 1000
+
+
+def main(hosts=5000, depth=900):
+    print('{:<34} {:>12} {:>12}'.format('document', 'recursive', 'iterative'))
+    for name, data in (('{} hosts'.format(hosts), generate_vars(hosts)),
+                       ('nested {} deep'.format(depth), deep_vars(depth))):
+        print('{:<34} {:>10.2f}ms {:>10.2f}ms'.format(
+            name, best(lambda: list(recursive_find(data))), best(lambda: list(rekey.find_yaml_secrets(data)))))
+
+    lines = ['# mentions $ANSIBLE_VAULT; but holds no secrets']
+    lines += ['host{0}:\n  ip: 10.0.0.{1}\n  ports: [80, 443]'.format(i, i % 250) for i in range(hosts)]
+    content = '\n'.join(lines)
+    print('{:<34} {:>10.2f}ms {:>10.2f}ms'.format(
+        'no secrets, load vs compose', best(lambda: rekey.load_yaml(content)),
+        best(lambda: rekey.load_yaml_secrets(content))))
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
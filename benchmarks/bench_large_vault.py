@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks peak memory and time rekeying one large whole-file vault in memory against
+streaming it a chunk at a time. Each run happens in a fresh process so peak RSS isn't shared.
+
+    $ python -m benchmarks.bench_large_vault [size in MB]
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from ansible_vault_rekey import ansible_vault_rekey as rekey
+
+
+def peak_rss_mb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+
+def in_memory(path, newpath):
+    with open(path, 'rb') as f:
+        encrypted = rekey.rekey_secret(f.read(), 'old', 'new')
+    with open(newpath, 'wb') as f:
+        f.write(encrypted)
+
+
+def streamed(path, newpath):
+    rekey.rekey_large_file(path, newpath, 'old', 'new')
+
+
+def measure(func, path, newpath):
+    before = peak_rss_mb()
+    start = time.perf_counter()
+    func(path, newpath)
+    return time.perf_counter() - start, peak_rss_mb() - before
+
+
+def main(size_mb=64):
+    workdir = tempfile.mkdtemp(prefix='bench-large-vault-')
+    try:
+        path = os.path.join(workdir, 'dump.sql')
+        with open(path, 'wb') as f:
+            f.write(rekey.encrypt_secret(os.urandom(size_mb * 1024 * 1024), 'old'))
+        print('{:.0f} MB vault ({} MB plaintext)'.format(os.path.getsize(path) / 1024.0 / 1024, size_mb))
+        for func in (in_memory, streamed):
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                seconds, rss = pool.submit(measure, func, path, path + '.new').result()
+            print('{:<10} {:>8.2f}s {:>10.1f} MB peak RSS growth'.format(func.__name__, seconds, rss))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks rekeying many small whole-file vaults in-process against shelling out to
+`ansible-vault rekey` once per file, which is what rekey_file used to do.
+
+    $ python -m benchmarks.bench_rekey_file [file count]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from ansible_vault_rekey import ansible_vault_rekey as rekey
+
+
+def generate_vaults(path, count, password):
+    for i in range(count):
+        with open(os.path.join(path, 'vault{}.yml'.format(i)), 'wb') as f:
+            f.write(rekey.encrypt_secret('secret_{0}: value {0}\n'.format(i), password))
+
+
+def rekey_subprocess(path, password_file, new_password_file):
+    cmd = "ansible-vault rekey --vault-password-file {} --new-vault-password-file {} {}".format(
+        password_file, new_password_file, path)
+    subprocess.check_call(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run(name, func, count):
+    workdir = tempfile.mkdtemp(prefix='bench-rekey-file-')
+    try:
+        password_file = os.path.join(workdir, 'old-password')
+        new_password_file = os.path.join(workdir, 'new-password')
+        rekey.write_password_file(password_file, 'old')
+        rekey.write_password_file(new_password_file, 'new')
+        vaults = os.path.join(workdir, 'vaults')
+        os.makedirs(vaults)
+        generate_vaults(vaults, count, 'old')
+
+        start = time.perf_counter()
+        for name_ in sorted(os.listdir(vaults)):
+            func(os.path.join(vaults, name_), password_file, new_password_file)
+        elapsed = time.perf_counter() - start
+        print('{:<14} {:>6} files {:>10.2f}s {:>10.1f} files/s'.format(name, count, elapsed, count / elapsed))
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main(count=1000):
+    run('in-process', rekey.rekey_file, count)
+    if shutil.which('ansible-vault'):
+        run('ansible-vault', rekey_subprocess, count)
+    else:
+        print('ansible-vault not on PATH, skipping the subprocess comparison')
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
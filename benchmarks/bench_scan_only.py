@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks listing a repo's vault data: classify_file, which parses every candidate file as
+YAML, with libyaml if PyYAML has it and with the pure Python loader, against inventory_file,
+which reads secrets straight from the text. Runs over a synthetic repo from the harness plus
+scripts which only mention the vault marker.
+
+    $ python -m benchmarks.bench_scan_only [vars files] [mentions]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+from ansible_vault_rekey import ansible_vault_rekey as rekey
+
+from benchmarks.harness import generate_repo
+
+MENTION = '''#!/bin/sh
+# decrypts anything starting with $ANSIBLE_VAULT;1.1;AES256
+for f in $(grep -rl '$ANSIBLE_VAULT;' .); do
+  ansible-vault view "$f"
+done
+'''
+
+
+def pure_python_classify_file(path):
+    libyaml, rekey.YamlLoader = rekey.YamlLoader, yaml.SafeLoader
+    try:
+        return rekey.classify_file(path)
+    finally:
+        rekey.YamlLoader = libyaml
+
+
+def measure(func, paths):
+    start = time.perf_counter()
+    found = [i for i in map(func, paths) if i]
+    return time.perf_counter() - start, found
+
+
+def main(files=400, mentions=200):
+    workdir = tempfile.mkdtemp(prefix='bench-scan-only-')
+    try:
+        generate_repo(workdir, files=files, secrets=10, depth=4, plain_files=files)
+        for i in range(mentions):
+            with open(os.path.join(workdir, 'decrypt{}.sh'.format(i)), 'w') as f:
+                f.write(MENTION)
+        paths = list(rekey.find_files(workdir, '*'))
+        print('{} files'.format(len(paths)))
+        results = {}
+        for func in (pure_python_classify_file, rekey.classify_file, rekey.inventory_file):
+            seconds, found = measure(func, paths)
+            results[func.__name__] = sorted(i['file'] for i in found)
+            print('{:<26} {:>8.3f}s {:>6} vault-enabled files'.format(func.__name__, seconds, len(found)))
+        assert len(set(tuple(i) for i in results.values())) == 1
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks splitting a repo between shards: how evenly the weighted partition spreads the
+work, as the heaviest shard's load over the average, against hashing each path to a shard, and
+what weighing every file costs each node up front.
+
+    $ python -m benchmarks.bench_shard [vars files] [secrets per file]
+"""
+
+import hashlib
+import shutil
+import sys
+import tempfile
+import time
+
+from ansible_vault_rekey import ansible_vault_rekey as rekey
+from ansible_vault_rekey import shard
+
+from benchmarks.harness import generate_repo
+
+
+def hashed(weights, count):
+    shards = [[] for _ in range(count)]
+    for relpath in weights:
+        shards[int(hashlib.sha256(relpath.encode('utf-8')).hexdigest(), 16) % count].append(relpath)
+    return shards
+
+
+def imbalance(weights, shards):
+    loads = [sum(weights[f] for f in s) for s in shards]
+    return max(loads) / (float(sum(loads)) / len(loads))
+
+
+def main(files=400, secrets=10):
+    workdir = tempfile.mkdtemp(prefix='bench-shard-')
+    try:
+        generate_repo(workdir, files=files, secrets=secrets, depth=3, plain_files=files)
+        paths = list(rekey.find_files(workdir))
+        start = time.perf_counter()
+        weights = shard.weigh_files(paths, workdir)
+        print('weighed {} files in {:.3f}s, total weight {}'.format(
+            len(paths), time.perf_counter() - start, sum(weights.values())))
+        print('{:>7} {:>10} {:>10}'.format('shards', 'weighted', 'hashed'))
+        for count in (2, 4, 8, 16):
+            print('{:>7} {:>10.3f} {:>10.3f}'.format(
+                count, imbalance(weights, shard.partition(weights, count)), imbalance(weights, hashed(weights, count))))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks writing a rekeyed vars file by splicing new ciphertext into the original text
+against re-emitting the whole document with write_yaml.
+
+    $ python -m benchmarks.bench_splice [plain vars] [secrets]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from ansible_vault_rekey import ansible_vault_rekey as rekey
+
+
+def generate_vars(path, plain, secrets):
+    lines = ['---', '# generated inventory vars']
+    for i in range(plain):
+        lines.append('host_{0}:  # host {0}\n  ip: 10.0.{1}.{2}\n  port: {3}'.format(i, i // 250, i % 250, 8000 + i))
+    for i in range(secrets):
+        block = rekey.encrypt_secret('secret {}'.format(i), 'old').decode('utf-8').strip()
+        lines.append('secret_{}: !vault |\n  {}'.format(i, block.replace('\n', '\n  ')))
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def main(plain=10000, secrets=20):
+    workdir = tempfile.mkdtemp(prefix='bench-splice-')
+    try:
+        path = os.path.join(workdir, 'vars.yml')
+        generate_vars(path, plain, secrets)
+        vf = rekey.classify_file(path)
+        results = rekey.map_vault_files([vf], rekey.rekey_secret, ('old', 'new'),
+                                        unwrap=lambda v: v.ciphertext,
+                                        wrap=lambda c: rekey.VaultString(c.decode('utf-8')))
+        print('{} lines, {} secrets'.format(sum(1 for _ in open(path)), secrets))
+        for name, vault_files in (('re-emit', None), ('splice', [vf])):
+            start = time.perf_counter()
+            rekey.write_encrypted_results([list(r) for r in results], [path + '.out'], vault_files)
+            print('{:<10} {:>8.3f}s'.format(name, time.perf_counter() - start))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
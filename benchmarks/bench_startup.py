@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks CLI startup, which every pre-commit run pays before doing anything: the import
+time of ansible_vault_rekey.cli as reported by `python -X importtime`, with and without Ansible's
+vault code imported along with it, and the wall time of `--help`, `--scan-only` over a small repo
+and the interpreter on its own.
+
+    $ python -m benchmarks.bench_startup [runs]
+"""
+
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.harness import generate_repo
+
+CLI = 'import ansible_vault_rekey.cli'
+EAGER = 'import ansible_vault_rekey.cli, ansible.parsing.vault, cryptography.hazmat.primitives.ciphers'
+
+
+def import_times(code):
+    """Returns {module: (self us, cumulative us)} from one `python -X importtime -c code`."""
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], stderr=subprocess.PIPE,
+                         check=True, universal_newlines=True).stderr
+    times = {}
+    for line in err.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+
+def wall_time(args, runs):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def main(runs=5):
+    for name, code in (('cli', CLI), ('cli + ansible vault', EAGER)):
+        times = min((import_times(code) for _ in range(runs)), key=lambda t: sum(i[0] for i in t.values()))
+        total = sum(i[0] for i in times.values())
+        ansible = sum(i[0] for m, i in times.items() if m.split('.')[0] in ('ansible', 'cryptography', 'jinja2'))
+        print('{:<22} {:>8.1f}ms imports, {:>6.1f}ms of it ansible/cryptography/jinja2'.format(
+            name, total / 1000.0, ansible / 1000.0))
+
+    workdir = tempfile.mkdtemp(prefix='bench-startup-')
+    try:
+        generate_repo(workdir, files=20, secrets=5, depth=3, plain_files=20)
+        for name, args in (('python -c pass', ['-c', 'pass']),
+                           ('--help', ['-m', 'ansible_vault_rekey.cli', '--help']),
+                           ('--scan-only', ['-m', 'ansible_vault_rekey.cli', '--scan-only', '--code-path', workdir])):
+            print('{:<22} {:>8.1f}ms'.format(name, wall_time(args, runs)))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks the memory a large inventory's !vault scalars take once loaded: the old
+VaultString, a __dict__ per instance holding the ciphertext text and, once decrypted, the
+plaintext, against the slotted one holding packed ciphertext bytes. Measured with tracemalloc
+over a vars document of that many secrets loaded with load_yaml, so it includes the strings the
+parser hands over.
+
+    $ python -m benchmarks.bench_vaultstring_memory [secrets] [plaintext bytes]
+"""
+
+from binascii import hexlify
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from ansible_vault_rekey import ansible_vault_rekey as rekey
+from ansible_vault_rekey.vaultstring import VaultString, unpack
+
+
+class LegacyVaultString:
+    yaml_tag = u'!vault'
+
+    def __init__(self, ciphertext):
+        self.plaintext = None
+        self.ciphertext = ciphertext.strip() if isinstance(ciphertext, str) else ciphertext
+
+
+def legacy_constructor(payload):
+    def construct(loader, node):
+        vs = LegacyVaultString(loader.construct_scalar(node))
+        # the old VaultString kept each plaintext on its object once decrypted
+        vs.plaintext = hexlify(os.urandom(payload // 2)).decode('utf-8')
+        return vs
+    return construct
+
+
+def vars_document(secrets, payload, seed=0):
+    """A vars file of `secrets` distinct !vault blocks the size `payload` bytes of plaintext
+        encrypt to. They're random bytes in vault layout, nothing needs to decrypt them here."""
+    rng = random.Random(seed)
+    size = 32 + 32 + (payload // 16 + 1) * 16
+    lines = []
+    for i in range(secrets):
+        payload_bytes = bytes(rng.getrandbits(8) for _ in range(size))
+        block = unpack(b'$ANSIBLE_VAULT;1.1;AES256', payload_bytes).decode('utf-8')
+        lines.append('secret_{}: !vault |\n  {}'.format(i, block.replace('\n', '\n  ')))
+    return '\n'.join(lines) + '\n'
+
+
+def measure(text, constructor):
+    rekey.YamlLoader.add_constructor(VaultString.yaml_tag, constructor)
+    try:
+        # timed without tracemalloc, which slows every allocation down
+        start = time.perf_counter()
+        rekey.load_yaml(text)
+        seconds = time.perf_counter() - start
+        tracemalloc.start()
+        data = rekey.load_yaml(text)
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        rekey.YamlLoader.add_constructor(VaultString.yaml_tag, VaultString.yaml_constructor)
+    return current, seconds, data
+
+
+def main(secrets=50000, payload=32):
+    text = vars_document(secrets, payload)
+    print('{} secrets, {:.1f} MiB of YAML'.format(secrets, len(text) / 1048576.0))
+    print('{:<12} {:>10} {:>14} {:>8}'.format('VaultString', 'MiB', 'bytes/secret', 'load'))
+    loaded = {}
+    for name, constructor in (('legacy', legacy_constructor(payload)), ('slotted', VaultString.yaml_constructor)):
+        current, seconds, loaded[name] = measure(text, constructor)
+        print('{:<12} {:>10.1f} {:>14.0f} {:>7.2f}s'.format(name, current / 1048576.0, current / float(secrets), seconds))
+    assert all(loaded['slotted'][k].ciphertext == v.ciphertext for k, v in loaded['legacy'].items())
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
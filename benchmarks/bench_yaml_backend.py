@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks loading and dumping large vars files with libyaml against the pure-Python backend.
+
+    $ python -m benchmarks.bench_yaml_backend [size in MB ...]
+"""
+
+import sys
+import time
+
+import yaml
+
+from ansible_vault_rekey import ansible_vault_rekey as rekey
+from ansible_vault_rekey.vaultstring import VaultString
+
+CIPHERTEXT = '$ANSIBLE_VAULT;1.1;AES256\n' + '\n'.join(['3' * 80] * 5)
+
+BACKENDS = [
+    ('yaml.Loader/Dumper', yaml.Loader, yaml.Dumper),
+    ('SafeLoader/SafeDumper', yaml.SafeLoader, yaml.SafeDumper),
+]
+if yaml.__with_libyaml__:
+    BACKENDS.append(('CSafeLoader/CSafeDumper', yaml.CSafeLoader, yaml.CSafeDumper))
+
+
+def generate_vars(megabytes):
+    """Returns YAML text of roughly `megabytes` MB, mixing plain values with inline secrets."""
+    data, i = {}, 0
+    while True:
+        data['host{}'.format(i)] = {
+            'users': [{'name': 'user{}'.format(u), 'password': VaultString(CIPHERTEXT)} for u in range(3)],
+            'packages': ['package{}'.format(p) for p in range(10)],
+            'settings': {'opt{}'.format(o): 'value{}'.format(o) for o in range(10)},
+        }
+        i += 1
+        if i % 250 == 0:
+            text = yaml.dump(data, Dumper=rekey.YamlDumper, default_flow_style=False)
+            if len(text) >= megabytes * 1024 * 1024:
+                return text
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main(sizes=(1, 4)):
+    print('{:>6} {:<26} {:>10} {:>10}'.format('MB', 'backend', 'load (s)', 'dump (s)'))
+    for size in sizes:
+        text = generate_vars(size)
+        for name, loader, dumper in BACKENDS:
+            data, load_time = timed(yaml.load, text, Loader=loader)
+            _, dump_time = timed(yaml.dump, data, Dumper=dumper, default_flow_style=False)
+            print('{:>6.1f} {:<26} {:>10.3f} {:>10.3f}'.format(
+                len(text) / 1024.0 / 1024, name, load_time, dump_time))
+
+
+if __name__ == '__main__':
+    main(tuple(float(i) for i in sys.argv[1:]) or (1, 4))
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Throughput benchmarks for scanning, decrypting, encrypting and rekeying a whole repo.
+
+Generates a synthetic Ansible repo, runs each phase of a rekey against it and reports files/s,
+secrets/s, peak RSS and a per-phase time breakdown. Results can be written out as JSON and
+compared against a stored baseline, failing if any phase got slower than the tolerance allows.
+
+    $ python -m benchmarks.harness --files 200 --secrets 5 --depth 3 --payload 64
+    $ python -m benchmarks.harness --output results.json --baseline benchmarks/baseline.json
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import string
+import sys
+import tempfile
+import time
+
+import yaml
+
+from ansible_vault_rekey import ansible_vault_rekey as rekey
+from ansible_vault_rekey import cli
+from ansible_vault_rekey.vaultstring import KEY_CACHE, VaultString
+
+PASSWORD = 'benchmark-password'
+
+# phases this fast are mostly noise, don't flag them unless they slow down by at least this much
+MIN_REGRESSION_SECONDS = 0.05
+
+
+def random_text(size, rng):
+    return ''.join(rng.choice(string.ascii_letters + string.digits) for _ in range(size))
+
+
+def nest(value, depth, rng):
+    """Wraps value in `depth` levels of dicts and lists, like a deep vars structure."""
+    for level in range(depth):
+        if level % 2:
+            value = [random_text(8, rng), value]
+        else:
+            value = {'key{}'.format(rng.randint(0, 99)): value, 'plain': random_text(16, rng)}
+    return value
+
+
+def generate_repo(path, files=200, secrets=5, depth=3, payload=64, whole_ratio=0.2, plain_files=200,
+                  jobs=1, seed=0):
+    """Writes a synthetic repo to path: `files` vault-enabled vars files (a `whole_ratio` share of
+        them whole-file vaults, the rest holding `secrets` inline secrets of `payload` bytes each
+        nested `depth` levels deep) alongside `plain_files` files without any vault data.
+        Returns the number of inline secrets written."""
+    rng = random.Random(seed)
+    whole = int(files * whole_ratio)
+    plaintexts = [random_text(payload, rng) for _ in range((files - whole) * secrets)]
+    whole_plaintexts = [yaml.dump({'secret_{}'.format(i): random_text(payload, rng) for i in range(secrets)})
+                        for _ in range(whole)]
+    tasks = [(p, PASSWORD) for p in plaintexts + whole_plaintexts]
+    encrypted = [e for e, _ in rekey.parallel_map(rekey.encrypt_secret, tasks, jobs)]
+
+    def write(relpath, content):
+        full = os.path.join(path, relpath)
+        if not os.path.isdir(os.path.dirname(full)):
+            os.makedirs(os.path.dirname(full))
+        with open(full, 'wb') as f:
+            f.write(content if isinstance(content, bytes) else content.encode('utf-8'))
+
+    inline = encrypted[:len(plaintexts)]
+    for i in range(files - whole):
+        data = {'var_{}'.format(s): nest(VaultString(inline[i * secrets + s].decode('utf-8')), depth, rng)
+                for s in range(secrets)}
+        data['plain'] = random_text(payload, rng)
+        write('group_vars/group{}/vars.yml'.format(i), yaml.dump(data, Dumper=rekey.YamlDumper))
+    for i, ciphertext in enumerate(encrypted[len(plaintexts):]):
+        write('host_vars/host{}/vault.yml'.format(i), ciphertext)
+    for i in range(plain_files):
+        write('roles/role{}/tasks/main.yml'.format(i), yaml.dump(nest(random_text(payload, rng), depth, rng)))
+    write('vault-password.txt', PASSWORD)
+    return len(plaintexts)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process and any pool workers, in MB."""
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return usage / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+
+def phase(results, name, files, secrets, func, *args):
+    start = time.perf_counter()
+    value = func(*args)
+    elapsed = time.perf_counter() - start
+    results['phases'][name] = {
+        'seconds': elapsed,
+        'files_per_sec': files / elapsed if elapsed else None,
+        'secrets_per_sec': secrets / elapsed if elapsed and secrets else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    return value
+
+
+def run(params, jobs=1):
+    workdir = tempfile.mkdtemp(prefix='ansible-vault-rekey-bench-')
+    try:
+        repo = os.path.join(workdir, 'repo')
+        secrets = generate_repo(repo, jobs=jobs, **params)
+        password_file = os.path.join(repo, 'vault-password.txt')
+        new_password_file = os.path.join(workdir, 'new-password.txt')
+        rekey.write_password_file(new_password_file)
+        results = {'params': dict(params, jobs=jobs), 'secrets': secrets, 'phases': {}}
+        KEY_CACHE.wipe()
+
+        paths = phase(results, 'scan', params['files'] + params['plain_files'], 0,
+                      lambda: list(rekey.find_files(repo)))
+        vault_files = phase(results, 'classify', len(paths), secrets,
+                            lambda: [f for f in map(rekey.classify_file, paths) if f])
+        decrypted = phase(results, 'decrypt', len(vault_files), secrets,
+                          rekey.decrypt_files, vault_files, password_file, None, jobs)
+        KEY_CACHE.wipe()
+        plaintext_files = [dict(f, data=d) if 'secrets' in f else dict(f, raw=d)
+                           for f, (d, _) in zip(vault_files, decrypted)]
+        newpaths = [os.path.join(workdir, 'out', str(i)) for i in range(len(vault_files))]
+        os.makedirs(os.path.join(workdir, 'out'))
+        phase(results, 'encrypt', len(vault_files), secrets,
+              rekey.encrypt_files, plaintext_files, new_password_file, newpaths, jobs)
+        KEY_CACHE.wipe()
+
+        args = ['-r', repo, '--no-backups', '--no-cache', '-j', str(jobs)]
+        phase(results, 'rekey', len(vault_files), secrets, cli.main.main, args, 'ansible-vault-rekey', None, False)
+        results['peak_rss_mb'] = peak_rss_mb()
+        return results
+    finally:
+        shutil.rmtree(workdir)
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of phases which ran more than `tolerance` (a fraction) slower than baseline."""
+    regressions = []
+    for name, current in results['phases'].items():
+        previous = baseline.get('phases', {}).get(name)
+        if previous and current['seconds'] > previous['seconds'] * (1 + tolerance) and \
+                current['seconds'] - previous['seconds'] > MIN_REGRESSION_SECONDS:
+            regressions.append('{}: {:.3f}s vs {:.3f}s baseline'.format(name, current['seconds'], previous['seconds']))
+    return regressions
+
+
+def print_report(results):
+    print('{secrets} secrets in {params[files]} vault files, {params[plain_files]} plain files, '
+          'depth {params[depth]}, {params[payload]} byte payloads, {params[jobs]} job(s)'.format(**results))
+    print('{:<10} {:>10} {:>12} {:>14} {:>12}'.format('phase', 'seconds', 'files/s', 'secrets/s', 'peak RSS MB'))
+    for name, p in results['phases'].items():
+        print('{:<10} {:>10.3f} {:>12} {:>14} {:>12.1f}'.format(
+            name, p['seconds'],
+            '{:.1f}'.format(p['files_per_sec']) if p['files_per_sec'] else '-',
+            '{:.1f}'.format(p['secrets_per_sec']) if p['secrets_per_sec'] else '-',
+            p['peak_rss_mb']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=200, help='vault-enabled files to generate')
+    parser.add_argument('--secrets', type=int, default=5, help='inline secrets per file')
+    parser.add_argument('--depth', type=int, default=3, help='nesting depth of each secret')
+    parser.add_argument('--payload', type=int, default=64, help='bytes of plaintext per secret')
+    parser.add_argument('--whole-ratio', type=float, default=0.2, help='share of files that are whole-file vaults')
+    parser.add_argument('--plain-files', type=int, default=200, help='files without vault data to generate')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare against results previously written with --output')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fraction a phase may be slower than the baseline before failing')
+    args = parser.parse_args(argv)
+
+    params = {'files': args.files, 'secrets': args.secrets, 'depth': args.depth, 'payload': args.payload,
+              'whole_ratio': args.whole_ratio, 'plain_files': args.plain_files}
+    results = run(params, args.jobs)
+    print_report(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != results['params']:
+            print('Baseline was recorded with different parameters: {}'.format(baseline.get('params')))
+            return 2
+        regressions = compare(results, baseline, args.tolerance)
+        for r in regressions:
+            print('REGRESSION {}'.format(r))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,24 +3,50 @@
 
 """Tests for `ansible_vault_rekey` package."""
 
+import io
+import json
 import os
+import pickle
 import pytest
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
 import time
+import yaml
 from os.path import realpath, join
 
 from click.testing import CliRunner
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from ansible_vault_rekey import ansible_vault_rekey as rekey
 from ansible.constants import DEFAULT_VAULT_ID_MATCH
 from ansible.parsing.vault import VaultLib
 from ansible.parsing.vault import VaultSecret
-from ansible_vault_rekey.vaultstring import VaultString
+from ansible_vault_rekey.vaultstring import KEY_CACHE, VaultString
+from ansible_vault_rekey import archive
 from ansible_vault_rekey import cli
+from ansible_vault_rekey import commit
+from ansible_vault_rekey import index
+from ansible_vault_rekey import manifest
+from ansible_vault_rekey import pipeline
+from ansible_vault_rekey import scanner
+from ansible_vault_rekey import shard
+from ansible_vault_rekey import stream
+from ansible_vault_rekey import textscan
+from ansible_vault_rekey.metrics import METRICS, Metrics
 
 PLAY = realpath('tests/testplay')
 TMP_DIR = '/tmp/python-ansible-vault-rekey-{}'.format(str(time.time()))
 
 
+@pytest.fixture(autouse=True)
+def cache_home(monkeypatch):
+    """Keeps the scan indexes CLI runs write out of the real ~/.cache."""
+    monkeypatch.setenv('XDG_CACHE_HOME', join(TMP_DIR, 'cache'))
+
+
 def test_find_files_yml():
     expected = [
         "local.yml",
@@ -63,9 +89,9 @@ def test_parse_yaml_bad():
 def test_find_yaml_secrets():
     d = rekey.parse_yaml(join(PLAY, "group_vars/inlinesecrets.yml"))
     expected = [
-        ['password'],
-        ['users', 0, 'password'],
-        ['users', 1, 'secrets', 1]
+        ('password',),
+        ('users', 0, 'password'),
+        ('users', 1, 'secrets', 1)
     ]
     r = list(rekey.find_yaml_secrets(d))
     for i in expected:
@@ -125,6 +151,24 @@ def test_vaultstring_encrypt_decrypt():
     assert decrypted == plaintext
 
 
+def test_vaultstring_compact():
+    ciphertext = rekey.encrypt_secret('moo', 'pw', 'dev').decode('utf-8').strip()
+    v = VaultString(ciphertext + '\n')
+    assert not hasattr(v, '__dict__')
+    assert v.ciphertext == ciphertext and v.header == b'$ANSIBLE_VAULT;1.2;AES256;dev'
+    assert len(v._payload) < len(ciphertext) / 3
+    assert pickle.loads(pickle.dumps(v)).ciphertext == ciphertext
+    # anything not laid out the way Ansible writes it is kept exactly as it was
+    for text in (ciphertext.upper(), ciphertext.replace('\n', '\n ', 1), 'moo'):
+        assert VaultString(text).ciphertext == text
+    assert VaultString(None).ciphertext is None
+
+    assert v.rekey('pw', 'newpw') is v
+    assert v.ciphertext != ciphertext and v.header == b'$ANSIBLE_VAULT;1.2;AES256;dev'
+    assert v.decrypt('newpw') == b'moo'
+    assert [s for s in VaultString.__slots__ if 'plain' in s] == []
+
+
 def test_rekey_file_withdecrypt():
     with open(join(PLAY, "group_vars/nosecrets.yml"), 'rb') as f:
         expected = f.read()
@@ -214,3 +258,1014 @@ def test_command_line_interface_dryrun():
     runner = CliRunner()
     dry_run_result = runner.invoke(cli.main, ['--debug', '--dry-run', '-r', PLAY])
     assert dry_run_result.exit_code == 0
+
+
+def test_parallel_map_ordered():
+    tasks = [(i,) for i in range(10)]
+    assert rekey.parallel_map(str, tasks, jobs=4) == [(str(i), None) for i in range(10)]
+
+
+def test_parallel_map_errors():
+    r = rekey.parallel_map(int, [('1',), ('moo',), ('3',)], jobs=2)
+    assert [i[0] for i in r] == [1, None, 3]
+    assert r[0][1] is None
+    assert isinstance(r[1][1], ValueError)
+
+
+def test_decrypt_files_parallel():
+    password_file = join(PLAY, "vault-password.txt")
+    inline = join(PLAY, "group_vars/inlinesecrets.yml")
+    vault_files = [
+        {'file': join(PLAY, "group_vars/encrypted.yml")},
+        {'file': inline, 'secrets': list(rekey.find_yaml_secrets(rekey.parse_yaml(inline)))},
+        {'file': join(PLAY, "group_vars/nosecrets.yml")},
+    ]
+    r = rekey.decrypt_files(vault_files, password_file, jobs=2)
+    with open(join(PLAY, "group_vars/nosecrets.yml"), 'rb') as f:
+        assert r[0] == (f.read(), None)
+    assert r[1] == (rekey.parse_yaml(join(PLAY, "group_vars/inlinesecrets_decrypted.yml")), None)
+    assert r[2][0] is None
+    assert r[2][1] is not None
+
+
+def test_encrypt_files_parallel():
+    password_file = join(PLAY, "alt-vault-password.txt")
+    src = join(PLAY, "group_vars/inlinesecrets_decrypted.yml")
+    vault_files = [
+        {'file': join(PLAY, "group_vars/nosecrets.yml")},
+        {'file': src, 'secrets': [['password'], ['users', 0, 'password'], ['users', 1, 'secrets', 1]]},
+    ]
+    newpaths = [join(TMP_DIR, 'encrypt_files_whole.yml'), join(TMP_DIR, 'encrypt_files_inline.yml')]
+    r = rekey.encrypt_files(vault_files, password_file, newpaths, jobs=2)
+    assert [i[1] for i in r] == [None, None]
+    assert rekey.decrypt_file(newpaths[0], password_file) == open(vault_files[0]['file'], 'rb').read()
+    assert rekey.decrypt_file(newpaths[1], password_file) == rekey.parse_yaml(src)
+
+
+def test_command_line_interface_jobs():
+    play = join(TMP_DIR, 'test_cli_jobs')
+    shutil.copytree(PLAY, play)
+    os.remove(join(play, 'group_vars/bad.yml'))
+    expected = rekey.parse_yaml(join(PLAY, "group_vars/inlinesecrets_decrypted.yml"))
+    runner = CliRunner()
+    result = runner.invoke(cli.main, ['--jobs', '2', '-r', play])
+    assert result.exit_code == 0
+    assert not os.path.exists(join(play, '.rekey-backups'))
+    password_file = join(play, 'vault-password.txt')
+    assert rekey.decrypt_file(join(play, 'group_vars/inlinesecrets.yml'), password_file) == expected
+    assert rekey.decrypt_file(join(play, 'group_vars/encrypted.yml'), password_file) == \
+        open(join(PLAY, 'group_vars/nosecrets.yml'), 'rb').read()
+
+
+class CountingPool(ProcessPoolExecutor):
+    submitted = []
+
+    def submit(self, fn, *args, **kwargs):
+        CountingPool.submitted.append(args[0])
+        return super(CountingPool, self).submit(fn, *args, **kwargs)
+
+
+def test_command_line_interface_jobs_split_secrets(monkeypatch):
+    play = join(TMP_DIR, 'test_cli_jobs_split')
+    shutil.copytree(PLAY, play)
+    os.remove(join(play, 'group_vars/bad.yml'))
+    password = rekey.read_password(join(play, 'vault-password.txt'))
+    count = rekey.SPLIT_SECRETS + 4
+    with open(join(play, 'group_vars/many.yml'), 'w') as f:
+        for i in range(count):
+            ciphertext = rekey.encrypt_secret('moo{}'.format(i), password).decode('utf-8').strip()
+            f.write('s{}: !vault |\n'.format(i) + ''.join('  {}\n'.format(line) for line in ciphertext.splitlines()))
+    monkeypatch.setattr(cli, 'ProcessPoolExecutor', CountingPool)
+    CountingPool.submitted = []
+    result = CliRunner().invoke(cli.main, ['--jobs', '2', '--verify', '-r', play])
+    assert result.exit_code == 0
+    # the big file's secrets each went to the pool on their own, the small files went whole
+    assert CountingPool.submitted.count(rekey.rekey_secret) == count
+    assert CountingPool.submitted.count(rekey.secret_matches) == count
+    data = rekey.decrypt_file(join(play, 'group_vars/many.yml'), join(play, 'vault-password.txt'))
+    assert data == dict(('s{}'.format(i), 'moo{}'.format(i)) for i in range(count))
+
+
+def test_parallel_map_executor():
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        assert rekey.parallel_map(str, [(1,)], executor=pool) == [('1', None)]
+        # left running for the caller
+        assert pool.submit(str, 2).result() == '2'
+
+
+def test_record_of_drops_data():
+    vf = rekey.classify_file(join(PLAY, 'group_vars/inlinesecrets.yml'))
+    vf['relpath'], vf['staged'] = 'group_vars/inlinesecrets.yml', vf['file'] + rekey.STAGED_SUFFIX
+    assert sorted(cli.record_of(vf)) == ['file', 'relpath', 'sha256', 'staged']
+    whole = rekey.classify_file(join(PLAY, 'group_vars/encrypted.yml'))
+    whole['relpath'], whole['staged'] = 'group_vars/encrypted.yml', whole['file'] + rekey.STAGED_SUFFIX
+    assert 'raw' in whole and 'raw' not in cli.record_of(whole)
+
+def test_key_cache_reuses_derived_keys():
+    from ansible_vault_rekey.vaultstring import KeyCache
+    cache = KeyCache(maxsize=2)
+    password = open(join(PLAY, 'vault-password.txt')).read().strip()
+    ciphertext = rekey.get_dict_value(rekey.parse_yaml(join(PLAY, "group_vars/inlinesecrets.yml")),
+                                      ['password']).ciphertext
+    assert cache.decrypt(ciphertext, password) == b"i'm a little teapot"
+    assert len(cache.keys) == 1
+    assert cache.decrypt(ciphertext, password) == b"i'm a little teapot"
+    assert len(cache.keys) == 1
+    assert cache.vault(password) is cache.vault(password)
+
+
+def test_key_cache_bounded_and_wipe():
+    from ansible_vault_rekey.vaultstring import KeyCache
+    cache = KeyCache(maxsize=2)
+    encrypted = [cache.encrypt('moo{}'.format(i), 'password') for i in range(3)]
+    assert len(cache.keys) == 2
+    assert len(set(encrypted)) == 3
+    assert VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(b'password'))]).decrypt(encrypted[0]) == b'moo0'
+    cache.wipe()
+    assert len(cache.keys) == 0 and len(cache.vaults) == 0
+
+
+def test_classify_file():
+    whole = rekey.classify_file(join(PLAY, "group_vars/encrypted.yml"))
+    assert whole['raw'] == open(join(PLAY, "group_vars/encrypted.yml"), 'rb').read()
+    assert 'secrets' not in whole
+
+    inline = rekey.classify_file(join(PLAY, "group_vars/inlinesecrets.yml"))
+    assert sorted(inline['data'].keys()) == ['password', 'users']
+    assert ('users', 1, 'secrets', 1) in inline['secrets']
+    assert list(inline['spans'].keys()) == inline['secrets']
+    assert isinstance(rekey.get_dict_value(inline['data'], ['password']), VaultString)
+
+    assert rekey.classify_file(join(PLAY, "group_vars/nosecrets.yml")) is None
+    assert rekey.classify_file(join(PLAY, "group_vars/bad.yml")) is None
+
+
+def test_classify_file_mmap(monkeypatch):
+    monkeypatch.setattr(rekey, 'MMAP_THRESHOLD', 1)
+    assert rekey.classify_file(join(PLAY, "group_vars/nosecrets.yml")) is None
+    assert len(rekey.classify_file(join(PLAY, "group_vars/inlinesecrets.yml"))['secrets']) == 3
+
+
+def test_get_dict_value_nocopy():
+    d = rekey.parse_yaml(join(PLAY, "group_vars/inlinesecrets.yml"))
+    assert rekey.get_dict_value(d, ['users', 0, 'password']) is d['users'][0]['password']
+    assert rekey.get_dict_value(d, ['users', 5, 'password']) is None
+    assert rekey.get_dict_value(d, ['password', 'nested']) is None
+
+
+def test_find_yaml_secret_slots():
+    d = rekey.parse_yaml(join(PLAY, "group_vars/inlinesecrets.yml"))
+    slots = list(rekey.find_yaml_secret_slots(d))
+    assert [s[0] for s in slots] == list(rekey.find_yaml_secrets(d))
+    for address, container, key in slots:
+        assert container[key] is rekey.get_dict_value(d, address)
+        container[key] = 'moo'
+    assert rekey.get_dict_value(d, ['users', 1, 'secrets', 1]) == 'moo'
+
+
+def test_find_yaml_secrets_deep():
+    data = VaultString('moo')
+    for i in range(5000):
+        data = [{'plain': i}, {'nested': data}]
+    r = list(rekey.find_yaml_secrets(data))
+    assert r == [(1, 'nested') * 5000]
+    assert list(rekey.find_yaml_secrets({'a': {'x': VaultString('moo')}, 'b': VaultString('moo')})) == \
+        [('a', 'x'), ('b',)]
+
+
+def test_find_yaml_node_secrets():
+    content = open(join(PLAY, "group_vars/inlinesecrets.yml"), 'rb').read()
+    data, found = rekey.load_yaml_secrets(content)
+    assert [a for a, _ in found] == list(rekey.find_yaml_secrets(data))
+    for address, node in found:
+        assert rekey.get_dict_value(data, address).ciphertext == node.value.strip()
+
+    merged = 'base: &base\n  secret: !vault |\n    moo\nhost:\n  <<: *base\n  1: !vault |\n    moo\n'
+    data, found = rekey.load_yaml_secrets(merged)
+    assert [a for a, _ in found] == [('base', 'secret'), ('host', 'secret'), ('host', 1)]
+    assert [a for a, _ in found] == list(rekey.find_yaml_secrets(data))
+    assert rekey.load_yaml_secrets(open(join(PLAY, "group_vars/nosecrets.yml"), 'rb').read()) == (None, [])
+
+
+@pytest.mark.parametrize('loader,dumper', [
+    (yaml.SafeLoader, yaml.SafeDumper),
+    (rekey.YamlLoader, rekey.YamlDumper),
+])
+def test_vaultstring_yaml_backends(loader, dumper):
+    with open(join(PLAY, "group_vars/inlinesecrets.yml")) as f:
+        d = yaml.load(f, Loader=loader)
+    assert isinstance(d['password'], VaultString)
+    dumped = yaml.load(yaml.dump(d, Dumper=dumper), Loader=loader)
+    assert dumped['users'][1]['secrets'][1].ciphertext == d['users'][1]['secrets'][1].ciphertext
+
+
+def test_rekey_files_inmemory():
+    password_file = join(PLAY, "vault-password.txt")
+    alt_password_file = join(PLAY, "alt-vault-password.txt")
+    vault_files = [rekey.classify_file(join(PLAY, "group_vars/encrypted.yml")),
+                   rekey.classify_file(join(PLAY, "group_vars/inlinesecrets.yml"))]
+    r = rekey.rekey_files(vault_files, password_file, alt_password_file, jobs=2)
+    assert [i[1] for i in r] == [None, None]
+    assert r[0][0].startswith(b'$ANSIBLE_VAULT;1.1;AES256')
+    assert rekey.decrypt_secret(r[0][0], 'threetoomoo') == open(join(PLAY, 'group_vars/nosecrets.yml'), 'rb').read()
+    assert r[1][0]['users'][0]['password'].decrypt('threetoomoo') == b"i'm a little teapot"
+
+
+def test_command_line_interface_ciphertext_backups():
+    play = join(TMP_DIR, 'test_cli_ciphertext_backups')
+    shutil.copytree(PLAY, play)
+    original = open(join(play, 'group_vars/inlinesecrets.yml'), 'rb').read()
+    old_password = open(join(play, 'vault-password.txt')).read()
+    runner = CliRunner()
+    result = runner.invoke(cli.main, ['-k', '-r', play])
+    assert result.exit_code == 0
+    backups = join(play, '.rekey-backups')
+    assert open(join(backups, 'group_vars/inlinesecrets.yml'), 'rb').read() == original
+    assert open(join(backups, 'vault-password.txt')).read() == old_password
+    assert open(join(play, 'vault-password.txt')).read() != old_password
+    assert not [i for i in rekey.find_files(play, '*') if i.endswith('.rekey-tmp')]
+
+
+@pytest.mark.parametrize('backup_format', ['tar', 'tar.gz'])
+def test_archive_writer(backup_format):
+    backups = join(TMP_DIR, 'test_archive_writer_' + backup_format)
+    files = ['group_vars/inlinesecrets.yml', 'group_vars/encrypted.yml', 'local.yml']
+    writer = archive.ArchiveWriter(backups, backup_format)
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        list(pool.map(lambda name: writer.add(join(PLAY, name), name), files))
+    writer.close()
+    # a plain tar archive to anything else
+    with tarfile.open(writer.path) as tar:
+        assert sorted(tar.getnames()) == sorted(files)
+    assert archive.find_archives(backups) == [writer.path]
+    # members include the old password files, whatever the umask
+    assert [os.stat(p).st_mode & 0o777 for p in (writer.path, writer.path + archive.INDEX_SUFFIX)] == [0o600] * 2
+    entries = archive.load_index(writer.path)
+    target = archive.extract(writer.path, entries['local.yml'], join(backups, 'restored', 'local.yml'))
+    assert open(target, 'rb').read() == open(join(PLAY, 'local.yml'), 'rb').read()
+
+    # an index cut short by a crash still covers the members written before it
+    with open(writer.path + archive.INDEX_SUFFIX, 'a') as f:
+        f.write('{"name": "group_v')
+    assert list(archive.load_index(writer.path)) == list(entries)
+    entries['local.yml']['sha256'] = '0' * 64
+    with pytest.raises(ValueError):
+        archive.extract(writer.path, entries['local.yml'], target)
+    assert open(target, 'rb').read() == open(join(PLAY, 'local.yml'), 'rb').read()
+
+
+def test_command_line_interface_archive_backups():
+    play = join(TMP_DIR, 'test_cli_archive_backups')
+    shutil.copytree(PLAY, play)
+    original = open(join(play, 'group_vars/inlinesecrets.yml'), 'rb').read()
+    old_password = open(join(play, 'vault-password.txt')).read()
+    runner = CliRunner()
+    result = runner.invoke(cli.main, ['--backup-format', 'tar.gz', '-k', '-r', play])
+    assert result.exit_code == 0
+    backups = join(play, '.rekey-backups')
+    assert not os.path.exists(join(backups, 'group_vars'))
+    assert len(archive.find_archives(backups)) == 1
+
+    result = runner.invoke(cli.main, ['restore', '--list', '-r', play])
+    assert result.output.split() == ['vault-password.txt', 'group_vars/encrypted.yml',
+                                     'group_vars/inlinesecrets.yml', 'group_vars/rekey.yml']
+    assert runner.invoke(cli.main, ['restore', '-r', play, 'group_vars/nothere.yml']).exit_code == 1
+    result = runner.invoke(cli.main, ['restore', '-r', play, 'group_vars/inlinesecrets.yml'])
+    assert result.exit_code == 0
+    assert open(join(play, 'group_vars/inlinesecrets.yml'), 'rb').read() == original
+    assert open(join(play, 'vault-password.txt')).read() != old_password
+
+    result = runner.invoke(cli.main, ['restore', '-r', play, '--target', join(play, 'restored')])
+    assert result.exit_code == 0
+    assert open(join(play, 'restored', 'vault-password.txt')).read() == old_password
+
+
+def test_rekey_file_keeps_mode():
+    path = join(TMP_DIR, 'rekey_file_mode.yml')
+    shutil.copy(join(PLAY, "group_vars/encrypted.yml"), path)
+    os.chmod(path, 0o600)
+    rekey.rekey_file(path, join(PLAY, "vault-password.txt"), join(PLAY, 'alt-vault-password.txt'))
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert not os.path.exists(path + '.rekey-tmp')
+    assert rekey.decrypt_file(path, join(PLAY, 'alt-vault-password.txt')) == \
+        open(join(PLAY, "group_vars/nosecrets.yml"), 'rb').read()
+
+
+def test_command_line_interface_resume(monkeypatch):
+    play = join(TMP_DIR, 'test_cli_resume')
+    shutil.copytree(PLAY, play)
+    expected = rekey.parse_yaml(join(PLAY, "group_vars/inlinesecrets_decrypted.yml"))
+    real_replace = os.replace
+
+    def crashing_replace(src, dst):
+        if dst.endswith('group_vars/inlinesecrets.yml'):
+            raise KeyboardInterrupt()
+        real_replace(src, dst)
+    monkeypatch.setattr(os, 'replace', crashing_replace)
+    runner = CliRunner()
+    result = runner.invoke(cli.main, ['-r', play])
+    assert result.exit_code != 0
+    m = manifest.Manifest.load(join(play, '.rekey-backups', 'manifest.json'))
+    assert not m.complete
+    assert m.files['group_vars/inlinesecrets.yml']['state'] == manifest.DECRYPTED
+
+    monkeypatch.setattr(os, 'replace', real_replace)
+    result = runner.invoke(cli.main, ['--resume', '-k', '-r', play])
+    assert result.exit_code == 0
+    m = manifest.Manifest.load(join(play, '.rekey-backups', 'manifest.json'))
+    assert m.complete
+    assert set(i['state'] for i in m.files.values()) == set([manifest.REENCRYPTED])
+    password_file = join(play, 'vault-password.txt')
+    assert rekey.decrypt_file(join(play, 'group_vars/inlinesecrets.yml'), password_file) == expected
+    assert rekey.decrypt_file(join(play, 'group_vars/encrypted.yml'), password_file) == \
+        open(join(PLAY, 'group_vars/nosecrets.yml'), 'rb').read()
+
+    password = open(password_file).read()
+    result = runner.invoke(cli.main, ['--resume', '-r', play])
+    assert result.exit_code == 0
+    assert open(password_file).read() == password
+
+
+def crashing_journal(root, monkeypatch, names=('a', 'b', 'c')):
+    """A journal replacing a file per name in root, with the rename of the second one crashing."""
+    journal = commit.Journal(join(root, 'backups', 'run.journal'))
+    for name in names:
+        path = join(root, name)
+        with open(path, 'w') as f:
+            f.write('old ' + name)
+        with open(path + rekey.STAGED_SUFFIX, 'w') as f:
+            f.write('new ' + name)
+        journal.add(path, path + rekey.STAGED_SUFFIX)
+    real_replace = os.replace
+
+    def crashing_replace(src, dst):
+        if dst == join(root, names[1]):
+            raise KeyboardInterrupt()
+        real_replace(src, dst)
+    monkeypatch.setattr(os, 'replace', crashing_replace)
+    with pytest.raises(KeyboardInterrupt):
+        commit.commit(journal)
+    monkeypatch.setattr(os, 'replace', real_replace)
+    assert open(join(root, names[0])).read() == 'new ' + names[0]
+    assert open(join(root, names[1])).read() == 'old ' + names[1]
+    return commit.Journal.load(journal.path)
+
+
+def test_commit_journal(monkeypatch):
+    root = join(TMP_DIR, 'test_commit_journal')
+    os.makedirs(root)
+    journal = crashing_journal(root, monkeypatch)
+    assert journal.state == commit.PREPARED
+    assert commit.roll_forward(journal) == []
+    commit.finish(journal)
+    assert [open(join(root, n)).read() for n in 'abc'] == ['new a', 'new b', 'new c']
+    assert sorted(os.listdir(root)) == ['a', 'b', 'backups', 'c'] and os.listdir(join(root, 'backups')) == []
+
+    journal = crashing_journal(root, monkeypatch)
+    with open(journal.entries[2]['staged'], 'w') as f:
+        f.write('changed')
+    assert len(commit.roll_forward(journal)) == 1
+    assert open(join(root, 'c')).read() == 'old c'
+    assert commit.roll_back(journal) == []
+    commit.finish(journal)
+    assert [open(join(root, n)).read() for n in 'abc'] == ['old a', 'old b', 'old c']
+    assert sorted(os.listdir(root)) == ['a', 'b', 'backups', 'c']
+
+    journal = commit.Journal(join(root, 'backups', 'run.journal'))
+    with open(join(root, 'd' + rekey.STAGED_SUFFIX), 'w') as f:
+        f.write('new d')
+    journal.add(join(root, 'd'), join(root, 'd' + rekey.STAGED_SUFFIX))
+    commit.commit(journal)
+    assert commit.Journal.load(journal.path).state == commit.COMMITTED
+    assert commit.roll_back(journal) != []
+    commit.finish(journal)
+    assert open(join(root, 'd')).read() == 'new d'
+
+
+def test_command_line_interface_recover(monkeypatch):
+    play = join(TMP_DIR, 'test_cli_recover')
+    shutil.copytree(PLAY, play)
+    staged_password_file = join(play, 'vault-password.txt' + rekey.STAGED_SUFFIX)
+    rekey.write_password_file(staged_password_file, 'stale')
+    os.chmod(staged_password_file, 0o644)
+    originals = dict((p, open(p, 'rb').read()) for p in rekey.find_files(play, '*'))
+    real_replace = os.replace
+
+    def crashing_replace(src, dst):
+        if dst.endswith('group_vars/inlinesecrets.yml'):
+            raise KeyboardInterrupt()
+        real_replace(src, dst)
+    monkeypatch.setattr(os, 'replace', crashing_replace)
+    runner = CliRunner()
+    assert runner.invoke(cli.main, ['-r', play]).exit_code != 0
+    monkeypatch.setattr(os, 'replace', real_replace)
+    assert commit.find_journals(join(play, '.rekey-backups'))
+    # the new password waits for --resume readable by its owner only
+    assert os.stat(staged_password_file).st_mode & 0o777 == 0o600
+    assert open(join(play, 'group_vars/encrypted.yml'), 'rb').read() != originals[join(play, 'group_vars/encrypted.yml')]
+    # nothing else runs until the commit is finished or undone
+    assert runner.invoke(cli.main, ['-r', play]).exit_code == 1
+
+    result = runner.invoke(cli.main, ['recover', '--rollback', '-r', play])
+    assert result.exit_code == 0
+    assert dict((p, open(p, 'rb').read()) for p in rekey.find_files(play, '*')) == originals
+    assert not os.path.isfile(join(play, '.rekey-backups', 'manifest.json'))
+    assert not commit.find_journals(join(play, '.rekey-backups'))
+    assert runner.invoke(cli.main, ['recover', '-r', play]).exit_code == 0
+
+
+def test_command_line_interface_unreadable(monkeypatch):
+    play = join(TMP_DIR, 'test_cli_unreadable')
+    shutil.copytree(PLAY, play)
+    originals = dict((p, open(p, 'rb').read()) for p in rekey.find_files(play, '*'))
+    real_classify_file = rekey.classify_file
+
+    def failing_classify_file(path):
+        if path.endswith('group_vars/encrypted.yml'):
+            raise IOError(5, 'Input/output error')
+        return real_classify_file(path)
+    monkeypatch.setattr(rekey, 'classify_file', failing_classify_file)
+    result = CliRunner().invoke(cli.main, ['-r', play, '--no-cache'])
+    assert result.exit_code == 1
+    assert dict((p, open(p, 'rb').read()) for p in rekey.find_files(play, '*')) == originals
+
+
+def test_command_line_interface_since():
+    play = join(TMP_DIR, 'test_cli_since')
+    shutil.copytree(PLAY, play)
+    runner = CliRunner()
+    assert runner.invoke(cli.main, ['-k', '-r', play]).exit_code == 0
+    previous = join(TMP_DIR, 'test_cli_since_manifest.json')
+    shutil.move(join(play, '.rekey-backups', 'manifest.json'), previous)
+    shutil.rmtree(join(play, '.rekey-backups'))
+
+    password_file = join(play, 'vault-password.txt')
+    password = open(password_file).read()
+    untouched = open(join(play, 'group_vars/inlinesecrets.yml'), 'rb').read()
+    rekey.rekey_file(join(play, 'group_vars/encrypted.yml'), password_file, password_file)
+    edited = open(join(play, 'group_vars/encrypted.yml'), 'rb').read()
+
+    result = runner.invoke(cli.main, ['--since', previous, '-k', '-r', play])
+    assert result.exit_code == 0
+    assert open(password_file).read() == password
+    assert open(join(play, 'group_vars/inlinesecrets.yml'), 'rb').read() == untouched
+    assert open(join(play, 'group_vars/encrypted.yml'), 'rb').read() != edited
+    m = manifest.Manifest.load(join(play, '.rekey-backups', 'manifest.json'))
+    assert list(m.files.keys()) == ['group_vars/encrypted.yml']
+
+
+def make_tree(root, files):
+    for name, content in files.items():
+        path = join(root, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+    return root
+
+
+def test_scan_files_excludes_and_size():
+    root = make_tree(join(TMP_DIR, 'test_scan_files'), {
+        'vars.yml': 'a: b\n',
+        'big.yml': 'x' * 2048,
+        'template.yml.j2': '{{ moo }}',
+        'node_modules/pkg/vars.yml': 'a: b\n',
+        'roles/web/vars/main.yml': 'a: b\n',
+        'roles/web/vars/main.yml.rekey-tmp': 'a: b\n',
+    })
+    expected = sorted(realpath(join(root, i)) for i in ['vars.yml', 'roles/web/vars/main.yml'])
+    for threads in (1, 4):
+        r = rekey.find_files(root, '*.yml', max_size=1024, threads=threads)
+        assert sorted(r) == expected
+    assert sorted(rekey.find_files(root, ['*.yml'], exclude=['roles', 'big*'])) == [realpath(join(root, 'vars.yml'))]
+
+
+def test_scan_files_gitignore():
+    root = make_tree(join(TMP_DIR, 'test_scan_gitignore'), {
+        '.gitignore': '# comment\nbuild/\n*.retry\n/top.yml\n',
+        'top.yml': 'a: b\n',
+        'keep.yml': 'a: b\n',
+        'site.retry': 'a\n',
+        'build/vars.yml': 'a: b\n',
+        'roles/top.yml': 'a: b\n',
+        'roles/.gitignore': '*.yml\n!keep.yml\n',
+        'roles/keep.yml': 'a: b\n',
+        'roles/drop.yml': 'a: b\n',
+    })
+    r = sorted(i[len(realpath(root)) + 1:] for i in rekey.find_files(root, '*', gitignore=True, threads=2))
+    assert r == ['.gitignore', 'keep.yml', 'roles/.gitignore', 'roles/keep.yml']
+    assert len(list(rekey.find_files(root, '*'))) == 9
+
+
+def test_scan_index(monkeypatch):
+    root = make_tree(join(TMP_DIR, 'test_scan_index'), {'plain.yml': 'a: b\n'})
+    shutil.copy(join(PLAY, 'group_vars/inlinesecrets.yml'), root)
+    monkeypatch.setattr(index, 'RACY_SECONDS', 0)
+    idx = index.ScanIndex(join(TMP_DIR, 'test_scan_index.sqlite'))
+    plain, inline = join(root, 'plain.yml'), join(root, 'inlinesecrets.yml')
+    assert index.classify_file(plain, idx) is None
+    assert len(index.classify_file(inline, idx)['secrets']) == 3
+    assert idx.lookup(inline, os.stat(inline)) == index.INLINE
+
+    reads = []
+    monkeypatch.setattr(rekey, 'classify_file', lambda p: reads.append(p))
+    assert index.classify_file(plain, idx) is None
+    assert reads == []
+
+    with open(plain, 'a') as f:
+        f.write('c: d\n')
+    index.classify_file(plain, idx)
+    assert reads == [plain]
+
+    idx.prune(set([plain]))
+    assert idx.lookup(inline, os.stat(inline)) is None
+    idx.close()
+
+
+def test_metrics_formats():
+    m = Metrics()
+    m.incr('secrets', 3)
+    with m.timer('decrypt'):
+        pass
+    m.merge({'counters': {'secrets': 2}, 'timers': {'decrypt': [2, 1.5]}})
+    assert m.counters == {'secrets': 5}
+    assert m.timers['decrypt'][0] == 3
+    prom = m.to_prometheus()
+    assert 'ansible_vault_rekey_secrets_total 5\n' in prom
+    assert 'ansible_vault_rekey_stage_calls_total{stage="decrypt"} 3\n' in prom
+    assert len(m.summary()) == 4
+
+
+def test_metrics_from_pool_workers():
+    METRICS.reset()
+    tasks = [(VaultString.encrypt('moo', 'pw').ciphertext, 'pw') for _ in range(4)]
+    METRICS.reset()
+    rekey.parallel_map(rekey.decrypt_secret, tasks, jobs=2)
+    assert METRICS.timers['decrypt'][0] == 4
+
+
+def test_metrics_timed_pickles():
+    # decorated functions have to reach pool workers by reference
+    assert rekey.write_yaml.__module__ == rekey.__name__
+    assert pickle.loads(pickle.dumps(rekey.write_yaml)) is rekey.write_yaml
+    path = join(PLAY, 'group_vars/inlinesecrets.yml')
+    assert rekey.parallel_map(rekey.inventory_file, [(path,)], jobs=2) == [(rekey.inventory_file(path), None)]
+
+
+def test_command_line_interface_metrics():
+    play = join(TMP_DIR, 'test_cli_metrics')
+    shutil.copytree(PLAY, play)
+    metrics_file = join(TMP_DIR, 'test_cli_metrics.json')
+    profile = join(TMP_DIR, 'test_cli_metrics.pstats')
+    result = CliRunner().invoke(cli.main, ['--stats', '--metrics-file', metrics_file, '--profile', profile,
+                                           '-r', play])
+    assert result.exit_code == 0
+    with open(metrics_file) as f:
+        metrics = json.load(f)
+    assert metrics['counters']['inline_secrets'] == 3
+    assert metrics['counters']['files_rekeyed'] == 3
+    for stage in ('scan', 'classify', 'backup', 'decrypt', 'encrypt', 'rekey', 'commit'):
+        assert stage in metrics['timers']
+    assert os.path.getsize(profile) > 0
+
+
+def test_stream_rekey_chunks():
+    for size in (0, 15, 16, 5000):
+        plaintext = os.urandom(size)
+        vaulttext = KEY_CACHE.encrypt(plaintext, 'old')
+        for chunk_size in (7, 1024):
+            out = io.BytesIO()
+            assert stream.rekey(io.BytesIO(vaulttext), out, 'old', 'new', chunk_size) == size
+            assert KEY_CACHE.decrypt(out.getvalue(), 'new') == plaintext
+            assert len(out.getvalue()) == len(vaulttext)
+    with pytest.raises(ValueError):
+        stream.decrypt(io.BytesIO(vaulttext), None, 'wrong')
+
+
+def test_rekey_files_streamed(monkeypatch):
+    monkeypatch.setattr(rekey, 'STREAM_THRESHOLD', 0)
+    password_file = join(PLAY, 'vault-password.txt')
+    new_password_file = join(TMP_DIR, 'test_rekey_files_streamed_password')
+    rekey.write_password_file(new_password_file, 'streamed', overwrite=True)
+    vf = rekey.classify_file(join(PLAY, 'group_vars/encrypted.yml'))
+    assert vf['stream'] and 'raw' not in vf
+    assert rekey.file_vault_ids(vf) == 'default'
+    plaintext = rekey.decrypt_secret(rekey.read_bytes(vf['file']), rekey.read_password(password_file))
+
+    newpath = join(TMP_DIR, 'test_rekey_files_streamed.yml')
+    r = rekey.rekey_files([vf], password_file, new_password_file, [newpath])
+    assert r == [(len(plaintext), None)]
+    assert rekey.decrypt_secret(rekey.read_bytes(newpath), 'streamed') == plaintext
+
+    decrypted = join(TMP_DIR, 'test_rekey_files_streamed.txt')
+    r = rekey.decrypt_files([dict(vf, file=newpath)], password_file, [decrypted])
+    assert r[0][0] is None and r[0][1]
+    assert not os.path.exists(decrypted)
+    assert rekey.decrypt_files([dict(vf, file=newpath)], new_password_file, [decrypted])[0][1] is None
+    assert rekey.read_bytes(decrypted) == plaintext
+
+
+def test_command_line_interface_streamed_indexed(monkeypatch):
+    monkeypatch.setattr(rekey, 'STREAM_THRESHOLD', 0)
+    play = join(TMP_DIR, 'test_cli_streamed_indexed')
+    shutil.copytree(PLAY, play)
+    runner = CliRunner()
+    result = runner.invoke(cli.main, ['-k', '-r', play, '--index-file', join(TMP_DIR, 'test_cli_streamed_indexed.sqlite')])
+    assert result.exit_code == 0
+    m = manifest.Manifest.load(join(play, '.rekey-backups', 'manifest.json'))
+    assert 'group_vars/encrypted.yml' in m.files
+    assert rekey.decrypt_file(join(play, 'group_vars/encrypted.yml'), join(play, 'vault-password.txt')) == \
+        open(join(PLAY, 'group_vars/nosecrets.yml'), 'rb').read()
+
+
+def test_rekey_secret_keyring():
+    keyring = {'dev': 'devpass', 'default': 'defpass'}
+    dev = rekey.encrypt_secret('moo', 'devpass', 'dev')
+    assert dev.startswith(b'$ANSIBLE_VAULT;1.2;AES256;dev\n')
+    assert rekey.vault_id(dev) == 'dev'
+    assert rekey.decrypt_secret(dev, keyring) == b'moo'
+
+    rekeyed = rekey.rekey_secret(dev, keyring, {'dev': 'newdev'})
+    assert rekey.vault_id(rekeyed) == 'dev'
+    assert rekey.decrypt_secret(rekeyed, 'newdev') == b'moo'
+
+    prod = rekey.encrypt_secret('baa', 'prodpass', 'prod')
+    assert rekey.rekey_secret(prod, keyring, {'dev': 'newdev'}) == prod
+    with pytest.raises(ValueError):
+        rekey.decrypt_secret(prod, keyring)
+
+
+def test_command_line_interface_vault_ids():
+    root = join(TMP_DIR, 'test_cli_vault_ids')
+    passwords = {'dev': 'devpass', 'prod': 'prodpass', 'legacy': 'legacypass', 'default': 'defpass'}
+    inline = {
+        'dev_secret': VaultString(rekey.encrypt_secret('d', 'devpass', 'dev').decode('utf-8')),
+        'prod_secret': VaultString(rekey.encrypt_secret('p', 'prodpass', 'prod').decode('utf-8')),
+        'old_secret': VaultString(rekey.encrypt_secret('o', 'defpass').decode('utf-8')),
+    }
+    make_tree(root, {
+        'group_vars/all.yml': yaml.dump(inline, Dumper=rekey.YamlDumper),
+        'host_vars/web/vault.yml': rekey.encrypt_secret('x: 1\n', 'devpass', 'dev').decode('utf-8'),
+        'host_vars/old/vault.yml': rekey.encrypt_secret('y: 2\n', 'legacypass', 'legacy').decode('utf-8'),
+    })
+    for vid, password in passwords.items():
+        rekey.write_password_file(join(TMP_DIR, 'test_cli_vault_ids_' + vid), password)
+    legacy = open(join(root, 'host_vars/old/vault.yml'), 'rb').read()
+
+    result = CliRunner().invoke(cli.main, [
+        '-r', root, '--no-cache',
+        '--vault-id', 'dev@' + join(TMP_DIR, 'test_cli_vault_ids_dev'),
+        '--vault-id', 'prod@' + join(TMP_DIR, 'test_cli_vault_ids_prod')])
+    assert result.exit_code == 0
+    assert not os.path.exists(join(root, 'vault-password.txt'))
+
+    new = dict((vid, rekey.read_password(join(TMP_DIR, 'test_cli_vault_ids_' + vid))) for vid in passwords)
+    assert new['dev'] != 'devpass' and new['prod'] != 'prodpass'
+    assert new['legacy'] == 'legacypass' and new['default'] == 'defpass'
+    data = rekey.parse_yaml(join(root, 'group_vars/all.yml'))
+    assert rekey.decrypt_secret(data['dev_secret'].ciphertext, new) == b'd'
+    assert rekey.decrypt_secret(data['prod_secret'].ciphertext, new) == b'p'
+    assert data['old_secret'].ciphertext == inline['old_secret'].ciphertext
+    assert rekey.decrypt_secret(rekey.read_bytes(join(root, 'host_vars/web/vault.yml')), new) == b'x: 1\n'
+    assert open(join(root, 'host_vars/old/vault.yml'), 'rb').read() == legacy
+
+
+SPLICE_VARS = '''---
+# database settings
+db_user: app   # trailing comment
+db_password: {}
+
+# keep this order
+zebra: 1
+apple:
+  - {}
+  - plain
+'''
+
+
+def without_vault_lines(text):
+    return [line for line in text.splitlines() if not re.match(r'\s*(\$ANSIBLE_VAULT|[0-9a-f]+$)', line)]
+
+
+def test_rekey_files_preserves_format():
+    root = join(TMP_DIR, 'test_rekey_files_splice')
+    blocks = [rekey.encrypt_secret(p, 'old').decode('utf-8') for p in ('one', 'two')]
+    text = SPLICE_VARS.format('!vault |\n  ' + blocks[0].strip().replace('\n', '\n  ') + '\n',
+                              '!vault |\n      ' + blocks[1].strip().replace('\n', '\n      '))
+    make_tree(root, {'vars.yml': text})
+    rekey.write_password_file(join(root, 'old'), 'old')
+    rekey.write_password_file(join(root, 'new'), 'new')
+    vf = rekey.classify_file(join(root, 'vars.yml'))
+    assert len(vf['spans']) == 2
+
+    rekey.rekey_files([vf], join(root, 'old'), join(root, 'new'), [join(root, 'out.yml')])
+    out = open(join(root, 'out.yml')).read()
+    assert without_vault_lines(out) == without_vault_lines(text)
+    assert len(out.splitlines()) == len(text.splitlines())
+    data = rekey.parse_yaml(join(root, 'out.yml'))
+    assert rekey.decrypt_secret(data['db_password'].ciphertext, 'new') == b'one'
+    assert rekey.decrypt_secret(data['apple'][0].ciphertext, 'new') == b'two'
+
+    vf = rekey.classify_file(join(root, 'vars.yml'))
+    assert rekey.decrypt_files([vf], join(root, 'old'), [join(root, 'plain.yml')])[0][1] is None
+    plain = open(join(root, 'plain.yml')).read()
+    assert '# keep this order\nzebra: 1\n' in plain
+    assert rekey.parse_yaml(join(root, 'plain.yml'))['apple'] == ['two', 'plain']
+
+    vf = rekey.classify_file(join(root, 'vars.yml'))
+    rekey.rekey_files([vf], join(root, 'old'), join(root, 'new'), [join(root, 'reformat.yml')],
+                      preserve_format=False)
+    assert '#' not in open(join(root, 'reformat.yml')).read()
+
+    with open(join(root, 'crlf.yml'), 'wb') as f:
+        f.write(text.replace('\n', '\r\n').encode('utf-8'))
+    vf = rekey.classify_file(join(root, 'crlf.yml'))
+    rekey.rekey_files([vf], join(root, 'old'), join(root, 'new'), [join(root, 'out.yml')])
+    out = open(join(root, 'out.yml'), 'rb').read().decode('utf-8')
+    assert out.count('\n') == out.count('\r\n') == len(text.splitlines())
+    assert without_vault_lines(out.replace('\r\n', '\n')) == without_vault_lines(text)
+    assert rekey.decrypt_secret(rekey.parse_yaml(join(root, 'out.yml'))['db_password'].ciphertext, 'new') == b'one'
+
+
+def test_rekey_files_splice_fallback():
+    root = join(TMP_DIR, 'test_rekey_files_splice_fallback')
+    block = rekey.encrypt_secret('one', 'old').decode('utf-8')
+    make_tree(root, {'vars.yml': '# comment\na: !vault "{}"\n'.format(block.replace('\n', '\\n'))})
+    rekey.write_password_file(join(root, 'old'), 'old')
+    vf = rekey.classify_file(join(root, 'vars.yml'))
+    r = rekey.rekey_files([vf], join(root, 'old'), join(root, 'old'), [join(root, 'out.yml')])
+    assert r[0][1] is None
+    out = open(join(root, 'out.yml')).read()
+    assert '# comment' not in out
+    assert rekey.decrypt_secret(rekey.parse_yaml(join(root, 'out.yml'))['a'].ciphertext, 'old') == b'one'
+
+
+def test_rekey_files_splice_anchors():
+    root = join(TMP_DIR, 'test_rekey_files_splice_anchors')
+    block = rekey.encrypt_secret('one', 'old').decode('utf-8').strip().replace('\n', '\n    ')
+    make_tree(root, {'vars.yml': '# comment\nbase: &b\n  password: !vault |\n    {}\ncopy: *b\n'
+                                 'merged:\n  <<: *b\n  other: 1\n'.format(block)})
+    rekey.write_password_file(join(root, 'old'), 'old')
+    rekey.write_password_file(join(root, 'new'), 'new')
+    vf = rekey.classify_file(join(root, 'vars.yml'))
+    assert len(set(vf['spans'].values())) == 1 and len(vf['secrets']) == 3
+    # one node under three addresses can't be spliced three times, the file is re-emitted
+    r = rekey.rekey_files([vf], join(root, 'old'), join(root, 'new'), [join(root, 'out.yml')])
+    assert r[0][1] is None
+    data = rekey.parse_yaml(join(root, 'out.yml'))
+    for key in ('base', 'copy', 'merged'):
+        assert rekey.decrypt_secret(data[key]['password'].ciphertext, 'new') == b'one'
+    assert data['merged']['other'] == 1
+
+    vf = rekey.classify_file(join(root, 'vars.yml'))
+    assert rekey.decrypt_files([vf], join(root, 'old'), [join(root, 'plain.yml')])[0][1] is None
+    data = rekey.parse_yaml(join(root, 'plain.yml'))
+    assert [data[key]['password'] for key in ('base', 'copy', 'merged')] == ['one'] * 3
+
+
+def test_pipeline_run():
+    produced = []
+
+    def source():
+        for i in range(200):
+            produced.append(i)
+            yield i
+
+    def slow_double(i):
+        time.sleep(0.001)
+        return i * 2
+
+    seen_by_sink = []
+
+    def sink(i):
+        # the source can't run further ahead of the last stage than the queues between them hold
+        seen_by_sink.append(len(produced) - i // 2)
+        return i if i % 4 == 0 else None
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        stages = [pipeline.Stage(slow_double, pool, 2), pipeline.Stage(sink)]
+        results = pipeline.run(source(), stages, pool, queue_size=4)
+    assert sorted(results) == list(range(0, 400, 4))
+    assert max(seen_by_sink) <= 4 * 3 + 2 + 2
+
+
+def test_pipeline_run_raises():
+    def fail(i):
+        if i == 3:
+            raise ValueError('moo')
+        return i
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        with pytest.raises(ValueError):
+            pipeline.run(range(100), [pipeline.Stage(fail, pool, 2), pipeline.Stage(lambda i: i)], pool, queue_size=2)
+
+
+def test_command_line_interface_verify():
+    derivations = []
+    for args in ([], ['--verify']):
+        play = join(TMP_DIR, 'test_cli_verify{}'.format(len(args)))
+        shutil.copytree(PLAY, play)
+        KEY_CACHE.wipe()
+        result = CliRunner().invoke(cli.main, args + ['-r', play])
+        assert result.exit_code == 0
+        derivations.append(METRICS.timers['key_derivation'][0])
+    assert METRICS.counters['files_verified'] == 3
+    assert METRICS.counters['secrets_verified'] == 3
+    # checking against the new ciphertext needs no more keys than writing it did
+    assert derivations[0] == derivations[1]
+    assert not os.path.isdir(join(play, '.rekey-backups'))
+
+
+def test_command_line_interface_verify_mismatch(monkeypatch, caplog):
+    play = join(TMP_DIR, 'test_cli_verify_mismatch')
+    shutil.copytree(PLAY, play)
+    original = open(join(play, 'group_vars/inlinesecrets.yml'), 'rb').read()
+    password = open(join(play, 'vault-password.txt')).read()
+    real_encrypt = rekey.encrypt_secret
+
+    def corrupting_encrypt(plaintext, password, vault_id=None):
+        return real_encrypt(plaintext + b'!', password, vault_id)
+    monkeypatch.setattr(rekey, 'encrypt_secret', corrupting_encrypt)
+    result = CliRunner().invoke(cli.main, ['--verify', '-r', play])
+    assert result.exit_code != 0
+    assert "at ['password'], ['users', 0, 'password']" in caplog.text
+    assert open(join(play, 'group_vars/inlinesecrets.yml'), 'rb').read() == original
+    assert open(join(play, 'vault-password.txt')).read() == password
+    assert os.path.isdir(join(play, '.rekey-backups'))
+    assert not [i for i in rekey.find_files(play, '*') if i.endswith('.rekey-tmp')]
+
+
+def test_verify_staged():
+    password_file = join(PLAY, 'vault-password.txt')
+    vf = rekey.classify_file(join(PLAY, 'group_vars/inlinesecrets.yml'))
+    originals = [rekey.get_dict_value(vf['data'], a).ciphertext for a in vf['secrets']]
+    vf['staged'] = join(TMP_DIR, 'test_verify_staged.yml')
+    rekey.rekey_files([vf], password_file, password_file, [vf['staged']])
+    password = rekey.read_password(password_file)
+    assert rekey.verify_staged(vf, originals, password, password) == []
+    assert rekey.verify_staged(vf, originals, password, 'wrong') == vf['secrets']
+
+
+def vault_block(indent, vault_id=None):
+    ciphertext = rekey.encrypt_secret('moo', 'pw', vault_id).decode('utf-8').strip()
+    return '!vault |\n' + '\n'.join(indent + line for line in ciphertext.splitlines())
+
+
+def test_find_vault_blocks():
+    docs = [
+        open(join(PLAY, 'group_vars/inlinesecrets.yml')).read(),
+        '---\n# c\na:\n  b:\n    - name: x\n      pw: ' + vault_block('        ') +
+        '\n\n    - - ' + vault_block('        ', 'dev') + '\n  1.5: "q: !vault"\n',
+        'users:\n- ' + vault_block('  ') + '\n- k: ' + vault_block('    ') + '\nyes: x\n',
+        'doc: |\n  fake: !vault |\n    x\nlong: one\n  two\n"k": \'multi\n  line\'\nz: ' + vault_block('  '),
+    ]
+    for doc in docs:
+        _, found = rekey.load_yaml_secrets(doc)
+        expected = [(a, (n.start_mark.index, n.end_mark.index), rekey.vault_id(n.value)) for a, n in found]
+        assert expected and textscan.find_vault_blocks(doc) == expected
+    ambiguous = [
+        'a: &x ' + vault_block('  ') + '\nb: *x\n',
+        'a: {b: !vault "x"}\n',
+        'a: ' + vault_block('  ') + '\na: 1\n',
+        'a: ' + vault_block('  ') + '\n---\nb: 1\n',
+        'a: 1  # !vault\n',
+    ]
+    for doc in ambiguous:
+        assert textscan.find_vault_blocks(doc) is None
+    assert textscan.find_vault_blocks('a: 1\n') == []
+
+
+def test_classify_file_complex_key():
+    root = make_tree(join(TMP_DIR, 'test_classify_file_complex_key'),
+                     {'vars.yml': '? [a, b]\n: 1\nsecret: {}\n'.format(vault_block('  '))})
+    with pytest.raises(yaml.YAMLError):
+        rekey.classify_file(join(root, 'vars.yml'))
+
+
+def test_classify_file_skips_mentions(monkeypatch):
+    path = join(TMP_DIR, 'mentions.sh')
+    make_tree(TMP_DIR, {'mentions.sh': "grep -l '$ANSIBLE_VAULT;' *.yml\n"})
+    monkeypatch.setattr(rekey, 'load_yaml_secrets', None)
+    assert rekey.classify_file(path) is None
+    assert rekey.inventory_file(path) is None
+
+
+def test_command_line_interface_scan_only():
+    play = join(TMP_DIR, 'test_cli_scan_only')
+    shutil.copytree(PLAY, play)
+    os.remove(join(play, 'vault-password.txt'))
+    result = CliRunner().invoke(cli.main, ['--scan-only', '-r', play])
+    assert result.exit_code == 0
+    assert 'inlinesecrets.yml: password, users.0.password, users.1.secrets.1 [default]' in result.output
+    assert 'encrypted.yml: (whole) [default]' in result.output
+    assert not os.path.exists(join(play, '.rekey-backups'))
+
+
+def test_command_line_interface_lazy_imports():
+    # a fresh interpreter, this one already has everything imported
+    play = join(TMP_DIR, 'test_cli_lazy_imports')
+    shutil.copytree(PLAY, play)
+    check = ('import sys\nfrom ansible_vault_rekey import cli\n'
+             'try:\n    cli.main(sys.argv[1:])\nexcept SystemExit:\n    pass\n'
+             'print(sorted(m for m in sys.modules if m.split(".")[0] in ("ansible", "cryptography")))')
+    for args in (['--help'], ['--scan-only', '-r', play]):
+        output = subprocess.check_output([sys.executable, '-c', check] + args, stderr=subprocess.DEVNULL)
+        assert output.decode('utf-8').splitlines()[-1] == '[]'
+    output = subprocess.check_output([sys.executable, '-c', check, '--dry-run', '-r', play], stderr=subprocess.DEVNULL)
+    assert 'ansible.parsing.vault' in output.decode('utf-8').splitlines()[-1]
+
+
+def git_commit(repo, message):
+    scanner.git(repo, 'add', '-A')
+    scanner.git(repo, '-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-q', '-m', message)
+
+
+def test_command_line_interface_git_diff():
+    play = join(TMP_DIR, 'test_cli_git_diff')
+    shutil.copytree(PLAY, play)
+    assert CliRunner().invoke(cli.main, ['--git-diff', 'HEAD', '-r', play]).exit_code == 1
+    scanner.git(play, 'init', '-q')
+    git_commit(play, 'initial')
+    with open(join(play, 'group_vars/inlinesecrets.yml'), 'a') as f:
+        f.write('# edited\n')
+    scanner.git(play, 'mv', 'group_vars/encrypted.yml', 'group_vars/moved.yml')
+    scanner.git(play, 'rm', '-q', 'group_vars/rekey.yml')
+    git_commit(play, 'edit, move and delete')
+    moved = open(join(play, 'group_vars/moved.yml'), 'rb').read()
+    password_file = join(play, 'vault-password.txt')
+    password = open(password_file).read()
+
+    result = CliRunner().invoke(cli.main, ['--git-diff', 'HEAD~1..HEAD', '-k', '-r', play])
+    assert result.exit_code == 0
+    m = manifest.Manifest.load(join(play, '.rekey-backups', 'manifest.json'))
+    assert sorted(m.files.keys()) == ['group_vars/inlinesecrets.yml', 'group_vars/moved.yml']
+    assert open(password_file).read() == password
+    assert open(join(play, 'group_vars/moved.yml'), 'rb').read() != moved
+    assert rekey.decrypt_file(join(play, 'group_vars/moved.yml'), password_file) == \
+        open(join(PLAY, 'group_vars/nosecrets.yml'), 'rb').read()
+
+    shutil.rmtree(join(play, '.rekey-backups'))
+    shutil.copy(join(PLAY, 'group_vars/inlinesecrets.yml'), join(play, 'group_vars/staged.yml'))
+    shutil.copy(join(PLAY, 'group_vars/inlinesecrets.yml'), join(play, 'group_vars/untracked.yml'))
+    scanner.git(play, 'add', 'group_vars/staged.yml')
+    assert rekey.find_changed_files(play, staged=True) == [join(play, 'group_vars/staged.yml')]
+    result = CliRunner().invoke(cli.main, ['--staged', '-k', '-r', play])
+    assert result.exit_code == 0
+    m = manifest.Manifest.load(join(play, '.rekey-backups', 'manifest.json'))
+    assert list(m.files.keys()) == ['group_vars/staged.yml']
+
+
+def test_shard_partition():
+    weights = dict(('group_vars/g{}.yml'.format(i), 1 + i % 7) for i in range(50))
+    shards = shard.partition(weights, 3)
+    assert shards == shard.partition(dict(reversed(list(weights.items()))), 3)
+    assert sorted(sum(shards, [])) == sorted(weights)
+    loads = [sum(weights[f] for f in s) for s in shards]
+    assert max(loads) - min(loads) <= max(weights.values())
+    assert shard.parse('2/4') == (2, 4)
+    for spec in ('0/2', '3/2', '2', 'a/b'):
+        with pytest.raises(ValueError):
+            shard.parse(spec)
+
+
+def test_command_line_interface_shard():
+    play = join(TMP_DIR, 'test_cli_shard')
+    shutil.copytree(PLAY, play)
+    password_file = join(play, 'vault-password.txt')
+    new_password_file = join(TMP_DIR, 'test_cli_shard_password.txt')
+    rekey.write_password_file(new_password_file, password='shard-password', overwrite=True)
+    runner = CliRunner()
+    assert runner.invoke(cli.main, ['--shard', '1/2', '-r', play]).exit_code == 1
+    assert runner.invoke(cli.main, ['--shard', '3/2', '--new-password-file', new_password_file, '-r', play]).exit_code == 1
+
+    result = runner.invoke(cli.main, ['--shard', '1/2', '--new-password-file', new_password_file, '-r', play])
+    assert result.exit_code == 0
+    first = manifest.Manifest.load(join(play, '.rekey-backups', 'shard-1-of-2.json'))
+    assert first.complete and first.shard['files'] == sorted(first.files)
+    # the rest still decrypt under the old password until the merge
+    assert rekey.decrypt_file(join(play, 'group_vars/encrypted.yml'), password_file)
+    result = runner.invoke(cli.main, ['merge', '--new-password-file', new_password_file, '-r', play])
+    assert result.exit_code == 1
+    assert os.path.isdir(join(play, '.rekey-backups'))
+
+    result = runner.invoke(cli.main, ['--shard', '2/2', '--new-password-file', new_password_file, '-r', play])
+    assert result.exit_code == 0
+    second = manifest.Manifest.load(join(play, '.rekey-backups', 'shard-2-of-2.json'))
+    assert first.shard['partition'] == second.shard['partition']
+    assert not set(first.files) & set(second.files)
+    wrong_password_file = join(TMP_DIR, 'test_cli_shard_wrong_password.txt')
+    rekey.write_password_file(wrong_password_file, password='wrong-password', overwrite=True)
+    assert runner.invoke(cli.main, ['merge', '--new-password-file', wrong_password_file, '-r', play]).exit_code == 1
+
+    result = runner.invoke(cli.main, ['merge', '--new-password-file', new_password_file, '-k', '-r', play])
+    assert result.exit_code == 0
+    assert rekey.read_password(password_file) == 'shard-password'
+    m = manifest.Manifest.load(join(play, '.rekey-backups', 'manifest.json'))
+    assert m.complete and sorted(m.files) == sorted(list(first.files) + list(second.files))
+    # the shard manifests are the run's own, not backups to restore
+    result = runner.invoke(cli.main, ['restore', '--list', '-r', play])
+    assert 'group_vars/encrypted.yml' in result.output.splitlines()
+    assert not [name for name in result.output.splitlines() if name.endswith('.json')]
+    for relpath in m.files:
+        vf = rekey.classify_file(join(play, relpath))
+        assert rekey.decrypt_checked(password_file, vf)[2] is None